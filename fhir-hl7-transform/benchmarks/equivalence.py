@@ -0,0 +1,321 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Equivalence check of the HL7v2 backends on synthetic patients generated by
+# benchmarks/patients.py, half of them with HL7v2 delimiters in their values:
+#
+#   encode   the er7 and hl7apy encoders write the same ADT message
+#   decode   the er7 and hl7apy parsers read the same resource
+#            (patients without delimiters only: hl7apy does not decode
+#            escape sequences and drops subcomponent separators)
+#   project  parsing with a projection returns the projection of the full
+#            parse, for every parser and top-level element
+#   update   update_adt_message writes the same message as
+#            create_adt_message for patients changed after they were read
+#   patch    the PATCH interaction of the Lambda handler sends the message
+#            of the patched patient, keeping the fields of the stored
+#            message that are not read back (PID-15, PID-16) and escaping
+#            values once, for every encoder and parser
+#   canonical  the canonical form of a patient (WRITE_RESPONSE_MODE mapping)
+#            equals the patient read back from its message (mode message),
+#            for every encoder and parser and for patients with empty
+#            elements
+#
+# Message date/time (MSH-7) and message control ID (MSH-10) are new for every
+# message and are not compared. Exits with status 1 on differences.
+#
+# Usage: python benchmarks/equivalence.py [--patients 100] [--seed 0]
+import argparse
+import json
+import random
+import sys
+from contextlib import contextmanager
+from copy import deepcopy
+from importlib import import_module
+
+# micro adds the Lambda function directory to the import path
+from micro import StubStore
+from patients import generate_patients
+
+import transform
+from lib import er7_message_builder, fhir_to_hl7, hl7_to_fhir
+from lib.fhir_projection import SUMMARY_ELEMENTS, project
+from lib.fhir_resource_writer import FhirResourceWriter
+from lib.fhir_to_hl7 import ENCODERS
+from lib.hl7_to_fhir import PARSERS, Hl7v2ToFhirConverter
+
+DELIMITERS = "|^~\\&"
+
+# Patients with empty elements and lists, checked once
+EMPTY_ELEMENT_PATIENTS = [
+    dict(contact=[dict(relationship=[{}])]),
+    dict(contact=[dict(relationship=[dict(coding=[])])]),
+    dict(contact=[dict(relationship=[dict(coding=[{}])])]),
+    dict(contact=[{}, dict(telecom=[{}], address={}, name={})]),
+    dict(name=[{}, dict(prefix=[]), dict(given=[]), dict(given=["", "B"])]),
+    dict(identifier=[{}, dict(type={}), dict(type=dict(coding=[]), assigner={})]),
+    dict(identifier=[dict(type=dict(coding=[{}]), value="1")]),
+    dict(address=[{}, dict(line=[]), dict(line=["", "A", "B"])]),
+    dict(telecom=[{}, dict(use="home")]),
+    dict(contact=[dict(name=dict(given=[""]), address=dict(line=[""]))]),
+    dict(address=[{}, dict(district="D")], telecom=[dict(value="1", use="work")]),
+    dict(),
+]
+
+# Elements that are encoded but not read back into the resource, the stored
+# message keeps them when a patient read from it is updated
+CARRIED_ELEMENTS = ["communication", "maritalStatus"]
+
+
+def _add_delimiters(patient: dict) -> None:
+    patient["name"][0]["family"] += DELIMITERS
+    patient["address"][0]["line"][0] += DELIMITERS
+    patient["contact"][0]["name"]["family"] += DELIMITERS
+
+
+class CapturingSqs(object):
+    """
+    SQS client keeping the body of the last message sent
+    """
+
+    body = None
+
+    def send_message(self, **kwargs):
+        self.body = kwargs["MessageBody"]
+
+
+def _change_gender(rng: random.Random, patient: dict) -> None:
+    patient["gender"] = rng.choice(["male", "female", "other", "unknown"])
+
+
+def _change_birth_date(rng: random.Random, patient: dict) -> None:
+    patient["birthDate"] = f"{rng.randint(1920, 2020)}-01-01"
+
+
+def _change_family(rng: random.Random, patient: dict) -> None:
+    patient["name"][0]["family"] = f"Family {rng.randint(1, 9999)}"
+
+
+def _add_telecom(rng: random.Random, patient: dict) -> None:
+    patient.setdefault("telecom", []).append(
+        dict(system="phone", value=f"555 {rng.randint(0, 9999):04d}", use="home")
+    )
+
+
+def _remove_contact(rng: random.Random, patient: dict) -> None:
+    if patient.get("contact"):
+        del patient["contact"][rng.randrange(len(patient["contact"]))]
+
+
+def _add_contact(rng: random.Random, patient: dict) -> None:
+    patient.setdefault("contact", []).append(
+        dict(name=dict(family=f"Contact {rng.randint(1, 9999)}", given=["A"]))
+    )
+
+
+def _change_contact(rng: random.Random, patient: dict) -> None:
+    if patient.get("contact"):
+        contact = patient["contact"][rng.randrange(len(patient["contact"]))]
+        contact["name"] = dict(family=f"Other{DELIMITERS}", given=["B"])
+
+
+def _reverse_contacts(rng: random.Random, patient: dict) -> None:
+    patient.get("contact", []).reverse()
+
+
+def _set_communication(rng: random.Random, patient: dict) -> None:
+    patient["communication"] = [dict(language=dict(text=rng.choice(["en", "fr"])))]
+
+
+CHANGES = [
+    _change_gender,
+    _change_birth_date,
+    _change_family,
+    _add_telecom,
+    _remove_contact,
+    _add_contact,
+    _change_contact,
+    _reverse_contacts,
+    _set_communication,
+]
+
+
+def _segments(hl7msg: str) -> list:
+    segments = hl7msg.split("\r")
+    msh = segments[0].split("|")
+    msh[6] = msh[9] = ""
+    segments[0] = "|".join(msh)
+    return segments
+
+
+def _parse(hl7msg: str, parser: str, elements: frozenset = None) -> dict:
+    return Hl7v2ToFhirConverter(
+        hl7msg, "Patient", "p", parser=parser, elements=elements
+    ).transform()
+
+
+def check_encode(messages: dict) -> bool:
+    return len({tuple(_segments(message)) for message in messages.values()}) == 1
+
+
+def check_decode(hl7msg: str) -> bool:
+    resources = [_parse(hl7msg, parser) for parser in PARSERS]
+    return all(resource == resources[0] for resource in resources)
+
+
+def check_project(hl7msg: str) -> int:
+    """
+    Returns number of projections that differ from the projected full parse
+    """
+    differences = 0
+    for parser in PARSERS:
+        resource = _parse(hl7msg, parser)
+        projections = [frozenset([element]) for element in resource]
+        projections.append(SUMMARY_ELEMENTS["Patient"])
+        for elements in projections:
+            if _parse(hl7msg, parser, elements) != project(resource, elements):
+                differences += 1
+    return differences
+
+
+def check_update(rng: random.Random, patient: dict, hl7msg: str) -> bool:
+    previous = _parse(hl7msg, "er7")
+    changed = deepcopy(previous)
+    for change in rng.sample(CHANGES, rng.randint(0, 3)):
+        change(rng, changed)
+    expected = deepcopy(changed)
+    for element in CARRIED_ELEMENTS:
+        if element not in expected and element in patient:
+            expected[element] = deepcopy(patient[element])
+    updated = er7_message_builder.update_adt_message(hl7msg, previous, changed)
+    return _segments(updated) == _segments(
+        er7_message_builder.create_adt_message(expected)
+    )
+
+
+@contextmanager
+def _defaults(encoder: str, parser: str):
+    # Encoder and parser of the handler and writers, set from HL7_ENCODER and
+    # HL7_PARSER on import
+    defaults = (fhir_to_hl7.DEFAULT_ENCODER, hl7_to_fhir.DEFAULT_PARSER)
+    fhir_to_hl7.DEFAULT_ENCODER, hl7_to_fhir.DEFAULT_PARSER = encoder, parser
+    try:
+        yield
+    finally:
+        fhir_to_hl7.DEFAULT_ENCODER, hl7_to_fhir.DEFAULT_PARSER = defaults
+
+
+def check_patch(patient: dict, encoders: list) -> int:
+    """
+    Returns number of encoder and parser pairings whose PATCH interaction
+    sends another message than the one of the patched patient
+    """
+    patient = deepcopy(patient)
+    patient["communication"] = [dict(language=dict(text="en"))]
+    patient["maritalStatus"] = dict(text="M")
+    path_parameters = dict(resource_type="Patient", id=patient["id"])
+    hl7msg = FhirResourceWriter(
+        deepcopy(patient), path_parameters, encoder="er7"
+    ).write(False)[0]
+    operation = dict(op="replace", path="/gender", value="other")
+    expected = _parse(hl7msg, "er7")
+    expected["id"] = patient["id"]
+    expected["gender"] = "other"
+    for element in CARRIED_ELEMENTS:
+        expected[element] = patient[element]
+    expected_message = er7_message_builder.create_adt_message(expected)
+
+    store = StubStore()
+    sqs = CapturingSqs()
+    transform.get_message_store = lambda name=None: store
+    transform.get_client = lambda service_name: sqs
+    differences = 0
+    for encoder, parser in [(e, p) for e in encoders for p in PARSERS]:
+        store.put(f"Patient/{patient['id']}", hl7msg.encode("utf-8"))
+        with _defaults(encoder, parser):
+            response = transform.handler(
+                dict(
+                    httpMethod="PATCH",
+                    pathParameters=path_parameters,
+                    body=json.dumps([operation]),
+                ),
+                None,
+            )
+        if response["statusCode"] != 200 or _segments(sqs.body) != _segments(
+            expected_message
+        ):
+            differences += 1
+    return differences
+
+
+def check_canonical(patient: dict, encoders: list, parsers: list) -> int:
+    """
+    Returns number of encoder and parser pairings for which the canonical
+    form of the patient differs from the patient read back from its message
+    """
+    path_parameters = dict(resource_type="Patient", id=patient["id"])
+    differences = 0
+    for encoder, parser in [(e, p) for e in encoders for p in parsers]:
+        resources = list()
+        for response_mode in ["mapping", "message"]:
+            with _defaults(encoder, parser):
+                writer = FhirResourceWriter(
+                    deepcopy(patient), path_parameters, response_mode=response_mode
+                )
+                try:
+                    resources.append(writer.write()[1])
+                except Exception as exc:
+                    # Both modes must accept the same resources
+                    resources.append(repr(exc))
+        differences += resources[0] != resources[1]
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HL7v2 backend equivalence check")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    encoders = {name: import_module(module) for name, module in ENCODERS.items()}
+    differences = dict(encode=0, decode=0, project=0, update=0, patch=0, canonical=0)
+    for index, patient in enumerate(EMPTY_ELEMENT_PATIENTS):
+        patient = dict(patient, resourceType="Patient", id=f"e{index}")
+        differences["canonical"] += check_canonical(
+            patient, list(ENCODERS), list(PARSERS)
+        )
+    for index, patient in enumerate(generate_patients(args.patients, seed=args.seed)):
+        patient["id"] = f"p{index}"
+        if index % 2:
+            _add_delimiters(patient)
+            hl7msg = er7_message_builder.create_adt_message(deepcopy(patient))
+        else:
+            messages = {
+                name: encoder.create_adt_message(deepcopy(patient))
+                for name, encoder in encoders.items()
+            }
+            hl7msg = messages["er7"]
+            differences["encode"] += not check_encode(messages)
+            differences["decode"] += not check_decode(hl7msg)
+            differences["patch"] += check_patch(patient, list(ENCODERS))
+            differences["canonical"] += check_canonical(
+                patient, list(ENCODERS), list(PARSERS)
+            )
+        differences["project"] += check_project(hl7msg)
+        differences["update"] += not check_update(rng, patient, hl7msg)
+        if index % 2:
+            # hl7apy does not encode values with subcomponent separators
+            differences["patch"] += check_patch(patient, ["er7"])
+            # Canonical values are unescaped like the er7 parser does
+            differences["canonical"] += check_canonical(patient, ["er7"], ["er7"])
+
+    print(f"{'check':<10}{'differences':>12}")
+    for name, count in differences.items():
+        print(f"{name:<10}{count:>12}")
+    if any(differences.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Microbenchmarks of the transform Lambda function: HL7v2 encoders and
+# parsers, FhirResourceWriter, FhirResourceReader and the handler end to end.
+# AWS services are replaced with in-memory stubs. Inputs are synthetic
+# patients generated by benchmarks/patients.py.
+#
+# Every case reports operations per second, latency percentiles and peak
+# memory allocated by one operation (measured in separate runs under
+# tracemalloc). Results can be saved with --save and compared with a saved
+# baseline with --compare, which exits with status 1 on regressions.
+#
+# Usage: python benchmarks/micro.py [--iterations 1000] [--filter parse]
+#            [--contacts 10] [--save results.json] [--compare baseline.json]
+import argparse
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+from importlib import import_module
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BENCHMARKS_DIR, "..", "lambda")
+
+os.environ.setdefault("SQS_QUEUE", "benchmark")
+os.environ.setdefault("S3_BUCKET_NAME", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, LAMBDA_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import transform  # noqa: E402
+from lib import fhir_resource_reader  # noqa: E402
+from lib.fhir_resource_reader import FhirResourceReader  # noqa: E402
+from lib.fhir_resource_writer import FhirResourceWriter  # noqa: E402
+from lib.fhir_to_hl7 import DEFAULT_ENCODER, ENCODERS  # noqa: E402
+from lib.hl7_to_fhir import DEFAULT_PARSER, PARSERS  # noqa: E402
+from patients import generate_patients  # noqa: E402
+
+
+class StubSqs(object):
+    def send_message(self, **kwargs):
+        pass
+
+    def send_message_batch(self, QueueUrl, Entries):
+        return dict(Successful=[dict(Id=entry["Id"]) for entry in Entries])
+
+
+class StubStore(object):
+    """
+    In-memory message store
+    """
+
+    location = "memory://benchmark"
+
+    def __init__(self):
+        self._messages = dict()
+
+    def get(self, key, if_none_match=None):
+        body, etag = self._messages[key]
+        if etag == if_none_match:
+            return (None, etag)
+        return (body, etag)
+
+    def put(self, key, body):
+        etag = f'"{len(self._messages)}"'
+        self._messages[key] = (body, etag)
+        return etag
+
+
+def create_cases(patients: list) -> dict:
+    """
+    Returns benchmark cases as functions that run one operation on the
+    input with the given index
+    """
+    messages = [
+        FhirResourceWriter(deepcopy(patient), dict(id=f"p{index}")).write(False)[0]
+        for index, patient in enumerate(patients)
+    ]
+    store = StubStore()
+    for index, message in enumerate(messages):
+        store.put(f"Patient/p{index}", message.encode("utf-8"))
+    transform.get_client = lambda service_name: StubSqs()
+    transform.get_message_store = lambda name=None: store
+    post_events = [
+        dict(
+            httpMethod="POST",
+            pathParameters=dict(resource_type="Patient"),
+            body=json.dumps(patient),
+        )
+        for patient in patients
+    ]
+    get_events = [
+        dict(httpMethod="GET", pathParameters=dict(resource_type="Patient", id=f"p{i}"))
+        for i in range(len(patients))
+    ]
+
+    def read(index, cached=False):
+        if not cached:
+            fhir_resource_reader.resource_cache.clear()
+        path_parameters = dict(resource_type="Patient", id=f"p{index}")
+        return FhirResourceReader(store, path_parameters).read()
+
+    def get(index):
+        fhir_resource_reader.resource_cache.clear()
+        return transform.handler(get_events[index], None)
+
+    cases = dict()
+    for name, module in ENCODERS.items():
+        encoder = import_module(module)
+        cases[f"create_adt_message[{name}]"] = lambda i, encoder=encoder: (
+            encoder.create_adt_message(deepcopy(patients[i]))
+        )
+    for name, module in PARSERS.items():
+        parser = import_module(module)
+        cases[f"parse_adt_message[{name}]"] = lambda i, parser=parser: (
+            parser.parse_adt_message(messages[i], dict(resourceType="Patient"))
+        )
+    for mode in ["message", "mapping"]:
+        cases[f"FhirResourceWriter.write[{mode}]"] = lambda i, mode=mode: (
+            FhirResourceWriter(deepcopy(patients[i]), response_mode=mode).write()
+        )
+    cases["FhirResourceWriter.write[minimal]"] = lambda i: (
+        FhirResourceWriter(deepcopy(patients[i])).write(False)
+    )
+    cases["FhirResourceReader.read"] = read
+    cases["FhirResourceReader.read[cached]"] = lambda i: read(i, cached=True)
+    cases["handler[POST]"] = lambda i: transform.handler(post_events[i], None)
+    cases["handler[GET]"] = get
+    return cases
+
+
+def measure(operation, inputs: int, iterations: int, warmup: int) -> dict:
+    # Every input is used at least once before measurement, e.g. to fill caches
+    for i in range(max(warmup, inputs)):
+        operation(i % inputs)
+
+    latencies = []
+    gc.collect()
+    for i in range(iterations):
+        start = time.perf_counter_ns()
+        operation(i % inputs)
+        latencies.append(time.perf_counter_ns() - start)
+
+    # Peak memory is measured separately, tracemalloc slows allocations down
+    # Tracing starts again for every sample, so only allocations of the
+    # operation are traced (reset_peak is not available before Python 3.9)
+    peaks = []
+    for i in range(min(iterations, 20)):
+        tracemalloc.start()
+        operation(i % inputs)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return dict(
+        ops_per_sec=len(latencies) * 1e9 / sum(latencies),
+        p50_us=percentiles[49] / 1000,
+        p90_us=percentiles[89] / 1000,
+        p99_us=percentiles[98] / 1000,
+        max_us=max(latencies) / 1000,
+        peak_kib=max(peaks) / 1024,
+    )
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns names of cases that are slower than the baseline by more than
+    threshold (fraction of baseline throughput)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1
+        result["change"] = change
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results: dict, regressions: list) -> None:
+    print(
+        f"{'case':<36}{'ops/sec':>12}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}"
+        f"{'max us':>10}{'peak KiB':>10}{'change':>9}"
+    )
+    for name, result in results.items():
+        change = f"{result['change']:+.1%}" if "change" in result else ""
+        flag = "  REGRESSION" if name in regressions else ""
+        print(
+            f"{name:<36}{result['ops_per_sec']:>12.1f}{result['p50_us']:>10.1f}"
+            f"{result['p90_us']:>10.1f}{result['p99_us']:>10.1f}"
+            f"{result['max_us']:>10.1f}{result['peak_kib']:>10.1f}{change:>9}{flag}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transform Lambda microbenchmarks")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--patients", type=int, default=50, help="distinct inputs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--identifiers", type=int, default=2)
+    parser.add_argument("--names", type=int, default=3)
+    parser.add_argument("--addresses", type=int, default=2)
+    parser.add_argument("--telecoms", type=int, default=3)
+    parser.add_argument("--contacts", type=int, default=2)
+    parser.add_argument("--filter", default="", help="run cases containing text")
+    parser.add_argument("--save", help="save results to JSON file")
+    parser.add_argument("--compare", help="compare with results saved in JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="throughput drop reported as regression (default 0.1)",
+    )
+    args = parser.parse_args()
+
+    patients = generate_patients(
+        args.patients,
+        seed=args.seed,
+        identifiers=args.identifiers,
+        names=args.names,
+        addresses=args.addresses,
+        telecoms=args.telecoms,
+        contacts=args.contacts,
+    )
+    cases = create_cases(patients)
+
+    print(
+        f"encoder={DEFAULT_ENCODER} parser={DEFAULT_PARSER} "
+        f"iterations={args.iterations} patients={args.patients} "
+        f"identifiers={args.identifiers} names={args.names} "
+        f"addresses={args.addresses} telecoms={args.telecoms} "
+        f"contacts={args.contacts}"
+    )
+    results = dict()
+    for name, operation in cases.items():
+        if args.filter in name:
+            results[name] = measure(
+                operation, args.patients, args.iterations, args.warmup
+            )
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+    print_results(results, regressions)
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
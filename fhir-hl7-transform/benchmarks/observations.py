@@ -0,0 +1,63 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Synthetic FHIR Observation resources for benchmarks: results with a given
+# number of components, such as lab panels and device feeds, which map to
+# ORU^R01 messages with one OBX segment per component. Values are mostly
+# quantities, with some strings and coded values, varied by a seeded random
+# generator.
+import random
+
+_UNITS = [
+    ("mm[Hg]", "mmHg"),
+    ("mg/dL", "mg/dL"),
+    ("/min", "beats/minute"),
+    ("%", "%"),
+    ("Cel", "degrees C"),
+]
+
+_INTERPRETATIONS = [("N", "Normal"), ("H", "High"), ("L", "Low"), ("A", "Abnormal")]
+
+
+def _coding(code: str) -> dict:
+    return dict(coding=[dict(system="http://loinc.org", code=code)])
+
+
+def generate_component(rng: random.Random, index: int) -> dict:
+    component = dict(code=_coding(f"{rng.randint(1000, 99999)}-{index % 10}"))
+    kind = rng.random()
+    if kind < 0.8:
+        code, unit = rng.choice(_UNITS)
+        component["valueQuantity"] = dict(
+            value=round(rng.uniform(0, 200), rng.randint(0, 2)),
+            unit=unit,
+            system="http://unitsofmeasure.org",
+            code=code,
+        )
+    elif kind < 0.9:
+        component["valueString"] = f"Result note {rng.randint(1, 9999)}"
+    else:
+        code, display = rng.choice(_INTERPRETATIONS)
+        component["valueCodeableConcept"] = dict(
+            coding=[dict(code=code, display=display)]
+        )
+    return component
+
+
+def generate_observation(rng: random.Random, components: int = 1000) -> dict:
+    return dict(
+        resourceType="Observation",
+        status="final",
+        subject=dict(reference=f"Patient/p{rng.randint(1, 99999)}"),
+        code=_coding("11502-2"),
+        effectiveDateTime=f"2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        component=[generate_component(rng, index) for index in range(components)],
+    )
+
+
+def generate_observations(count: int, seed: int = 0, components: int = 1000) -> list:
+    """
+    Returns count observations with the given number of components
+    """
+    rng = random.Random(seed)
+    return [generate_observation(rng, components) for _ in range(count)]
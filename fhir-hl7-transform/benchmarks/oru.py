@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Benchmark of Observation <-> ORU^R01 conversion by result size. Every HL7v2
+# encoder and parser backend converts observations with a growing number of
+# components (OBX segments); time and peak memory per OBX segment should stay
+# flat as results grow. Inputs are synthetic observations generated by
+# benchmarks/observations.py. The number of iterations of a case is chosen so
+# that it converts about --obx-per-case OBX segments.
+#
+# Usage: python benchmarks/oru.py [--sizes 10,100,1000,5000] [--filter er7]
+#            [--save results.json] [--compare baseline.json]
+import argparse
+import json
+import sys
+from copy import deepcopy
+from importlib import import_module
+
+# micro adds the Lambda function directory to the import path
+from micro import compare, measure
+from observations import generate_observations
+
+from lib.fhir_resource_writer import FhirResourceWriter
+from lib.fhir_to_hl7 import ENCODERS
+from lib.hl7_to_fhir import PARSERS
+
+
+def create_cases(size: int, observations: list) -> dict:
+    """
+    Returns benchmark cases for observations with size components
+    """
+    messages = [
+        FhirResourceWriter(
+            deepcopy(observation), dict(id=f"o{index}"), encoder="er7"
+        ).write(False)[0]
+        for index, observation in enumerate(observations)
+    ]
+
+    cases = dict()
+    for name, module in ENCODERS.items():
+        encoder = import_module(module)
+        cases[f"create_oru_message[{name}]/{size}"] = lambda i, encoder=encoder: (
+            encoder.create_oru_message(dict(observations[i], id=f"o{i}"))
+        )
+    for name, module in PARSERS.items():
+        parser = import_module(module)
+        cases[f"parse_oru_message[{name}]/{size}"] = lambda i, parser=parser: (
+            parser.parse_oru_message(messages[i], dict(resourceType="Observation"))
+        )
+    return cases
+
+
+def print_results(results: dict, regressions: list) -> None:
+    print(
+        f"{'case':<36}{'ops/sec':>10}{'p50 ms':>10}{'p99 ms':>10}"
+        f"{'us/OBX':>10}{'peak KiB':>11}{'B/OBX':>8}{'change':>9}"
+    )
+    for name, result in results.items():
+        size = result["size"]
+        change = f"{result['change']:+.1%}" if "change" in result else ""
+        flag = "  REGRESSION" if name in regressions else ""
+        print(
+            f"{name:<36}{result['ops_per_sec']:>10.1f}"
+            f"{result['p50_us'] / 1000:>10.2f}{result['p99_us'] / 1000:>10.2f}"
+            f"{result['p50_us'] / size:>10.2f}{result['peak_kib']:>11.1f}"
+            f"{result['peak_kib'] * 1024 / size:>8.0f}{change:>9}{flag}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ORU^R01 conversion benchmark")
+    parser.add_argument(
+        "--sizes",
+        default="10,100,1000,5000",
+        help="comma separated numbers of OBX segments",
+    )
+    parser.add_argument("--obx-per-case", type=int, default=20000)
+    parser.add_argument("--observations", type=int, default=2, help="distinct inputs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--filter", default="", help="run cases containing text")
+    parser.add_argument("--save", help="save results to JSON file")
+    parser.add_argument("--compare", help="compare with results saved in JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="throughput drop reported as regression (default 0.1)",
+    )
+    args = parser.parse_args()
+
+    results = dict()
+    for size in [int(size) for size in args.sizes.split(",")]:
+        observations = generate_observations(
+            args.observations, seed=args.seed, components=size
+        )
+        iterations = max(args.obx_per_case // size, 5)
+        for name, operation in create_cases(size, observations).items():
+            if args.filter in name:
+                results[name] = measure(
+                    operation, args.observations, iterations, warmup=1
+                )
+                results[name]["size"] = size
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+    print_results(results, regressions)
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
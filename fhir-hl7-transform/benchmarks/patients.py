@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Synthetic FHIR Patient resources for benchmarks. Elements are copied from
+# resources/patient.json, cycling through its entries, with values varied by
+# a seeded random generator so that every generated patient is different.
+import json
+import os
+import random
+from copy import deepcopy
+
+TEMPLATE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources", "patient.json"
+)
+
+with open(TEMPLATE_FILE) as template_file:
+    TEMPLATE = json.load(template_file)
+
+
+def _first(value):
+    # Contact name and address are single elements in FHIR R4
+    return value[0] if isinstance(value, list) else value
+
+
+def _vary(rng: random.Random, value: str) -> str:
+    return f"{value} {rng.randint(1, 9999)}"
+
+
+def _cycle(template: list, count: int) -> list:
+    return [deepcopy(template[i % len(template)]) for i in range(count)]
+
+
+def generate_patient(
+    rng: random.Random,
+    identifiers: int = 2,
+    names: int = 3,
+    addresses: int = 2,
+    telecoms: int = 3,
+    contacts: int = 2,
+) -> dict:
+    patient = dict(resourceType="Patient")
+
+    patient["identifier"] = _cycle(TEMPLATE["identifier"], identifiers)
+    for identifier in patient["identifier"]:
+        identifier["value"] = str(rng.randint(10000, 99999999))
+
+    patient["name"] = _cycle(TEMPLATE["name"], names)
+    for name in patient["name"]:
+        name["given"] = [_vary(rng, given) for given in name.get("given", [])]
+        if "family" in name:
+            name["family"] = _vary(rng, name["family"])
+
+    patient["birthDate"] = (
+        f"{rng.randint(1920, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    )
+    patient["gender"] = rng.choice(["male", "female", "other", "unknown"])
+
+    patient["address"] = _cycle(TEMPLATE["address"], addresses)
+    for address in patient["address"]:
+        address["line"] = [_vary(rng, line) for line in address.get("line", [])]
+        address["postalCode"] = str(rng.randint(1000, 9999))
+
+    patient["telecom"] = _cycle(TEMPLATE["telecom"], telecoms)
+    for telecom in patient["telecom"]:
+        telecom["value"] = f"(0{rng.randint(2, 9)}) 5555 {rng.randint(0, 9999):04d}"
+
+    patient["contact"] = _cycle(TEMPLATE["contact"], contacts)
+    for contact in patient["contact"]:
+        contact["name"] = _first(contact["name"])
+        contact["name"]["family"] = _vary(rng, contact["name"]["family"])
+        if "address" in contact:
+            contact["address"] = _first(contact["address"])
+
+    return patient
+
+
+def generate_patients(count: int, seed: int = 0, **sizes) -> list:
+    """
+    Returns count patients, sizes are numbers of identifiers, names,
+    addresses, telecoms and contacts of every patient
+    """
+    rng = random.Random(seed)
+    return [generate_patient(rng, **sizes) for _ in range(count)]
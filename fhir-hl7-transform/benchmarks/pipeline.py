@@ -0,0 +1,504 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Offline end-to-end load harness. Runs the whole write path on one machine
+# without AWS:
+#
+#   open-loop POST requests --> transform.handler (worker processes)
+#     --> in-process SQS queue --> hl7_sender pipeline --> MLLP over loopback
+#     --> hl7_listener (subprocess) --> SQLite message store on local disk
+#
+# Worker processes stand in for concurrent Lambda instances. Requests are
+# sent at a fixed (or Poisson) rate that does not depend on completed
+# requests, for every rate given with --rates. The listener acknowledges a
+# message after it was stored, so end-to-end latency is measured from the
+# start of a POST request to the ACK of its message.
+#
+# Every step reports achieved throughput, end-to-end and handler latency
+# percentiles and queue depths of the stages. A step is saturated when the
+# pipeline cannot keep up with the offered rate or does not drain in time;
+# the sweep stops at the first saturated step.
+#
+# Usage: python benchmarks/pipeline.py [--rates 10,20,40] [--duration 20]
+#            [--workers 4] [--mllp-connections 2] [--mllp-connections-max 8]
+#            [--control-interval 1]
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BENCHMARKS_DIR, "..", "lambda")
+SENDER_DIR = os.path.join(BENCHMARKS_DIR, "..", "container", "application")
+LISTENER_DIR = os.path.join(
+    BENCHMARKS_DIR, "..", "..", "test-hl7-server", "container", "application"
+)
+
+# transform module of a worker process
+_transform = None
+
+
+class CapturingSqs(object):
+    """
+    SQS client of worker processes that keeps sent messages, which are passed
+    to the queue by the harness process
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None):
+        self.messages.append((MessageBody, MessageAttributes or {}))
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend(
+            (entry["MessageBody"], entry.get("MessageAttributes") or {})
+            for entry in Entries
+        )
+        return dict(Successful=[dict(Id=entry["Id"]) for entry in Entries])
+
+
+def _init_worker():
+    global _transform
+    os.environ.setdefault("SQS_QUEUE", "harness")
+    os.environ.setdefault("S3_BUCKET_NAME", "harness")
+    sys.path.insert(0, LAMBDA_DIR)
+    import transform
+
+    _transform = transform
+
+
+def invoke(event: dict) -> tuple:
+    sqs = CapturingSqs()
+    _transform.get_client = lambda service_name: sqs
+    response = _transform.handler(event, None)
+    return (response["statusCode"], sqs.messages)
+
+
+class LocalQueue(object):
+    """
+    In-process stand-in of an SQS standard queue, implementing the part of
+    the SQS client used by hl7_sender
+    """
+
+    def __init__(self, visibility_timeout: int) -> None:
+        self._visibility_timeout = visibility_timeout
+        self._condition = threading.Condition()
+        self._visible = deque()
+        self._in_flight = dict()
+        self._ids = itertools.count()
+        self._closed = False
+
+    def send(self, body: str, attributes: dict) -> None:
+        with self._condition:
+            self._visible.append(
+                dict(
+                    MessageId=str(next(self._ids)),
+                    Body=body,
+                    MessageAttributes=attributes,
+                )
+            )
+            self._condition.notify()
+
+    def depth(self) -> tuple:
+        """
+        Returns numbers of visible and in-flight messages
+        """
+        with self._condition:
+            return (len(self._visible), len(self._in_flight))
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _return_expired(self) -> None:
+        now = time.monotonic()
+        for receipt_handle, (message, deadline) in list(self._in_flight.items()):
+            if deadline <= now:
+                del self._in_flight[receipt_handle]
+                self._visible.append(message)
+
+    def get_queue_url(self, QueueName):
+        return dict(QueueUrl=QueueName)
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        with self._condition:
+            self._return_expired()
+            visible = len(self._visible)
+        return dict(
+            Attributes=dict(
+                VisibilityTimeout=str(self._visibility_timeout),
+                ApproximateNumberOfMessages=str(visible),
+            )
+        )
+
+    def receive_message(
+        self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs
+    ):
+        wait_until = time.monotonic() + WaitTimeSeconds
+        messages = []
+        with self._condition:
+            while not self._closed:
+                self._return_expired()
+                remaining = wait_until - time.monotonic()
+                if self._visible or remaining <= 0:
+                    break
+                # Wakes up to return messages with expired visibility
+                self._condition.wait(min(remaining, 0.1))
+            deadline = time.monotonic() + self._visibility_timeout
+            while self._visible and len(messages) < MaxNumberOfMessages:
+                message = self._visible.popleft()
+                receipt_handle = f"{message['MessageId']}-{next(self._ids)}"
+                self._in_flight[receipt_handle] = (message, deadline)
+                messages.append(dict(message, ReceiptHandle=receipt_handle))
+        return dict(Messages=messages)
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self._condition:
+            for entry in Entries:
+                if self._in_flight.pop(entry["ReceiptHandle"], None) is not None:
+                    successful.append(dict(Id=entry["Id"]))
+                else:
+                    failed.append(
+                        dict(Id=entry["Id"], Message="Receipt handle has expired")
+                    )
+        return dict(Successful=successful, Failed=failed)
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self._condition:
+            for entry in Entries:
+                in_flight = self._in_flight.get(entry["ReceiptHandle"])
+                if in_flight is not None:
+                    deadline = time.monotonic() + entry["VisibilityTimeout"]
+                    self._in_flight[entry["ReceiptHandle"]] = (in_flight[0], deadline)
+                    successful.append(dict(Id=entry["Id"]))
+                else:
+                    failed.append(
+                        dict(Id=entry["Id"], Message="Receipt handle has expired")
+                    )
+        return dict(Successful=successful, Failed=failed)
+
+
+class Step(object):
+    """
+    Measurements of one offered request rate
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.pending = 0
+        self.handler_latencies = []
+        self.e2e_latencies = []
+        self.started_at = None
+        self.last_ack_at = None
+        self.depths = dict(
+            api=[], sqs_visible=[], send_queue=[], sending=[], delete_queue=[]
+        )
+
+    def summary(self, drained: bool) -> dict:
+        elapsed = (self.last_ack_at or time.perf_counter()) - self.started_at
+        throughput = len(self.e2e_latencies) / elapsed if elapsed > 0 else 0
+        return dict(
+            offered_rate=self.rate,
+            throughput=throughput,
+            submitted=self.submitted,
+            errors=self.errors,
+            acknowledged=len(self.e2e_latencies),
+            drained=drained,
+            saturated=not drained or throughput < 0.95 * self.rate,
+            e2e_ms=percentiles(self.e2e_latencies),
+            handler_ms=percentiles(self.handler_latencies),
+            max_depth={
+                name: max(values, default=0) for name, values in self.depths.items()
+            },
+        )
+
+
+def percentiles(latencies: list) -> dict:
+    if len(latencies) < 2:
+        return dict(p50=None, p90=None, p99=None)
+    values = statistics.quantiles(latencies, n=100, method="inclusive")
+    return dict(p50=values[49] * 1000, p90=values[89] * 1000, p99=values[98] * 1000)
+
+
+def wait_for_port(port: int, timeout: float) -> None:
+    wait_until = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > wait_until:
+                raise
+            time.sleep(0.1)
+
+
+class Harness(object):
+    def __init__(self, args, sender, queue: LocalQueue, pool) -> None:
+        self._args = args
+        self._sender = sender
+        self._queue = queue
+        self._pool = pool
+        # Start of the POST request of every message in flight
+        self._started = dict()
+        self._step = None
+        self._send_queue = asyncio.Queue(maxsize=sender.queue_size)
+        self._delete_queue = asyncio.Queue(maxsize=sender.queue_size)
+
+        from patients import generate_patients
+
+        self._events = [
+            dict(
+                httpMethod="POST",
+                pathParameters=dict(resource_type="Patient"),
+                body=json.dumps(patient),
+            )
+            for patient in generate_patients(100, seed=args.seed)
+        ]
+
+        # Messages are acknowledged when process_message returns
+        process_message = sender.process_message
+
+        async def timed_process_message(reader, writer, message):
+            await process_message(reader, writer, message)
+            self._acknowledged(message["Body"])
+
+        sender.process_message = timed_process_message
+
+    def _acknowledged(self, body: str) -> None:
+        entry = self._started.pop(body, None)
+        if entry is None:
+            # Redelivered message that was acknowledged before
+            return
+        step, started_at = entry
+        now = time.perf_counter()
+        step.e2e_latencies.append(now - started_at)
+        step.last_ack_at = now
+
+    def _handled(self, step: Step, started_at: float, future) -> None:
+        step.pending -= 1
+        step.handler_latencies.append(time.perf_counter() - started_at)
+        try:
+            status_code, messages = future.result()
+        except Exception:
+            status_code, messages = 500, []
+        if status_code != 201:
+            step.errors += 1
+        step.completed += 1
+        for body, attributes in messages:
+            self._started[body] = (step, started_at)
+            self._queue.send(body, attributes)
+
+    async def _sample_depths(self, step: Step) -> None:
+        while True:
+            visible, in_flight = self._queue.depth()
+            send_queue = self._send_queue.qsize()
+            delete_queue = self._delete_queue.qsize()
+            step.depths["api"].append(step.pending)
+            step.depths["sqs_visible"].append(visible)
+            step.depths["send_queue"].append(send_queue)
+            step.depths["sending"].append(max(in_flight - send_queue - delete_queue, 0))
+            step.depths["delete_queue"].append(delete_queue)
+            await asyncio.sleep(self._args.sample_interval)
+
+    async def run_step(self, rate: float) -> dict:
+        loop = asyncio.get_running_loop()
+        rng = random.Random(self._args.seed)
+        step = Step(rate)
+        sampler = asyncio.create_task(self._sample_depths(step))
+        step.started_at = time.perf_counter()
+        next_at = step.started_at
+        end_at = step.started_at + self._args.duration
+        events = itertools.cycle(self._events)
+        while next_at < end_at:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Open loop: requests are sent without waiting for responses
+            started_at = time.perf_counter()
+            future = loop.run_in_executor(self._pool, invoke, next(events))
+            future.add_done_callback(
+                lambda future, started_at=started_at: self._handled(
+                    step, started_at, future
+                )
+            )
+            step.submitted += 1
+            step.pending += 1
+            if self._args.poisson:
+                next_at += rng.expovariate(rate)
+            else:
+                next_at += 1 / rate
+
+        # Waits until all messages of the step were acknowledged
+        drain_until = time.perf_counter() + self._args.drain_timeout
+        drained = False
+        while time.perf_counter() < drain_until:
+            if step.pending == 0 and not any(
+                entry[0] is step for entry in self._started.values()
+            ):
+                drained = True
+                break
+            await asyncio.sleep(0.05)
+        sampler.cancel()
+        return step.summary(drained)
+
+    async def run(self) -> list:
+        pipeline = asyncio.create_task(
+            self._sender.run_pipeline(self._send_queue, self._delete_queue)
+        )
+        results = []
+        try:
+            for rate in self._args.rates:
+                result = await self.run_step(rate)
+                results.append(result)
+                print_step(result)
+                if result["saturated"] or pipeline.done():
+                    break
+        finally:
+            pipeline.cancel()
+            self._queue.close()
+            await asyncio.gather(pipeline, return_exceptions=True)
+        return results
+
+
+def print_step(result: dict) -> None:
+    def ms(value):
+        return f"{value:8.1f}" if value is not None else f"{'-':>8}"
+
+    e2e, handler = result["e2e_ms"], result["handler_ms"]
+    depths = " ".join(f"{name}={value}" for name, value in result["max_depth"].items())
+    print(
+        f"rate {result['offered_rate']:7.1f}/s  throughput {result['throughput']:7.1f}/s"
+        f"  acked {result['acknowledged']:6d}/{result['submitted']:<6d}"
+        f" errors {result['errors']:4d}  e2e ms p50 {ms(e2e['p50'])} p90 "
+        f"{ms(e2e['p90'])} p99 {ms(e2e['p99'])}  handler ms p50 "
+        f"{ms(handler['p50'])} p99 {ms(handler['p99'])}"
+        f"{'  SATURATED' if result['saturated'] else ''}",
+        flush=True,
+    )
+    print(f"{'':>10}max depth: {depths}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end load harness")
+    parser.add_argument(
+        "--rates",
+        default="5,10,20,40,80",
+        type=lambda value: [float(rate) for rate in value.split(",")],
+        help="comma separated request rates per second",
+    )
+    parser.add_argument("--duration", type=float, default=20, help="seconds per rate")
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--mllp-connections", type=int, default=1)
+    parser.add_argument(
+        "--mllp-connections-max", type=int, help="adaptive senders up to this number"
+    )
+    parser.add_argument("--sqs-pollers-max", type=int, help="adaptive pollers")
+    parser.add_argument("--control-interval", type=float, default=1)
+    parser.add_argument("--port", type=int, default=12575)
+    parser.add_argument("--store-path", help="SQLite file (default temporary)")
+    parser.add_argument("--sample-interval", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="save results to JSON file")
+    args = parser.parse_args()
+
+    store_dir = tempfile.TemporaryDirectory()
+    store_path = args.store_path or os.path.join(store_dir.name, "messages.db")
+
+    listener = subprocess.Popen(
+        [sys.executable, "hl7_listener.py"],
+        cwd=LISTENER_DIR,
+        env=dict(
+            os.environ,
+            MESSAGE_STORE="sqlite",
+            MESSAGE_STORE_PATH=store_path,
+            PORT_NUMBER=str(args.port),
+        ),
+        stdout=subprocess.DEVNULL,
+    )
+    pool = ProcessPoolExecutor(
+        args.workers, mp_context=get_context("spawn"), initializer=_init_worker
+    )
+    try:
+        wait_for_port(args.port, 30)
+        # Starts workers before measurement, like initialized Lambda instances
+        list(pool.map(time.sleep, [0.1] * args.workers))
+
+        queue = LocalQueue(visibility_timeout=30)
+        os.environ.update(
+            QUEUE_NAME="harness",
+            SERVER_NAME="127.0.0.1",
+            PORT_NUMBER=str(args.port),
+            MLLP_CONNECTIONS=str(args.mllp_connections),
+            MLLP_CONNECTIONS_MAX=str(
+                args.mllp_connections_max or args.mllp_connections
+            ),
+            SQS_POLLERS_MAX=str(args.sqs_pollers_max or 1),
+            CONTROL_INTERVAL_SECONDS=str(args.control_interval),
+        )
+        sys.path.insert(0, SENDER_DIR)
+        sys.path.insert(0, BENCHMARKS_DIR)
+        import aws_clients
+
+        aws_clients.get_client = lambda service_name: queue
+        import hl7_sender
+
+        # Per-message output of the sender is not shown
+        hl7_sender.print = lambda *args, **kwargs: None
+        print(
+            f"workers={args.workers} mllp_connections={args.mllp_connections}"
+            f"-{args.mllp_connections_max or args.mllp_connections} "
+            f"duration={args.duration}s store={store_path}",
+            flush=True,
+        )
+        results = asyncio.run(Harness(args, hl7_sender, queue, pool).run())
+    finally:
+        pool.shutdown(cancel_futures=True)
+        listener.terminate()
+        listener.wait()
+
+    with sqlite3.connect(store_path) as connection:
+        stored = connection.execute("SELECT count(*) FROM messages").fetchone()[0]
+    print(f"stored messages: {stored}")
+    saturated = [result for result in results if result["saturated"]]
+    if saturated:
+        unsaturated = [r["offered_rate"] for r in results if not r["saturated"]]
+        if unsaturated:
+            print(
+                f"saturation point: between {max(unsaturated)}/s and "
+                f"{saturated[0]['offered_rate']}/s"
+            )
+        else:
+            print(f"saturation point: below {saturated[0]['offered_rate']}/s")
+    else:
+        print("saturation point: not reached")
+    store_dir.cleanup()
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Cold start benchmark for the transform Lambda function. Every run starts a
+# fresh Python interpreter that imports the function module and handles one
+# POST request with a stubbed SQS client, reporting import time and time to
+# first conversion.
+#
+# Usage: python benchmarks/startup.py [--runs 10] [--encoder er7] [--warm-up]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+
+_RUN = """
+import json
+import time
+
+t0 = time.perf_counter()
+import transform
+t1 = time.perf_counter()
+
+from lib.hl7_reference_cache import SAMPLE_PATIENT
+
+
+class _Sqs:
+    def send_message(self, **kwargs):
+        pass
+
+
+transform.get_client = lambda service_name: _Sqs()
+response = transform.handler(
+    {
+        "httpMethod": "POST",
+        "pathParameters": {"resource_type": "Patient"},
+        "body": json.dumps(SAMPLE_PATIENT),
+    },
+    None,
+)
+t2 = time.perf_counter()
+assert response["statusCode"] == 201, response
+print(json.dumps({"import": t1 - t0, "first_conversion": t2 - t1}))
+"""
+
+
+def run_once(env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", _RUN],
+        cwd=LAMBDA_DIR,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transform Lambda cold start benchmark"
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--encoder", default="hl7apy", choices=["hl7apy", "er7"])
+    parser.add_argument("--parser", default="hl7apy", choices=["hl7apy", "er7"])
+    parser.add_argument("--warm-up", action="store_true", help="set HL7_WARM_UP")
+    parser.add_argument(
+        "--build-cache",
+        action="store_true",
+        help="build hl7apy reference cache before running",
+    )
+    args = parser.parse_args()
+
+    if args.build_cache:
+        subprocess.run(
+            [sys.executable, "-m", "lib.hl7_reference_cache"],
+            cwd=LAMBDA_DIR,
+            check=True,
+        )
+
+    env = dict(
+        os.environ,
+        SQS_QUEUE="benchmark",
+        S3_BUCKET_NAME="benchmark",
+        HL7_ENCODER=args.encoder,
+        HL7_PARSER=args.parser,
+        HL7_WARM_UP=str(args.warm_up).lower(),
+    )
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    results = [run_once(env) for _ in range(args.runs)]
+
+    print(
+        f"encoder={args.encoder} parser={args.parser} warm_up={args.warm_up} "
+        f"runs={args.runs}"
+    )
+    for name in ["import", "first_conversion"]:
+        values = [result[name] * 1000 for result in results]
+        print(
+            f"{name:>18}: median {statistics.median(values):8.2f} ms"
+            f"  min {min(values):8.2f} ms  max {max(values):8.2f} ms"
+        )
+    total = [
+        (result["import"] + result["first_conversion"]) * 1000 for result in results
+    ]
+    print(f"{'total':>18}: median {statistics.median(total):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@
 from os import path
 
 from aws_cdk import aws_apigateway as apigw
+from aws_cdk import aws_dynamodb as dynamodb
 from aws_cdk import aws_ec2 as ec2
 from aws_cdk import aws_ecs as ecs
 from aws_cdk import aws_ecs_patterns as ecs_patterns
@@ -55,10 +56,49 @@ class FhirToHl7V2TransformStack(core.Stack):
             "test-server-output-bucket-name"
         )
 
+        # Optional DynamoDB tables of the search index (search interactions)
+        # and of content hashes (PUT interactions with unchanged messages are
+        # not sent again)
+        # From --context search-index="true"
+        # From --context content-hash-store="true"
+        search_index_enabled = (
+            str(self.node.try_get_context("search-index")).lower() == "true"
+        )
+        content_hash_store_enabled = (
+            str(self.node.try_get_context("content-hash-store")).lower() == "true"
+        )
+
+        # Number of deliveries of a message the HL7v2 server rejects (NAK) or
+        # the sender cannot read before it is moved to the dead-letter queue
+        # From --context max-receive-count="5"
+        max_receive_count = int(self.node.try_get_context("max-receive-count") or 5)
+
         # SQS queue
         # Custom transform lambda communicates with Connectivity Manager using this SQS queue
+        dead_letter_queue = sqs.Queue(
+            self,
+            f"{COMPONENT_PREFIX}DeadLetterQueue",
+            encryption=sqs.QueueEncryption.KMS_MANAGED,
+            retention_period=core.Duration.days(14),
+        )
         queue = sqs.Queue(
-            self, f"{COMPONENT_PREFIX}Queue", encryption=sqs.QueueEncryption.KMS_MANAGED
+            self,
+            f"{COMPONENT_PREFIX}Queue",
+            encryption=sqs.QueueEncryption.KMS_MANAGED,
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=max_receive_count, queue=dead_letter_queue
+            ),
+        )
+
+        # S3 Bucket of HL7v2 messages too large for SQS message bodies, only
+        # their location is sent on the queue. Objects are kept for the
+        # longest SQS message retention period
+        payload_bucket = s3.Bucket(
+            self,
+            f"{COMPONENT_PREFIX}PayloadBucket",
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            lifecycle_rules=[s3.LifecycleRule(expiration=core.Duration.days(14))],
         )
 
         # S3 Bucket to retrieve HL7v2 messages in proof of concept deployment
@@ -85,6 +125,11 @@ class FhirToHl7V2TransformStack(core.Stack):
                             [
                                 "pip install --no-cache-dir -r requirements.txt -t /asset-output",
                                 "(tar -c --exclude-from=exclude.lst -f - .)|(cd /asset-output; tar -xf -)",
+                                # Prebuilt hl7apy reference structures and bytecode
+                                # shorten cold starts
+                                "cd /asset-output",
+                                "python -m lib.hl7_reference_cache",
+                                "python -m compileall -q .",
                             ]
                         ),
                     ],
@@ -93,11 +138,47 @@ class FhirToHl7V2TransformStack(core.Stack):
             timeout=core.Duration.seconds(60),
             environment=dict(
                 SQS_QUEUE=queue.queue_url,
+                SQS_OFFLOAD_BUCKET=payload_bucket.bucket_name,
                 # The following parameter is optional
                 S3_BUCKET_NAME=test_server_output_bucket_name,
             ),
         )
         queue.grant_send_messages(transform_lambda)
+        payload_bucket.grant_put(transform_lambda)
+
+        if search_index_enabled:
+            search_index_table = dynamodb.Table(
+                self,
+                f"{COMPONENT_PREFIX}SearchIndex",
+                partition_key=dynamodb.Attribute(
+                    name="term", type=dynamodb.AttributeType.STRING
+                ),
+                sort_key=dynamodb.Attribute(
+                    name="key", type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                encryption=dynamodb.TableEncryption.AWS_MANAGED,
+            )
+            search_index_table.grant_read_write_data(transform_lambda)
+            transform_lambda.add_environment("SEARCH_INDEX", "dynamodb")
+            transform_lambda.add_environment(
+                "SEARCH_INDEX_TABLE", search_index_table.table_name
+            )
+        if content_hash_store_enabled:
+            content_hash_table = dynamodb.Table(
+                self,
+                f"{COMPONENT_PREFIX}ContentHashes",
+                partition_key=dynamodb.Attribute(
+                    name="key", type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                encryption=dynamodb.TableEncryption.AWS_MANAGED,
+            )
+            content_hash_table.grant_read_write_data(transform_lambda)
+            transform_lambda.add_environment("CONTENT_HASH_STORE", "dynamodb")
+            transform_lambda.add_environment(
+                "CONTENT_HASH_TABLE", content_hash_table.table_name
+            )
 
         # API Gateway with Lambda construct (using https://aws.amazon.com/solutions/constructs/patterns)
         # Reference implementation of Custom Transform component of Transform Execution Environment
@@ -131,11 +212,17 @@ class FhirToHl7V2TransformStack(core.Stack):
         )
         rest_api = api_lambda.api_gateway
         persistence = rest_api.root.add_resource("persistence")
+        # Batch and transaction Bundles
+        persistence.add_method("POST")
         resource_type = persistence.add_resource("{resource_type}")
         resource_type.add_method("POST")
+        # Search, only with the search index
+        if search_index_enabled:
+            resource_type.add_method("GET")
         resource_id = resource_type.add_resource("{id}")
         resource_id.add_method("GET")
         resource_id.add_method("PUT")
+        resource_id.add_method("PATCH")
         resource_id.add_method("DELETE")
 
         # ECS Fargate Container (HL7v2 sender)
@@ -146,7 +233,7 @@ class FhirToHl7V2TransformStack(core.Stack):
 
         cluster = ecs.Cluster(self, f"{COMPONENT_PREFIX}Cluster", vpc=vpc)
 
-        ecs_patterns.QueueProcessingFargateService(
+        sender_service = ecs_patterns.QueueProcessingFargateService(
             self,
             f"{COMPONENT_PREFIX}Service",
             cluster=cluster,
@@ -162,6 +249,7 @@ class FhirToHl7V2TransformStack(core.Stack):
                 PORT_NUMBER=hl7_port,
             ),
         )
+        payload_bucket.grant_read(sender_service.task_definition.task_role)
 
         # The following permission grants are needed to support
         # read interactions with integration transform
@@ -20,6 +20,7 @@ setuptools.setup(
     install_requires=[
         "aws-cdk.core==1.69.0",
         "aws-cdk.aws-lambda==1.69.0",
+        "aws-cdk.aws-dynamodb==1.69.0",
         "aws-cdk.aws_ecs==1.69.0",
         "aws-cdk.aws_ecs_patterns==1.69.0",
         "aws_solutions_constructs.aws_apigateway_lambda==1.69.0",
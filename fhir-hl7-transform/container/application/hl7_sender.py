@@ -1,85 +1,594 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
+#
+# HL7v2 sender: forwards HL7v2 messages from SQS queue to HL7v2 server over
+# MLLP. The sender is an asyncio pipeline with three stages connected by
+# bounded queues:
+#
+#   SQS pollers --> send queue --> MLLP senders --> delete queue --> deleters
+#
+# Every MLLP sender owns one connection and waits for the ACK of a message
+# before sending the next one. Messages are deleted from SQS only after they
+# were acknowledged, so delivery is at-least-once: messages that were not
+# acknowledged become visible again after the SQS visibility timeout.
+#
+# Deleters collect acknowledged messages into DeleteMessageBatch requests
+# flushed by size or time. A heartbeat extends visibility timeout of received
+# messages that are close to expiry, so that messages waiting for a slow
+# HL7v2 server are not redelivered and sent twice.
+#
+# Numbers of active pollers and senders are adjusted by a controller within
+# configured bounds (AIMD): they are increased while messages are waiting,
+# doubling until the first back-off, and halved when ACKs take longer than
+# the latency target or sends fail, so that a slow HL7v2 server is not
+# overloaded. Pollers receive at most as many messages as the send queue has
+# room for.
+#
+# Large messages arrive compressed (message attribute ContentEncoding "zlib",
+# base64-encoded body) or stored in S3 (message attribute PayloadLocation
+# "s3://bucket/key"), as encoded by the transform Lambda (lib/sqs_payload.py).
+import asyncio
 import logging
 import os
-from signal import SIGINT, SIGTERM, signal
+import zlib
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from signal import SIGINT, SIGTERM
 
-import boto3
-from hl7.client import MLLPClient
+import hl7
+from hl7.mllp import open_hl7_connection
+
+from aws_clients import get_client
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+port_number = int(os.environ.get("PORT_NUMBER", 2575))
+server_name = os.environ.get("SERVER_NAME", "localhost")
+
+# Pipeline configuration, numbers of pollers and connections are adjusted
+# between the minimum (initial) and maximum
+sqs_pollers = int(os.environ.get("SQS_POLLERS", 1))
+sqs_pollers_max = max(int(os.environ.get("SQS_POLLERS_MAX", sqs_pollers)), sqs_pollers)
+mllp_connections = int(os.environ.get("MLLP_CONNECTIONS", 1))
+mllp_connections_max = max(
+    int(os.environ.get("MLLP_CONNECTIONS_MAX", mllp_connections)), mllp_connections
+)
+sqs_deleters = int(os.environ.get("SQS_DELETERS", 1))
+queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", 20))
+ack_timeout = float(os.environ.get("ACK_TIMEOUT_SECONDS", 30))
+connect_timeout = float(os.environ.get("CONNECT_TIMEOUT_SECONDS", 10))
+# Sends of a message that fail with a connection error before it is left to
+# the visibility timeout and redrive policy of the queue
+max_send_attempts = int(os.environ.get("MAX_SEND_ATTEMPTS", 3))
+reconnect_delay = float(os.environ.get("RECONNECT_DELAY_SECONDS", 1))
+shutdown_timeout = float(os.environ.get("SHUTDOWN_TIMEOUT_SECONDS", 20))
+mllp_encoding = os.environ.get("MLLP_ENCODING", "utf-8")
+delete_flush_interval = float(os.environ.get("DELETE_FLUSH_SECONDS", 0.5))
+
+# Concurrency control configuration: senders back off when the mean ACK
+# latency or the share of failed sends of an interval exceeds its limit
+control_interval = float(os.environ.get("CONTROL_INTERVAL_SECONDS", 5))
+ack_latency_target = float(os.environ.get("ACK_LATENCY_TARGET_SECONDS", 2))
+error_rate_limit = float(os.environ.get("ERROR_RATE_LIMIT", 0.1))
+backoff_factor = 0.5
+
+# SQS limit of entries in batch requests and received messages
+SQS_BATCH_MAX_ENTRIES = 10
+
+sqs = get_client("sqs")
+queue_url = sqs.get_queue_url(QueueName=os.environ["QUEUE_NAME"])["QueueUrl"]
+
+# Visibility timeout heartbeat configuration, defaults derived from
+# visibility timeout of the queue
+visibility_timeout = int(
+    os.environ.get("VISIBILITY_TIMEOUT_SECONDS")
+    or sqs.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=["VisibilityTimeout"]
+    )["Attributes"]["VisibilityTimeout"]
+)
+heartbeat_interval = float(
+    os.environ.get("HEARTBEAT_INTERVAL_SECONDS", max(visibility_timeout / 6, 1))
+)
+heartbeat_margin = float(
+    os.environ.get("HEARTBEAT_MARGIN_SECONDS", visibility_timeout / 3)
+)
+
 
 class SignalHandler:
-    def __init__(self):
+    def __init__(self, loop: asyncio.AbstractEventLoop):
         self.received_signal = False
-        signal(SIGINT, self._signal_handler)
-        signal(SIGTERM, self._signal_handler)
+        self.stopped = asyncio.Event()
+        loop.add_signal_handler(SIGINT, self._signal_handler, SIGINT)
+        loop.add_signal_handler(SIGTERM, self._signal_handler, SIGTERM)
 
-    def _signal_handler(self, signal, frame):
+    def _signal_handler(self, signal):
         logger.info(f"handling signal {signal}, exiting gracefully")
         self.received_signal = True
+        self.stopped.set()
 
 
-sqs = boto3.resource("sqs")
-queue = sqs.get_queue_by_name(QueueName=os.environ["QUEUE_NAME"])
-port_number = int(os.environ.get("PORT_NUMBER", 2575))
-server_name = os.environ.get("SERVER_NAME", "localhost")
+class InFlightMessages:
+    """
+    Visibility deadlines of messages received from SQS and not deleted yet
+    """
 
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._deadlines = dict()
 
-def process_message(client, body):
-    client.send_message(body)
+    def __len__(self) -> int:
+        return len(self._deadlines)
 
+    def add(self, message: dict, received_at: float) -> None:
+        self._deadlines[message["ReceiptHandle"]] = received_at + visibility_timeout
 
-def main():
-    signal_handler = SignalHandler()
-    while True:
-        try:
-            with MLLPClient(server_name, port_number) as client:
-                print(f"Connecting to {server_name} on {port_number}", flush=True)
-                while not signal_handler.received_signal:
-                    messages = queue.receive_messages(
-                        AttributeNames=["All"],
-                        MaxNumberOfMessages=10,
-                        WaitTimeSeconds=10,
-                    )
-                    for message in messages:
-                        try:
-                            print("Processing message...", flush=True)
-                            process_message(client, message.body)
-                            # BrokenPipeError: [Errno 32] Broken pipe
-                            # ConnectionResetError: [Errno 104] Connection reset by peer
-                        except ConnectionResetError as exc:
-                            client.close()
-                            raise exc
-                        except ConnectionAbortedError as exc:
-                            client.close()
-                            raise exc
-                        except Exception as exc:
-                            client.close()
-                            logger.exception(
-                                f"Exception: {repr(exc)} Connection: {server_name}:{port_number}",
-                                exc_info=exc,
-                            )
-                            # raise RuntimeError(
-                            #     f"Parameters: {server_name}:{port_number}"
-                            # ) from exc
-                            raise exc
-                        else:
-                            message.delete()
-        except ConnectionResetError as exc:
-            print(f"Reconnecting due to {exc}")
+    def remove(self, message: dict) -> None:
+        self._deadlines.pop(message["ReceiptHandle"], None)
+
+    def expiring(self, margin: float) -> list:
+        deadline = self._loop.time() + margin
+        return [
+            receipt_handle
+            for receipt_handle, message_deadline in self._deadlines.items()
+            if message_deadline <= deadline
+        ]
+
+    def extend(self, receipt_handle: str, extended_at: float) -> None:
+        if receipt_handle in self._deadlines:
+            self._deadlines[receipt_handle] = extended_at + visibility_timeout
+
+
+class ConcurrencyController:
+    """
+    Numbers of active SQS pollers and MLLP senders, adjusted once per
+    control interval from queue depth, ACK latency and send errors
+    """
+
+    def __init__(self):
+        self.pollers = sqs_pollers
+        self.senders = mllp_connections
+        self._condition = asyncio.Condition()
+        # Limits double until the first back-off, and again after idle periods
+        self._slow_start = True
+        self._acks = 0
+        self._errors = 0
+        self._latency = 0.0
+
+    @property
+    def adaptive(self) -> bool:
+        return sqs_pollers_max > sqs_pollers or mllp_connections_max > mllp_connections
+
+    def record_ack(self, latency: float) -> None:
+        self._acks += 1
+        self._latency += latency
+
+    def record_error(self) -> None:
+        self._errors += 1
+
+    async def wait_active(self, stage: str, index: int) -> None:
+        """
+        Waits until the poller or sender at index is active
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: index < getattr(self, stage))
+
+    async def adjust(self, queue_depth: int, send_queue: asyncio.Queue) -> None:
+        """
+        Adjusts numbers of pollers and senders to the approximate number of
+        visible SQS messages and the sends since the last adjustment
+        """
+        sends = self._acks + self._errors
+        latency = self._latency / self._acks if self._acks else 0.0
+        error_rate = self._errors / sends if sends else 0.0
+        self._acks, self._errors, self._latency = 0, 0, 0.0
+        waiting = queue_depth + send_queue.qsize()
+        pollers, senders = self.pollers, self.senders
+
+        if latency > ack_latency_target or error_rate > error_rate_limit:
+            # Multiplicative decrease when the HL7v2 server slows down or fails
+            senders = max(int(senders * backoff_factor), mllp_connections)
+            self._slow_start = False
+        elif waiting > 0:
+            senders = min(
+                senders + (senders if self._slow_start else 1), mllp_connections_max
+            )
+        else:
+            senders = max(senders - 1, mllp_connections)
+            self._slow_start = True
+
+        if send_queue.full():
+            # Senders are behind, received messages would only wait
+            pollers = max(int(pollers * backoff_factor), sqs_pollers)
+        elif queue_depth > pollers * SQS_BATCH_MAX_ENTRIES:
+            pollers = min(pollers * 2, sqs_pollers_max)
+        elif queue_depth == 0:
+            pollers = max(pollers - 1, sqs_pollers)
+
+        if (pollers, senders) != (self.pollers, self.senders):
+            logger.info(
+                f"Concurrency: {pollers} pollers, {senders} senders (queue depth "
+                f"{queue_depth}, ACK latency {latency:.3f}s, error rate "
+                f"{error_rate:.2f})"
+            )
+            async with self._condition:
+                self.pollers, self.senders = pollers, senders
+                self._condition.notify_all()
+
+
+class NegativeAcknowledgment(Exception):
+    """
+    Raised when HL7v2 server does not accept a message
+    """
+
+
+class PayloadError(Exception):
+    """
+    Raised when the HL7v2 message of an SQS message cannot be read
+    """
+
+
+async def process_message(reader, writer, message: dict) -> None:
+    body = await get_message_body(message)
+    writer.writeblock(body.encode(mllp_encoding))
+    await writer.drain()
+    ack = await asyncio.wait_for(reader.readblock(), ack_timeout)
+    ack_code = get_ack_code(ack.decode(mllp_encoding))
+    if ack_code not in ["AA", "CA"]:
+        raise NegativeAcknowledgment(f"Message rejected with {ack_code}")
+
+
+async def get_message_body(message: dict) -> str:
+    """
+    Returns HL7v2 message of the SQS message, decompressing it or reading it
+    from S3 as described by the message attributes
+    """
+    attributes = message.get("MessageAttributes") or {}
+    content_encoding = attributes.get("ContentEncoding", {}).get("StringValue")
+    location = attributes.get("PayloadLocation", {}).get("StringValue")
+    if content_encoding is None and location is None:
+        return message["Body"]
+    try:
+        if location is not None:
+            loop = asyncio.get_running_loop()
+            payload = await loop.run_in_executor(None, read_payload, location)
+        else:
+            payload = b64decode(message["Body"])
+        if content_encoding == "zlib":
+            payload = zlib.decompress(payload)
+        elif content_encoding is not None:
+            raise ValueError(f"Unknown content encoding {content_encoding}")
+        return payload.decode("utf-8")
+    except Exception as exc:
+        raise PayloadError(
+            f"Unable to read message {message.get('MessageId')}: {repr(exc)}"
+        ) from exc
+
+
+def read_payload(location: str) -> bytes:
+    bucket, _, key = location[len("s3://") :].partition("/")
+    return get_client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+def get_ack_code(ack: str) -> str:
+    try:
+        return str(hl7.parse(ack).segment("MSA")[1])
+    except Exception:
+        return ""
+
+
+async def receive_messages(
+    index: int,
+    send_queue: asyncio.Queue,
+    in_flight: InFlightMessages,
+    signal_handler: SignalHandler,
+    controller: ConcurrencyController,
+) -> None:
+    loop = asyncio.get_running_loop()
+    while not signal_handler.received_signal:
+        if index >= controller.pollers:
+            # Inactive pollers check for signals while they wait
+            try:
+                await asyncio.wait_for(
+                    controller.wait_active("pollers", index), reconnect_delay
+                )
+            except asyncio.TimeoutError:
+                pass
             continue
-        except ConnectionAbortedError as exc:
-            print(f"Reconnecting due to {exc}")
+        # Messages that do not fit into the send queue would wait with their
+        # visibility timeout running
+        max_messages = SQS_BATCH_MAX_ENTRIES
+        if send_queue.maxsize > 0:
+            room = send_queue.maxsize - send_queue.qsize()
+            max_messages = min(max(room, 1), SQS_BATCH_MAX_ENTRIES)
+        # Visibility timeout starts before the messages are returned
+        received_at = loop.time()
+        try:
+            response = await loop.run_in_executor(
+                None,
+                partial(
+                    sqs.receive_message,
+                    QueueUrl=queue_url,
+                    AttributeNames=["All"],
+                    MessageAttributeNames=["All"],
+                    MaxNumberOfMessages=max_messages,
+                    WaitTimeSeconds=10,
+                ),
+            )
+        except Exception as exc:
+            logger.exception(f"Unable to receive messages: {repr(exc)}", exc_info=exc)
+            await asyncio.sleep(reconnect_delay)
             continue
-        except BrokenPipeError as exc:
-            print(f"Reconnecting due to {exc}")
+        messages = response.get("Messages", [])
+        for message in messages:
+            in_flight.add(message, received_at)
+        for message in messages:
+            # Blocks while senders are behind (backpressure on polling)
+            await send_queue.put(message)
+
+
+async def send_messages(
+    index: int,
+    send_queue: asyncio.Queue,
+    delete_queue: asyncio.Queue,
+    in_flight: InFlightMessages,
+    controller: ConcurrencyController,
+) -> None:
+    loop = asyncio.get_running_loop()
+    message = None
+    attempts = 0
+    while True:
+        # Inactive senders do not hold a connection
+        if message is None:
+            await controller.wait_active("senders", index)
+        try:
+            reader, writer = await asyncio.wait_for(
+                open_hl7_connection(server_name, port_number), connect_timeout
+            )
+        except (OSError, asyncio.TimeoutError) as exc:
+            controller.record_error()
+            print(f"Reconnecting due to {exc}", flush=True)
+            await asyncio.sleep(reconnect_delay)
             continue
-        except TimeoutError as exc:
-            print(f"Reconnecting due to {exc}")
+
+        print(f"Connecting to {server_name} on {port_number}", flush=True)
+        try:
+            while True:
+                # Message that failed with a connection error is sent again
+                # on the new connection
+                if message is None:
+                    if index >= controller.senders:
+                        break
+                    message = await send_queue.get()
+                    attempts = 0
+                print("Processing message...", flush=True)
+                attempts += 1
+                sent_at = loop.time()
+                try:
+                    await process_message(reader, writer, message)
+                except (NegativeAcknowledgment, PayloadError) as exc:
+                    # Message stays on SQS and will be redelivered, until the
+                    # redrive policy of the queue moves it to the dead-letter
+                    # queue
+                    in_flight.remove(message)
+                    logger.error(f"{exc} Connection: {server_name}:{port_number}")
+                else:
+                    controller.record_ack(loop.time() - sent_at)
+                    await delete_queue.put(message)
+                message = None
+                send_queue.task_done()
+        except (
+            ConnectionError,
+            TimeoutError,
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+        ) as exc:
+            controller.record_error()
+            print(f"Reconnecting due to {repr(exc)}", flush=True)
+            if message is not None and attempts >= max_send_attempts:
+                # Visibility timeout is no longer extended, the message is
+                # received again until the redrive policy of the queue moves
+                # it to the dead-letter queue
+                logger.error(
+                    f"Message {message.get('MessageId')} failed {attempts} times,"
+                    f" returning it to the queue"
+                )
+                in_flight.remove(message)
+                send_queue.task_done()
+                message = None
+        except Exception as exc:
+            logger.exception(
+                f"Exception: {repr(exc)} Connection: {server_name}:{port_number}",
+                exc_info=exc,
+            )
+            if message is not None:
+                # Message is not sent again, SQS redelivers it after its
+                # visibility timeout or moves it to the dead-letter queue
+                in_flight.remove(message)
+                send_queue.task_done()
+                message = None
+            await asyncio.sleep(reconnect_delay)
+        finally:
+            writer.close()
+
+
+async def delete_messages(
+    delete_queue: asyncio.Queue, in_flight: InFlightMessages
+) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        # Collect batch until it is full or flush interval has passed
+        batch = [await delete_queue.get()]
+        flush_at = loop.time() + delete_flush_interval
+        while len(batch) < SQS_BATCH_MAX_ENTRIES:
+            timeout = flush_at - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(delete_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            response = await loop.run_in_executor(
+                None,
+                partial(
+                    sqs.delete_message_batch,
+                    QueueUrl=queue_url,
+                    Entries=[
+                        dict(Id=str(index), ReceiptHandle=message["ReceiptHandle"])
+                        for index, message in enumerate(batch)
+                    ],
+                ),
+            )
+            for failure in response.get("Failed", []):
+                # Message will be redelivered and sent again
+                logger.error(f"Unable to delete message: {failure.get('Message')}")
+        except Exception as exc:
+            logger.exception(f"Unable to delete messages: {repr(exc)}", exc_info=exc)
+        finally:
+            for message in batch:
+                in_flight.remove(message)
+                delete_queue.task_done()
+
+
+async def extend_visibility(in_flight: InFlightMessages) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(heartbeat_interval)
+        receipt_handles = in_flight.expiring(heartbeat_margin)
+        for start in range(0, len(receipt_handles), SQS_BATCH_MAX_ENTRIES):
+            batch = receipt_handles[start : start + SQS_BATCH_MAX_ENTRIES]
+            extended_at = loop.time()
+            try:
+                response = await loop.run_in_executor(
+                    None,
+                    partial(
+                        sqs.change_message_visibility_batch,
+                        QueueUrl=queue_url,
+                        Entries=[
+                            dict(
+                                Id=str(index),
+                                ReceiptHandle=receipt_handle,
+                                VisibilityTimeout=visibility_timeout,
+                            )
+                            for index, receipt_handle in enumerate(batch)
+                        ],
+                    ),
+                )
+            except Exception as exc:
+                logger.exception(
+                    f"Unable to extend visibility timeout: {repr(exc)}", exc_info=exc
+                )
+                continue
+            for success in response.get("Successful", []):
+                in_flight.extend(batch[int(success["Id"])], extended_at)
+            for failure in response.get("Failed", []):
+                logger.error(
+                    f"Unable to extend visibility timeout: {failure.get('Message')}"
+                )
+
+
+async def control_concurrency(
+    send_queue: asyncio.Queue, controller: ConcurrencyController
+) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(control_interval)
+        try:
+            response = await loop.run_in_executor(
+                None,
+                partial(
+                    sqs.get_queue_attributes,
+                    QueueUrl=queue_url,
+                    AttributeNames=["ApproximateNumberOfMessages"],
+                ),
+            )
+            queue_depth = int(response["Attributes"]["ApproximateNumberOfMessages"])
+        except Exception as exc:
+            logger.exception(f"Unable to get queue depth: {repr(exc)}", exc_info=exc)
             continue
+        await controller.adjust(queue_depth, send_queue)
+
+
+async def run_pipeline(
+    send_queue: asyncio.Queue = None, delete_queue: asyncio.Queue = None
+) -> None:
+    """
+    Runs the pipeline until SIGINT or SIGTERM. Queues between the stages can
+    be passed in, e.g. to observe their depth.
+    """
+    loop = asyncio.get_running_loop()
+    # Threads for blocking SQS calls of pollers, deleters, heartbeat and
+    # controller and S3 reads of offloaded messages by senders
+    loop.set_default_executor(
+        ThreadPoolExecutor(sqs_pollers_max + sqs_deleters + 2 + mllp_connections_max)
+    )
+    signal_handler = SignalHandler(loop)
+    in_flight = InFlightMessages(loop)
+    controller = ConcurrencyController()
+
+    if send_queue is None:
+        send_queue = asyncio.Queue(maxsize=queue_size)
+    if delete_queue is None:
+        delete_queue = asyncio.Queue(maxsize=queue_size)
+    # Pollers and senders are started up to the maximum, the controller
+    # activates them
+    pollers = [
+        asyncio.create_task(
+            receive_messages(index, send_queue, in_flight, signal_handler, controller)
+        )
+        for index in range(sqs_pollers_max)
+    ]
+    workers = (
+        [
+            asyncio.create_task(
+                send_messages(index, send_queue, delete_queue, in_flight, controller)
+            )
+            for index in range(mllp_connections_max)
+        ]
+        + [
+            asyncio.create_task(delete_messages(delete_queue, in_flight))
+            for _ in range(sqs_deleters)
+        ]
+        + [asyncio.create_task(extend_visibility(in_flight))]
+    )
+    if controller.adaptive:
+        workers.append(asyncio.create_task(control_concurrency(send_queue, controller)))
+
+    stopped = asyncio.create_task(signal_handler.stopped.wait())
+    try:
+        await asyncio.wait([stopped] + pollers, return_when=asyncio.FIRST_COMPLETED)
+        # Pollers finish their receive calls. Pollers blocked on a full send
+        # queue do not see the signal and are cancelled, their messages are
+        # redelivered by SQS.
+        _, pending = await asyncio.wait(pollers, timeout=shutdown_timeout)
+    except asyncio.CancelledError:
+        for task in pollers + workers:
+            task.cancel()
+        raise
+    finally:
+        stopped.cancel()
+    for poller in pending:
+        poller.cancel()
+    for result in await asyncio.gather(*pollers, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"Poller failed: {repr(result)}")
+
+    # Drain messages already received, the rest is redelivered by SQS
+    try:
+        await asyncio.wait_for(send_queue.join(), shutdown_timeout)
+        await asyncio.wait_for(delete_queue.join(), shutdown_timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Pipeline not drained before shutdown timeout")
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+def main():
+    asyncio.run(run_pipeline())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Process-wide registry of AWS service clients. Clients are created lazily,
+# once per process, and reused across invocations and threads so that
+# session setup, credential resolution and TLS connections are not repeated
+# for every request. boto3 clients (unlike resources) are thread-safe.
+# boto3 itself is imported when the first client is created.
+#
+# Connection settings are read from environment variables:
+#   AWS_MAX_POOL_CONNECTIONS - size of the HTTP connection pool (default 10)
+#   AWS_TCP_KEEPALIVE        - enable TCP keep-alive on connections (default true)
+#   AWS_RETRY_MODE           - legacy, standard or adaptive (default standard)
+#   AWS_MAX_ATTEMPTS         - total number of attempts per call (default 3)
+import os
+import threading
+
+_lock = threading.Lock()
+_session = None
+_clients = dict()
+
+
+def _get_config():
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "10")),
+        tcp_keepalive=os.environ.get("AWS_TCP_KEEPALIVE", "true").lower() == "true",
+        retries=dict(
+            mode=os.environ.get("AWS_RETRY_MODE", "standard"),
+            total_max_attempts=int(os.environ.get("AWS_MAX_ATTEMPTS", "3")),
+        ),
+    )
+
+
+def get_client(service_name: str):
+    """
+    Returns shared client for the AWS service, creating it on first use
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                global _session
+                if _session is None:
+                    import boto3.session
+
+                    _session = boto3.session.Session()
+                client = _session.client(service_name, config=_get_config())
+                _clients[service_name] = client
+    return client
+
+
+def reset_clients() -> None:
+    """
+    Discards all shared clients, e.g. after credentials have changed
+    """
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
@@ -0,0 +1,187 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Content hashes of the last HL7v2 message sent for every resource, keyed by
+# "{resource_type}/{id}", with the entity tag of that message. PUT
+# interactions whose message has the same content hash are not sent again.
+# The backend is selected by environment variables:
+#   CONTENT_HASH_STORE      - none (default, no deduplication), memory, sqlite
+#                             or dynamodb
+#   CONTENT_HASH_CACHE_SIZE - entries kept by the memory backend (default 10000)
+#   CONTENT_HASH_STORE_PATH - database file of the sqlite backend
+#                             (default content_hashes.db)
+#   CONTENT_HASH_TABLE      - table of the dynamodb backend, with string
+#                             partition key "key"
+#
+# The memory backend is a bounded LRU cache in the container; it is only
+# accurate while a single container writes a resource. The sqlite and
+# dynamodb backends persist hashes, dynamodb across all containers.
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from lib.aws_clients import get_client
+
+CONTENT_HASH_STORE = os.environ.get("CONTENT_HASH_STORE", "none")
+
+_lock = threading.Lock()
+_stores = dict()
+
+
+class ContentHashStore(object):
+    """
+    Interface of content hash storage backends
+    """
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """
+        Returns content hash and entity tag of the last message sent for
+        the key, or None if there is none
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, content_hash: str, etag: str) -> None:
+        """
+        Records content hash and entity tag of a message sent for the key
+        """
+        raise NotImplementedError
+
+    def put_many(self, items: Iterable[Tuple[str, str, str]]) -> None:
+        """
+        Records (key, content hash, entity tag) of messages sent
+        """
+        for key, content_hash, etag in items:
+            self.put(key, content_hash, etag)
+
+
+class MemoryContentHashStore(ContentHashStore):
+    """
+    Content hashes kept in a bounded LRU cache of the container
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, content_hash: str, etag: str) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (content_hash, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+
+class SqliteContentHashStore(ContentHashStore):
+    """
+    Content hashes stored in a local SQLite database
+    """
+
+    def __init__(self, path: str) -> None:
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS content_hashes "
+            "(key TEXT PRIMARY KEY, content_hash TEXT NOT NULL, etag TEXT NOT NULL) "
+            "WITHOUT ROWID"
+        )
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_hash, etag FROM content_hashes WHERE key = ?", (key,)
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put(self, key: str, content_hash: str, etag: str) -> None:
+        self.put_many([(key, content_hash, etag)])
+
+    def put_many(self, items: Iterable[Tuple[str, str, str]]) -> None:
+        rows = list(items)
+        # All hashes are written in one transaction
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO content_hashes (key, content_hash, etag) "
+                    "VALUES (?, ?, ?)",
+                    rows,
+                )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+
+class DynamoDbContentHashStore(ContentHashStore):
+    """
+    Content hashes stored as items of a DynamoDB table
+    """
+
+    def __init__(self, table_name: str) -> None:
+        self._table_name = table_name
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        dynamodb = get_client("dynamodb")
+        item = dynamodb.get_item(
+            TableName=self._table_name,
+            Key=dict(key=dict(S=key)),
+            ConsistentRead=True,
+        ).get("Item")
+        if item is None:
+            return None
+        return (item["content_hash"]["S"], item["etag"]["S"])
+
+    def put(self, key: str, content_hash: str, etag: str) -> None:
+        dynamodb = get_client("dynamodb")
+        dynamodb.put_item(
+            TableName=self._table_name,
+            Item=dict(
+                key=dict(S=key), content_hash=dict(S=content_hash), etag=dict(S=etag)
+            ),
+        )
+
+
+def get_content_hash_store(name: str = None) -> Optional[ContentHashStore]:
+    """
+    Returns shared content hash store of the backend, creating it on first
+    use, or None if deduplication is disabled
+    """
+    name = name or CONTENT_HASH_STORE
+    if name == "none":
+        return None
+    store = _stores.get(name)
+    if store is None:
+        with _lock:
+            store = _stores.get(name)
+            if store is None:
+                if name == "memory":
+                    store = MemoryContentHashStore(
+                        int(os.environ.get("CONTENT_HASH_CACHE_SIZE", "10000"))
+                    )
+                elif name == "sqlite":
+                    store = SqliteContentHashStore(
+                        os.environ.get("CONTENT_HASH_STORE_PATH", "content_hashes.db")
+                    )
+                elif name == "dynamodb":
+                    store = DynamoDbContentHashStore(os.environ["CONTENT_HASH_TABLE"])
+                else:
+                    raise ValueError(f"Unknown content hash store {name}")
+                _stores[name] = store
+    return store
@@ -0,0 +1,301 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Direct ER7 encoder for HL7v2 messages. Produces the same output as
+# hl7_message_builder without building an hl7apy object tree: every segment
+# has a fixed layout, so fields and components are written straight into
+# strings from the FHIR resource. Patient fields are written by functions
+# compiled from the mappings in lib.hl7_mapping. Messages of changed Patient
+# resources can be updated segment by segment.
+from datetime import datetime
+from decimal import Decimal
+from uuid import uuid4
+
+from lib.hl7_mapping import (
+    ADT,
+    CE,
+    RESULT_STATUS_CODES,
+    compile_mapping,
+    compile_segments,
+)
+
+SEGMENT_SEPARATOR = "\r"
+FIELD_SEPARATOR = "|"
+REPETITION_SEPARATOR = "~"
+COMPONENT_SEPARATOR = "^"
+
+_ESCAPE_TABLE = str.maketrans(
+    {
+        "\\": "\\E\\",
+        "|": "\\F\\",
+        "^": "\\S\\",
+        "&": "\\T\\",
+        "~": "\\R\\",
+        "\r": "\\X0D\\",
+        "\n": "\\X0A\\",
+    }
+)
+_ESCAPED_CHARACTERS = frozenset("\\|^&~\r\n")
+
+_MSH_TEMPLATE = "MSH|^~\\&|||||{datetime}||{message_type}|{control_id}|T|2.5.1||||AL"
+# Segments are copied verbatim from messages with these encoding characters
+_MSH_PREFIX = "MSH|^~\\&|"
+
+
+def escape(value: str) -> str:
+    if _ESCAPED_CHARACTERS.isdisjoint(value):
+        return value
+    return value.translate(_ESCAPE_TABLE)
+
+
+def _create_msh_segment(message_type: str) -> str:
+    return _MSH_TEMPLATE.format(
+        datetime=datetime.now().strftime("%Y%m%d%H%M%S"),
+        message_type=message_type,
+        control_id=uuid4().hex,
+    )
+
+
+def create_adt_message(fhir_resource: dict) -> str:
+    segments = [_create_msh_segment(ADT.message_type)]
+    segments.extend(_encode_adt(fhir_resource))
+
+    return SEGMENT_SEPARATOR.join(segments)
+
+
+def update_adt_message(
+    hl7msg: str, previous_resource: dict, fhir_resource: dict
+) -> str:
+    """
+    Writes ADT message for fhir_resource, a changed version of
+    previous_resource that was read from hl7msg. Segments of unchanged
+    elements are copied from hl7msg, only the others are encoded again.
+    Fields that are not read back keep their values from hl7msg unless
+    fhir_resource has their elements. Messages with other segments or
+    encoding characters are written in full.
+    """
+    if "\n" in hl7msg:
+        hl7msg = hl7msg.replace("\r\n", "\r").replace("\n", "\r")
+    previous_segments = [segment for segment in hl7msg.split("\r") if segment]
+    # Repeated segments hold top-level lists, one segment per list element
+    expected = ["MSH"]
+    for segment in ADT.segments:
+        if segment.repeat:
+            items = previous_resource.get(segment.path[0]) or ()
+            expected.extend([segment.name] * len(items))
+        else:
+            expected.append(segment.name)
+    if (
+        not hl7msg.startswith(_MSH_PREFIX)
+        or [segment[:3] for segment in previous_segments] != expected
+    ):
+        return carry_adt_fields(
+            create_adt_message(fhir_resource), hl7msg, fhir_resource
+        )
+
+    segments = [_create_msh_segment(ADT.message_type)]
+    position = 1
+    for segment in ADT.segments:
+        encode = _encode_adt_segments[segment.name]
+        if segment.repeat:
+            name = segment.path[0]
+            previous_items = previous_resource.get(name) or ()
+            # Set IDs follow list positions, so elements that moved are
+            # encoded again
+            for index, item in enumerate(fhir_resource.get(name) or (), 1):
+                if index <= len(previous_items) and previous_items[index - 1] == item:
+                    segments.append(previous_segments[position + index - 1])
+                else:
+                    segments.append(encode(item, index))
+            position += len(previous_items)
+        else:
+            if any(
+                previous_resource.get(name) != fhir_resource.get(name)
+                for name in _ADT_SEGMENT_ELEMENTS[segment.name]
+            ):
+                segments.append(
+                    _carry_fields(
+                        encode(fhir_resource, 1),
+                        previous_segments[position],
+                        [
+                            field_position
+                            for field_position, name in _ADT_CARRIED_FIELDS[
+                                segment.name
+                            ]
+                            if name not in fhir_resource
+                        ],
+                    )
+                )
+            else:
+                segments.append(previous_segments[position])
+            position += 1
+
+    return SEGMENT_SEPARATOR.join(segments)
+
+
+def carry_adt_fields(hl7msg: str, previous_hl7msg: str, fhir_resource: dict) -> str:
+    """
+    Returns ADT message hl7msg with the fields that are not read back copied
+    from previous_hl7msg, unless fhir_resource has their elements. Messages
+    with other encoding characters are returned unchanged.
+    """
+    if "\n" in previous_hl7msg:
+        previous_hl7msg = previous_hl7msg.replace("\r\n", "\r").replace("\n", "\r")
+    if not (hl7msg.startswith(_MSH_PREFIX) and previous_hl7msg.startswith(_MSH_PREFIX)):
+        return hl7msg
+    previous_segments = dict()
+    for segment in reversed(previous_hl7msg.split(SEGMENT_SEPARATOR)):
+        previous_segments[segment[:3]] = segment
+    segments = hl7msg.split(SEGMENT_SEPARATOR)
+    for index, segment in enumerate(segments):
+        name = segment[:3]
+        if name in previous_segments and (fields := _ADT_CARRIED_FIELDS.get(name)):
+            segments[index] = _carry_fields(
+                segment,
+                previous_segments[name],
+                [position for position, path in fields if path not in fhir_resource],
+            )
+    return SEGMENT_SEPARATOR.join(segments)
+
+
+def _carry_fields(segment: str, previous_segment: str, positions: list) -> str:
+    # Fields at positions are copied from previous_segment
+    if not positions:
+        return segment
+    fields = segment.split(FIELD_SEPARATOR)
+    previous_fields = previous_segment.split(FIELD_SEPARATOR)
+    for position in positions:
+        if position < len(previous_fields):
+            if position >= len(fields):
+                fields.extend([""] * (position + 1 - len(fields)))
+            fields[position] = previous_fields[position]
+    return FIELD_SEPARATOR.join(fields)
+
+
+def create_oru_message(fhir_resource: dict) -> str:
+    """
+    Writes ORU^R01 message with one OBX segment for the Observation value
+    and one for every component, segments are written in a single pass
+    """
+    segments = [_create_msh_segment("ORU^R01^ORU_R01")]
+    if patient_id := _get_subject_patient_id(fhir_resource):
+        segments.append(f"PID|1||{escape(patient_id)}^^^^FW")
+
+    code = _encode_coded_element(fhir_resource.get("code"))
+    segments.append(
+        _join_fields(
+            [
+                "OBR",
+                "1",
+                "",
+                f"{escape(fhir_resource['id'])}^FW",
+                code,
+                "",
+                "",
+                escape(fhir_resource.get("effectiveDateTime", "")),
+            ]
+        )
+    )
+
+    status = RESULT_STATUS_CODES.get(fhir_resource.get("status"), "")
+    set_id = 0
+    # Observation value has the Observation code and no sub-ID
+    if obx := _create_obx_segment(set_id + 1, fhir_resource, code, "", status):
+        set_id += 1
+        segments.append(obx)
+    for sub_id, component in enumerate(fhir_resource.get("component") or [], 1):
+        component_code = _encode_coded_element(component.get("code"))
+        if obx := _create_obx_segment(
+            set_id + 1, component, component_code, str(sub_id), status
+        ):
+            set_id += 1
+            segments.append(obx)
+
+    return SEGMENT_SEPARATOR.join(segments)
+
+
+def _get_subject_patient_id(fhir_resource: dict) -> str:
+    reference = (fhir_resource.get("subject") or {}).get("reference", "")
+    resource_type, _, resource_id = reference.partition("/")
+    return resource_id if resource_type == "Patient" else ""
+
+
+def _create_obx_segment(
+    set_id: int, element: dict, code: str, sub_id: str, status: str
+) -> str:
+    # Returns empty string for elements without supported value
+    if (quantity := element.get("valueQuantity")) is not None:
+        value_type = "NM"
+        value = _format_number(quantity.get("value", ""))
+        units = _join_components(
+            [
+                escape(quantity.get("code", "")),
+                escape(quantity.get("unit", "")),
+                escape(quantity.get("system", "")),
+            ]
+        )
+    elif (string := element.get("valueString")) is not None:
+        value_type, value, units = "ST", escape(string), ""
+    elif (concept := element.get("valueCodeableConcept")) is not None:
+        value_type, value, units = "CE", _encode_coded_element(concept), ""
+    else:
+        return ""
+
+    # OBX: set ID^value type^identifier^sub-ID^value^units^^^^^result status
+    return _join_fields(
+        ["OBX", str(set_id), value_type, code, sub_id, value, units]
+        + ["", "", "", "", status]
+    )
+
+
+def _format_number(value) -> str:
+    # NM values are written in decimal notation without exponent
+    if isinstance(value, float):
+        value = repr(value)
+        if "e" in value or "E" in value:
+            value = format(Decimal(value), "f")
+        return value
+    return str(value)
+
+
+def _join_components(components: list) -> str:
+    # Trailing empty components are not written
+    return COMPONENT_SEPARATOR.join(components).rstrip(COMPONENT_SEPARATOR)
+
+
+def _join_fields(fields: list) -> str:
+    # Trailing empty fields are not written
+    while fields and not fields[-1]:
+        fields.pop()
+    return FIELD_SEPARATOR.join(fields)
+
+
+_encode_adt = compile_mapping(
+    ADT, "er7", "encode", escape=escape, escaped_characters=_ESCAPED_CHARACTERS
+)
+_encode_adt_segments = compile_segments(
+    ADT, "er7", "encode", escape=escape, escaped_characters=_ESCAPED_CHARACTERS
+)
+# Top-level elements written into every segment that is not repeated
+_ADT_SEGMENT_ELEMENTS = {
+    segment.name: frozenset(
+        field.path[0] for field in segment.fields if field.path is not None
+    )
+    for segment in ADT.segments
+    if not segment.repeat
+}
+# Fields of these segments that are not read back, as (position, top-level
+# element): previous_resource of update_adt_message does not have them
+_ADT_CARRIED_FIELDS = {
+    segment.name: [
+        (field.position, field.path[0])
+        for field in segment.fields
+        if field.path is not None and not field.decode
+    ]
+    for segment in ADT.segments
+    if not segment.repeat
+}
+# CE: identifier^text^name of coding system
+_encode_coded_element = compile_mapping(
+    CE, "er7", "encode", escape=escape, escaped_characters=_ESCAPED_CHARACTERS
+)
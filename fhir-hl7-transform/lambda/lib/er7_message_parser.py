@@ -0,0 +1,281 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Lazy ER7 parser for HL7v2 messages. The message is split into segments
+# once; fields, repetitions and components of a segment are only split and
+# unescaped when the FHIR mapping asks for them. Patient fields are read by
+# functions compiled from the mappings in lib.hl7_mapping. With a projection
+# of elements, segments and fields of other elements are not split at all.
+import math
+import re
+from functools import lru_cache
+
+from lib.fhir_projection import requests
+from lib.hl7_mapping import (
+    ADT,
+    CE,
+    RESULT_STATUS_VALUES,
+    compile_mapping,
+    get_elements,
+)
+
+
+class Er7Message(object):
+    """
+    Index of an ER7 encoded message by segment name
+    """
+
+    def __init__(self, hl7msg: str) -> None:
+        if not hl7msg.startswith("MSH") or len(hl7msg) < 8:
+            raise ValueError("Message does not start with a valid MSH segment")
+        self.field_separator = hl7msg[3]
+        (
+            self.component_separator,
+            self.repetition_separator,
+            self.escape_character,
+            self.subcomponent_separator,
+        ) = hl7msg[4:8]
+        self._unescape_pattern = _get_unescape_pattern(self.escape_character)
+
+        if "\n" in hl7msg:
+            hl7msg = hl7msg.replace("\r\n", "\r").replace("\n", "\r")
+        self._segments = dict()
+        for segment in hl7msg.split("\r"):
+            if segment:
+                self._segments.setdefault(segment[:3], []).append(segment)
+
+    def segment(self, name: str):
+        if segments := self._segments.get(name):
+            return Er7Segment(self, segments[0])
+        return None
+
+    def segments(self, name: str) -> list:
+        return [Er7Segment(self, s) for s in self._segments.get(name, [])]
+
+    def unescape(self, value: str) -> str:
+        if self.escape_character not in value:
+            return value
+        return self._unescape_pattern.sub(self._replace_escape_sequence, value)
+
+    def _replace_escape_sequence(self, match) -> str:
+        sequence = match.group(1)
+        if sequence == "F":
+            return self.field_separator
+        if sequence == "S":
+            return self.component_separator
+        if sequence == "T":
+            return self.subcomponent_separator
+        if sequence == "R":
+            return self.repetition_separator
+        if sequence == "E":
+            return self.escape_character
+        # \Xhhhh\ hexadecimal data
+        return bytes.fromhex(sequence[1:]).decode("latin-1")
+
+
+class Er7Segment(object):
+    """
+    Single segment of an ER7 message with fields split on first access
+    """
+
+    def __init__(self, message: Er7Message, raw: str) -> None:
+        self._message = message
+        self._raw = raw
+        self._fields = None
+
+    def field(self, index: int) -> str:
+        """
+        Returns raw (escaped) value of the field at HL7 position index
+        """
+        if self._fields is None:
+            self._fields = self._raw.split(self._message.field_separator)
+            if self._fields[0] == "MSH":
+                # MSH-1 is the field separator itself
+                self._fields.insert(1, self._message.field_separator)
+        if index < len(self._fields):
+            return self._fields[index]
+        return ""
+
+    def repetitions(self, index: int) -> list:
+        """
+        Returns list of repetitions of the field, each as list of raw components
+        """
+        if field := self.field(index):
+            component_separator = self._message.component_separator
+            return [
+                rep.split(component_separator)
+                for rep in field.split(self._message.repetition_separator)
+            ]
+        return []
+
+    def value(self, index: int) -> str:
+        """
+        Returns unescaped value of the first repetition of the field
+        """
+        if field := self.field(index):
+            return self._message.unescape(
+                field.split(self._message.repetition_separator, 1)[0]
+            )
+        return ""
+
+    def values(self, index: int) -> list:
+        """
+        Returns unescaped values of all repetitions of the field
+        """
+        if field := self.field(index):
+            unescape = self._message.unescape
+            return [
+                unescape(rep) for rep in field.split(self._message.repetition_separator)
+            ]
+        return []
+
+    def component(self, components: list, index: int) -> str:
+        if index <= len(components):
+            return self._message.unescape(components[index - 1])
+        return ""
+
+
+@lru_cache(maxsize=8)
+def _get_unescape_pattern(escape_character: str):
+    escape_character = re.escape(escape_character)
+    return re.compile(
+        f"{escape_character}([FSTRE]|X(?:[0-9A-Fa-f]{{2}})+){escape_character}"
+    )
+
+
+def iter_segments(hl7msg: str):
+    """
+    Yields segments of the message one at a time
+    """
+    if "\n" in hl7msg:
+        hl7msg = hl7msg.replace("\r\n", "\r").replace("\n", "\r")
+    start, length = 0, len(hl7msg)
+    while start < length:
+        end = hl7msg.find("\r", start)
+        if end < 0:
+            end = length
+        if end > start:
+            yield hl7msg[start:end]
+        start = end + 1
+
+
+def parse_oru_message(hl7msg: str, r: dict, elements: frozenset = None) -> dict:
+    # Results can have thousands of OBX segments, so segments are split and
+    # mapped one at a time in a single pass over the message. The MSH segment
+    # provides encoding characters for the other segments.
+    segments = iter_segments(hl7msg)
+    m = Er7Message(next(segments, ""))
+    # OBX segments hold status, value and components, PID the subject
+    read_results = any(
+        requests(elements, element) for element in ("status", "value", "component")
+    )
+    read_subject = requests(elements, "subject")
+    order_code = None
+    value_found = False
+    component_list = list()
+    for raw_segment in segments:
+        name = raw_segment[:3]
+        if name == "OBX":
+            if not read_results:
+                # OBX segments follow OBR and PID
+                break
+            obx = Er7Segment(m, raw_segment)
+            if "status" not in r:
+                if status := RESULT_STATUS_VALUES.get(obx.value(11)):
+                    r["status"] = status
+            obx_3 = obx.repetitions(3)
+            code = obx.component(obx_3[0], 1) if obx_3 else ""
+            # Observation value has the code of the order and no sub-ID
+            if not value_found and code == order_code and not obx.value(4):
+                value_found = True
+                _parse_observation_value(obx, r, m.unescape)
+            else:
+                component = dict()
+                if obx_3 and (
+                    coded_element := _parse_coded_element(obx_3[0], m.unescape)
+                ):
+                    component["code"] = coded_element
+                component_list.append(
+                    _parse_observation_value(obx, component, m.unescape)
+                )
+        elif name == "OBR" and order_code is None:
+            obr = Er7Segment(m, raw_segment)
+            obr_4 = obr.repetitions(4)
+            order_code = obr.component(obr_4[0], 1) if obr_4 else ""
+            if obr_4 and (coded_element := _parse_coded_element(obr_4[0], m.unescape)):
+                r["code"] = coded_element
+            if effective_date_time := obr.value(7):
+                r["effectiveDateTime"] = effective_date_time
+        elif name == "PID" and read_subject and "subject" not in r:
+            pid = Er7Segment(m, raw_segment)
+            for pid_3 in pid.repetitions(3):
+                if pid.component(pid_3, 5) == "FW":
+                    patient_id = pid.component(pid_3, 1)
+                    r["subject"] = dict(reference=f"Patient/{patient_id}")
+                    break
+
+    if component_list:
+        r["component"] = component_list
+
+    return r
+
+
+def _parse_observation_value(obx: Er7Segment, element: dict, unescape) -> dict:
+    value_type = obx.value(2)
+    value = obx.value(5)
+    if value_type == "NM":
+        quantity = dict()
+        if value:
+            try:
+                quantity["value"] = parse_number(value)
+            except ValueError:
+                element["valueString"] = value
+                return element
+        if obx_6 := obx.repetitions(6):
+            if unit := obx.component(obx_6[0], 2):
+                quantity["unit"] = unit
+            if system := obx.component(obx_6[0], 3):
+                quantity["system"] = system
+            if code := obx.component(obx_6[0], 1):
+                quantity["code"] = code
+        if quantity:
+            element["valueQuantity"] = quantity
+    elif value_type in ("CE", "CWE"):
+        obx_5 = obx.repetitions(5)
+        if obx_5 and (coded_element := _parse_coded_element(obx_5[0], unescape)):
+            element["valueCodeableConcept"] = coded_element
+    elif value:
+        element["valueString"] = value
+    return element
+
+
+def parse_number(value: str):
+    """
+    Returns NM value as int or float, raises ValueError for other values
+    """
+    try:
+        return int(value)
+    except ValueError:
+        number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"Invalid number {value}")
+    return number
+
+
+def parse_adt_message(hl7msg: str, r: dict, elements: frozenset = None) -> dict:
+    if elements is None or _ADT_ELEMENTS <= elements:
+        decode_adt = _decode_adt
+    else:
+        decode_adt = _compile_adt_projection(elements & _ADT_ELEMENTS)
+    return decode_adt(Er7Message(hl7msg), r)
+
+
+@lru_cache(maxsize=None)
+def _compile_adt_projection(elements: frozenset):
+    # One function for every projection, bounded by subsets of mapped elements
+    return compile_mapping(ADT, "er7", "decode", elements)
+
+
+_ADT_ELEMENTS = get_elements(ADT)
+_decode_adt = compile_mapping(ADT, "er7", "decode")
+_parse_coded_element = compile_mapping(CE, "er7", "decode")
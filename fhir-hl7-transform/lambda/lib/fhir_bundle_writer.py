@@ -0,0 +1,149 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+from typing import List
+
+from lib import request_metrics
+from lib.content_hash_store import ContentHashStore
+from lib.fhir_resource_writer import FhirResourceWriter
+from lib.search_index import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_TYPES = ["batch", "transaction"]
+
+
+class FhirBundleWriter:
+    """
+    Class representing writer of FHIR Bundle (batch or transaction) resources.
+    Every entry is converted to an HL7v2 message with FhirResourceWriter.
+    """
+
+    def __init__(
+        self,
+        bundle: dict,
+        hash_store: ContentHashStore = None,
+        search_index: SearchIndex = None,
+    ) -> None:
+        self._bundle = bundle
+        self._hash_store = hash_store
+        self._search_index = search_index
+        self._bundle_type = bundle.get("type")
+        if self._bundle_type not in BUNDLE_TYPES:
+            raise ValueError(f"Unsupported Bundle type: {self._bundle_type}")
+
+    @property
+    def bundle_type(self) -> str:
+        return self._bundle_type
+
+    def write(self, return_representation: bool = True) -> List[dict]:
+        """
+        Returns list of entry results with keys message (HL7v2 message or None
+        if entry could not be converted), resource, status, location and etag.
+        Results of PUT entries with messages equal to the last ones sent for
+        the resources have unchanged set; their messages are not sent again.
+        """
+        results = list()
+        for entry in self._bundle.get("entry") or []:
+            try:
+                results.append(self._write_entry(entry, return_representation))
+            except ValueError as exc:
+                # Entry is invalid or not supported
+                logger.warning(f"Unable to process Bundle entry: {exc}")
+                results.append(
+                    dict(message=None, status="400 Bad Request", outcome=str(exc))
+                )
+            except Exception as exc:
+                logger.exception("Unable to process Bundle entry", exc_info=exc)
+                results.append(
+                    dict(message=None, status="400 Bad Request", outcome=str(exc))
+                )
+        return results
+
+    def _write_entry(self, entry: dict, return_representation: bool) -> dict:
+        request = entry.get("request", {})
+        method = request.get("method", "POST")
+        resource_type, _, resource_id = request.get("url", "").partition("/")
+        if method == "POST":
+            path_parameters = None
+        elif method == "PUT" and resource_id:
+            path_parameters = dict(resource_type=resource_type, id=resource_id)
+        else:
+            raise ValueError(f"Unsupported request {method} {request.get('url')}")
+
+        writer = FhirResourceWriter(
+            entry["resource"],
+            path_parameters,
+            hash_store=self._hash_store,
+            search_index=self._search_index,
+        )
+        if resource_type and resource_type != writer.resource_type:
+            raise ValueError(
+                f"Request URL {request['url']} does not match {writer.resource_type}"
+            )
+        message, resource = writer.write(return_representation)
+
+        return dict(
+            message=message,
+            resource=resource,
+            status="200 OK" if writer.unchanged else "201 Created",
+            location=f"{writer.resource_type}/{writer.resource_id}",
+            etag=writer.etag,
+            unchanged=writer.unchanged,
+            writer=writer,
+        )
+
+    def record_sent(self, results: List[dict]) -> None:
+        """
+        Records content hashes and search index terms of the messages of entry
+        results that were sent
+        """
+        results = [result for result in results if not result["unchanged"]]
+        if self._hash_store is not None:
+            try:
+                self._hash_store.put_many(
+                    (result["location"], result["writer"].content_hash, result["etag"])
+                    for result in results
+                    if result["writer"].content_hash is not None
+                )
+            except Exception as exc:
+                logger.exception("Unable to record content hashes", exc_info=exc)
+        if self._search_index is not None:
+            try:
+                with request_metrics.timer("Index"):
+                    self._search_index.put_many(
+                        (result["location"], result["writer"].search_terms)
+                        for result in results
+                    )
+            except Exception as exc:
+                logger.exception("Unable to update search index", exc_info=exc)
+
+    def response(self, results: List[dict]) -> dict:
+        """
+        Returns batch-response or transaction-response Bundle for entry results
+        """
+        entries = list()
+        for result in results:
+            response_entry = dict(status=result["status"])
+            if location := result.get("location"):
+                response_entry["location"] = location
+            if etag := result.get("etag"):
+                response_entry["etag"] = etag
+            if outcome := result.get("outcome"):
+                response_entry["outcome"] = dict(
+                    resourceType="OperationOutcome",
+                    issue=[
+                        dict(severity="error", code="processing", diagnostics=outcome)
+                    ],
+                )
+            entry = dict(response=response_entry)
+            if resource := result.get("resource"):
+                entry["resource"] = resource
+            entries.append(entry)
+
+        return dict(
+            resourceType="Bundle",
+            type=f"{self._bundle_type}-response",
+            entry=entries,
+        )
@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Canonical form of FHIR resources: the resource that reading back the HL7v2
+# message built from a FHIR resource would produce. Computed directly from
+# the FHIR resource, without building or parsing the HL7v2 message. Patients
+# and coded elements are converted by functions compiled from the mappings in
+# lib.hl7_mapping for the canonical backend; Observation values, written by
+# the encoders without a mapping, are converted here.
+from lib.hl7_mapping import (
+    ADT,
+    CE,
+    RESULT_STATUS_CODES,
+    RESULT_STATUS_VALUES,
+    compile_mapping,
+)
+
+_canonicalize_adt = compile_mapping(ADT, "canonical", "encode")
+_canonicalize_coded_element = compile_mapping(CE, "canonical", "encode")
+
+# FHIR values as read back from the HL7v2 codes they are written as:
+# observation status (OBX-11)
+_OBSERVATION_STATUS_VALUES = {
+    status: RESULT_STATUS_VALUES[code] for status, code in RESULT_STATUS_CODES.items()
+}
+
+
+class FhirCanonicalConverter(object):
+    """
+    This class converts FHIR resource to its canonical form as stored
+    by the HL7v2 system
+    """
+
+    def __init__(
+        self, fhir_resource: dict, resource_type: str, resource_id: str
+    ) -> None:
+        self._fhir_resource = fhir_resource
+        self._resource_type = resource_type
+        self._resource_id = resource_id
+
+    def transform(self) -> dict:
+        r = dict()
+        r["resourceType"] = self._resource_type
+        r["id"] = self._resource_id
+        if self._resource_type == "Patient":
+            resource = canonicalize_patient(self._fhir_resource, r)
+        elif self._resource_type == "Observation":
+            resource = canonicalize_observation(self._fhir_resource, r)
+        else:
+            return {}
+
+        return resource
+
+
+def canonicalize_patient(fhir_resource: dict, r: dict) -> dict:
+    return _canonicalize_adt(fhir_resource, r)
+
+
+def canonicalize_observation(fhir_resource: dict, r: dict) -> dict:
+    reference = (fhir_resource.get("subject") or {}).get("reference", "")
+    resource_type, _, patient_id = reference.partition("/")
+    if resource_type == "Patient" and patient_id:
+        r["subject"] = dict(reference=reference)
+
+    if code := _canonicalize_coded_element(fhir_resource.get("code")):
+        r["code"] = code
+
+    if effective_date_time := fhir_resource.get("effectiveDateTime", ""):
+        r["effectiveDateTime"] = effective_date_time
+
+    # Values are stored in OBX segments, status is read from the first one
+    component_list = [
+        component
+        for component in (fhir_resource.get("component") or [])
+        if _has_observation_value(component)
+    ]
+    if _has_observation_value(fhir_resource) or component_list:
+        if status := _OBSERVATION_STATUS_VALUES.get(fhir_resource.get("status")):
+            r["status"] = status
+
+    _canonicalize_observation_value(fhir_resource, r)
+
+    if component_list:
+        r["component"] = list()
+        for component in component_list:
+            canonical_component = dict()
+            if code := _canonicalize_coded_element(component.get("code")):
+                canonical_component["code"] = code
+            r["component"].append(
+                _canonicalize_observation_value(component, canonical_component)
+            )
+
+    return r
+
+
+def _has_observation_value(element: dict) -> bool:
+    return any(
+        element.get(name) is not None
+        for name in ["valueQuantity", "valueString", "valueCodeableConcept"]
+    )
+
+
+def _canonicalize_observation_value(element: dict, r: dict) -> dict:
+    if (quantity := element.get("valueQuantity")) is not None:
+        canonical_quantity = dict()
+        if (value := quantity.get("value")) is not None and value != "":
+            canonical_quantity["value"] = value
+        for name in ["unit", "system", "code"]:
+            if quantity_element := quantity.get(name, ""):
+                canonical_quantity[name] = quantity_element
+        if canonical_quantity:
+            r["valueQuantity"] = canonical_quantity
+    elif (string := element.get("valueString")) is not None:
+        if string:
+            r["valueString"] = string
+    elif (concept := element.get("valueCodeableConcept")) is not None:
+        if coded_element := _canonicalize_coded_element(concept):
+            r["valueCodeableConcept"] = coded_element
+    return r
@@ -0,0 +1,123 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Projections of FHIR resources requested with the _elements and _summary
+# parameters of read and search interactions. A projection is the set of
+# top-level elements returned; resourceType, id and meta are always returned
+# and projected resources are tagged SUBSETTED. Parsers receive the
+# projection and do not read the HL7v2 segments and fields of other elements.
+from typing import Optional
+
+# Top-level elements of the summary of every resource type (_summary=true)
+SUMMARY_ELEMENTS = dict(
+    Patient=frozenset(
+        [
+            "identifier",
+            "active",
+            "name",
+            "telecom",
+            "gender",
+            "birthDate",
+            "deceased",
+            "address",
+            "managingOrganization",
+            "link",
+        ]
+    ),
+    Observation=frozenset(
+        [
+            "identifier",
+            "basedOn",
+            "partOf",
+            "status",
+            "category",
+            "code",
+            "subject",
+            "focus",
+            "encounter",
+            "effective",
+            "issued",
+            "performer",
+            "value",
+            "hasMember",
+            "derivedFrom",
+            "component",
+        ]
+    ),
+)
+
+MANDATORY_ELEMENTS = frozenset(["resourceType", "id", "meta"])
+
+# Elements with a choice of types, e.g. valueQuantity for value[x]
+CHOICE_ELEMENTS = frozenset(["value", "effective", "deceased", "multipleBirth"])
+
+SUBSETTED_TAG = dict(
+    system="http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+    code="SUBSETTED",
+)
+
+
+def get_projection(
+    resource_type: str, elements: str = None, summary: str = None
+) -> Optional[frozenset]:
+    """
+    Returns projection for the values of the _elements and _summary
+    parameters, or None for whole resources. Raises ValueError for
+    unsupported values.
+    """
+    if summary not in (None, "true", "false"):
+        raise ValueError(f"Unsupported _summary {summary}")
+    if summary == "true":
+        if elements is not None:
+            raise ValueError("_elements cannot be combined with _summary=true")
+        return SUMMARY_ELEMENTS.get(resource_type, frozenset())
+    if elements is None:
+        return None
+    projection = frozenset(
+        name.strip().replace("[x]", "") for name in elements.split(",") if name.strip()
+    )
+    if not projection:
+        raise ValueError("Empty _elements")
+    return projection
+
+
+def is_projected(name: str, projection: frozenset) -> bool:
+    """
+    Returns True if the top-level element is in the projection, choice
+    elements by name or with their type, e.g. value or valueQuantity
+    """
+    if name in projection or name in MANDATORY_ELEMENTS:
+        return True
+    for element in CHOICE_ELEMENTS:
+        if name.startswith(element) and name[len(element) : len(element) + 1].isupper():
+            return element in projection
+    return False
+
+
+def requests(projection: Optional[frozenset], element: str) -> bool:
+    """
+    Returns True if the element is read for the projection, choice elements
+    also if the projection names one of their types
+    """
+    if projection is None or element in projection:
+        return True
+    return element in CHOICE_ELEMENTS and any(
+        name.startswith(element) and name[len(element) : len(element) + 1].isupper()
+        for name in projection
+    )
+
+
+def project(resource: dict, projection: frozenset) -> dict:
+    """
+    Returns copy of the resource with the top-level elements of the
+    projection, tagged SUBSETTED
+    """
+    projected = {
+        name: value
+        for name, value in resource.items()
+        if is_projected(name, projection)
+    }
+    meta = dict(projected.get("meta") or {})
+    meta["tag"] = list(meta.get("tag") or []) + [SUBSETTED_TAG]
+    projected["meta"] = meta
+    return projected
@@ -0,0 +1,62 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from copy import deepcopy
+from typing import Optional
+
+from lib import request_metrics
+from lib.fhir_resource_reader import FhirResourceReader, parse_entity_tags
+from lib.json_patch import JsonPatchConflict, apply_patch
+from lib.message_store import MessageStore
+
+# Stored messages are read with the er7 parser, which decodes escape
+# sequences, so that encoding the patched resource does not escape them again
+PATCH_PARSER = "er7"
+
+
+class PreconditionFailed(Exception):
+    """
+    Raised when the stored resource does not have an entity tag of If-Match
+    """
+
+
+class FhirResourcePatcher(object):
+    """
+    Class applying JSON Patch documents to stored FHIR resources
+    """
+
+    def __init__(self, store: MessageStore, path_parameters: dict) -> None:
+        self._reader = FhirResourceReader(store, path_parameters)
+        self._resource_type = path_parameters.get("resource_type")
+        self._resource_id = path_parameters.get("id")
+        # Stored message and resource the patch was applied to
+        self.message = None
+        self.resource = None
+        self.etag = None
+
+    def patch(self, patch: list, if_match: Optional[str] = None) -> dict:
+        """
+        Returns copy of the stored resource with the operations of patch
+        applied. Raises MessageNotFound for unknown resources,
+        PreconditionFailed if the entity tag of the resource is not listed in
+        if_match, and JsonPatchError for patches that cannot be applied.
+        """
+        self.message, self.resource = self._reader.read_message(PATCH_PARSER)
+        self.etag = self._reader.etag
+        if if_match:
+            etags = parse_entity_tags(if_match)
+            if self.etag not in etags and "*" not in etags:
+                raise PreconditionFailed(
+                    f"{self._resource_type}/{self._resource_id} has ETag {self.etag}"
+                )
+
+        with request_metrics.timer("Patch"):
+            # Resource is shared with the read cache
+            patched = apply_patch(deepcopy(self.resource), patch)
+        if (
+            not isinstance(patched, dict)
+            or patched.get("resourceType") != self._resource_type
+            or patched.get("id") != self._resource_id
+        ):
+            raise JsonPatchConflict("Patch cannot change resourceType or id")
+        return patched
@@ -1,8 +1,63 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
+import os
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from lib import request_metrics
 from lib.hl7_to_fhir import Hl7v2ToFhirConverter
+from lib.message_store import MessageStore
+
+# Maximum number of converted resources kept by the container (0 disables)
+READ_CACHE_SIZE = int(os.environ.get("READ_CACHE_SIZE", "128"))
+
+
+class ResourceCache(object):
+    """
+    Bounded LRU cache of converted resources keyed by store location and key.
+    Entries are validated with the message entity tag before they are used.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[Tuple[str, dict]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, etag: str, resource: dict) -> None:
+        if self._max_size <= 0:
+            return
+        self._entries[key] = (etag, resource)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+resource_cache = ResourceCache(READ_CACHE_SIZE)
+
+
+def parse_entity_tags(if_none_match: Optional[str]) -> set:
+    """
+    Returns entity tags listed in If-None-Match header, ignoring weak prefix
+    """
+    if not if_none_match:
+        return set()
+    etags = set()
+    for etag in if_none_match.split(","):
+        etag = etag.strip()
+        if etag.startswith("W/"):
+            etag = etag[2:]
+        if etag:
+            etags.add(etag)
+    return etags
 
 
 class FhirResourceReader(object):
@@ -10,21 +65,96 @@ class FhirResourceReader(object):
     Class representing FHIR resource reader
     """
 
-    def __init__(self, s3_bucket_name: str, path_parameters: dict) -> None:
-        self._s3_bucket_name = s3_bucket_name
+    def __init__(self, store: MessageStore, path_parameters: dict) -> None:
+        self._store = store
         self._path_parameters = path_parameters
         self._resource_type = self._path_parameters.get("resource_type")
         self._resource_id = self._path_parameters.get("id")
+        self.etag = None
+
+    def _get_hl7_message(
+        self, if_none_match: Optional[str] = None
+    ) -> Tuple[Optional[str], str]:
+        """
+        Returns HL7v2 message and its entity tag. Message is None if the
+        entity tag matches if_none_match.
+        """
+        key = f"{self._resource_type}/{self._resource_id}"
+        body, etag = self._store.get(key, if_none_match)
+        return (body.decode("utf-8") if body is not None else None, etag)
+
+    def read(
+        self, if_none_match: Optional[str] = None, elements: frozenset = None
+    ) -> Optional[dict]:
+        """
+        Returns FHIR resource, or None if its ETag is listed in if_none_match.
+        Only the top-level elements of a projection are converted if elements
+        is given. ETag of the resource is available in the etag attribute
+        after reading. Returned resources are shared with the cache and must
+        not be modified.
+        """
+        client_etags = parse_entity_tags(if_none_match)
+        # Projections of a resource, and resources read with another parser,
+        # are cached separately
+        cache_key = (
+            self._store.location,
+            self._resource_type,
+            self._resource_id,
+            elements,
+            None,
+        )
+        cached = resource_cache.get(cache_key)
+
+        if cached is not None:
+            conditional_etag = cached[0]
+        elif len(client_etags) == 1 and "*" not in client_etags:
+            conditional_etag = next(iter(client_etags))
+        else:
+            conditional_etag = None
+
+        with request_metrics.timer("Fetch"):
+            self._hl7msg, self.etag = self._get_hl7_message(conditional_etag)
+        if self._hl7msg is None:
+            resource = cached[1] if cached is not None else None
+        else:
+            request_metrics.record_message(self._hl7msg)
+            with request_metrics.timer("Convert"):
+                resource = Hl7v2ToFhirConverter(
+                    self._hl7msg,
+                    self._resource_type,
+                    self._resource_id,
+                    elements=elements,
+                ).transform()
+            resource_cache.put(cache_key, self.etag, resource)
 
-    def _get_hl7_from_s3(self) -> str:
-        s3 = boto3.resource("s3")
-        obj_key = f"{self._resource_type}/{self._resource_id}"
-        hl7obj = s3.Object(self._s3_bucket_name, obj_key)
-        return hl7obj.get()["Body"].read().decode("utf-8")
+        if self.etag in client_etags or "*" in client_etags:
+            return None
+        return resource
 
-    def read(self) -> str:
-        self._hl7msg = self._get_hl7_from_s3()
+    def read_message(self, parser: str = None) -> Tuple[str, dict]:
+        """
+        Returns HL7v2 message and FHIR resource, converted with parser (default
+        HL7_PARSER). ETag of the resource is available in the etag attribute
+        after reading. Returned resources are shared with the cache and must
+        not be modified.
+        """
+        cache_key = (
+            self._store.location,
+            self._resource_type,
+            self._resource_id,
+            None,
+            parser,
+        )
+        cached = resource_cache.get(cache_key)
 
-        return Hl7v2ToFhirConverter(
-            self._hl7msg, self._resource_type, self._resource_id
-        ).transform()
+        with request_metrics.timer("Fetch"):
+            self._hl7msg, self.etag = self._get_hl7_message()
+        request_metrics.record_message(self._hl7msg)
+        if cached is not None and cached[0] == self.etag:
+            return (self._hl7msg, cached[1])
+        with request_metrics.timer("Convert"):
+            resource = Hl7v2ToFhirConverter(
+                self._hl7msg, self._resource_type, self._resource_id, parser=parser
+            ).transform()
+        resource_cache.put(cache_key, self.etag, resource)
+        return (self._hl7msg, resource)
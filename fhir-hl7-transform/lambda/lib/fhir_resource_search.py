@@ -0,0 +1,126 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from urllib.parse import urlencode
+
+from lib import request_metrics
+from lib.fhir_projection import get_projection
+from lib.fhir_resource_reader import FhirResourceReader
+from lib.message_store import MessageNotFound, MessageStore
+from lib.search_index import SEARCH_PARAMETERS, SearchIndex, get_term
+
+# Number of resources per page when _count is not given, and its maximum
+SEARCH_DEFAULT_COUNT = int(os.environ.get("SEARCH_DEFAULT_COUNT", "20"))
+SEARCH_MAX_COUNT = int(os.environ.get("SEARCH_MAX_COUNT", "100"))
+
+
+class FhirResourceSearch(object):
+    """
+    Class representing FHIR search over resources in the search index
+    """
+
+    def __init__(
+        self,
+        store: MessageStore,
+        index: SearchIndex,
+        path_parameters: dict,
+        query_parameters: dict = None,
+    ) -> None:
+        self._store = store
+        self._index = index
+        self._resource_type = path_parameters.get("resource_type")
+        self._query_parameters = query_parameters or {}
+
+    def search(self) -> dict:
+        """
+        Returns searchset Bundle of resources matching all search parameters,
+        one page at a time. Raises ValueError for unsupported parameters.
+        """
+        supported = SEARCH_PARAMETERS.get(self._resource_type, [])
+        criteria = dict()
+        # Result parameters repeated in the links
+        projection_parameters = dict()
+        count = SEARCH_DEFAULT_COUNT
+        after = None
+        for name, value in self._query_parameters.items():
+            if name == "_count":
+                count = self._parse_count(value)
+            elif name in ("_elements", "_summary"):
+                projection_parameters[name] = value
+            elif name == "_page_token":
+                after = self._parse_page_token(value)
+            elif name in supported:
+                criteria[name] = value
+            else:
+                raise ValueError(
+                    f"Unsupported search parameter {name} for {self._resource_type}"
+                )
+        if not criteria:
+            raise ValueError(f"Search parameters supported: {', '.join(supported)}")
+        elements = get_projection(
+            self._resource_type,
+            projection_parameters.get("_elements"),
+            projection_parameters.get("_summary"),
+        )
+
+        terms = [
+            get_term(self._resource_type, name, value)
+            for name, value in sorted(criteria.items())
+        ]
+        # One more key tells whether there is a next page
+        with request_metrics.timer("Search"):
+            keys = self._index.search(terms, count + 1, after)
+        next_key = keys[count - 1] if len(keys) > count else None
+
+        entries = list()
+        for key in keys[:count]:
+            resource_id = key.partition("/")[2]
+            reader = FhirResourceReader(
+                self._store, dict(resource_type=self._resource_type, id=resource_id)
+            )
+            try:
+                resource = reader.read(elements=elements)
+            except MessageNotFound:
+                # Message was sent but is not stored by the HL7v2 system yet
+                continue
+            entries.append(
+                dict(fullUrl=key, resource=resource, search=dict(mode="match"))
+            )
+        request_metrics.put_metric("SearchMatches", len(entries), "Count")
+
+        parameters = dict(criteria, **projection_parameters)
+        link = [dict(relation="self", url=self._get_url(parameters, count, after))]
+        if next_key is not None:
+            link.append(
+                dict(relation="next", url=self._get_url(parameters, count, next_key))
+            )
+        return dict(resourceType="Bundle", type="searchset", link=link, entry=entries)
+
+    def _get_url(self, parameters: dict, count: int, after: str = None) -> str:
+        parameters = dict(parameters, _count=count)
+        if after is not None:
+            parameters["_page_token"] = (
+                urlsafe_b64encode(after.encode("utf-8")).decode("ascii").rstrip("=")
+            )
+        return f"{self._resource_type}?{urlencode(parameters)}"
+
+    def _parse_count(self, value: str) -> int:
+        try:
+            count = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid _count {value}") from None
+        if count < 1:
+            raise ValueError(f"Invalid _count {value}")
+        return min(count, SEARCH_MAX_COUNT)
+
+    def _parse_page_token(self, value: str) -> str:
+        # Page token is the last key of the previous page
+        try:
+            after = urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode("utf-8")
+        except ValueError:
+            raise ValueError("Invalid _page_token") from None
+        if not after.startswith(f"{self._resource_type}/"):
+            raise ValueError("Invalid _page_token")
+        return after
@@ -1,11 +1,43 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from typing import Tuple
+import logging
+import os
+from hashlib import md5, sha256
+from typing import Optional, Tuple
 from uuid import uuid4
 
+from lib import request_metrics
+from lib.content_hash_store import ContentHashStore
+from lib.fhir_canonical import FhirCanonicalConverter
 from lib.fhir_to_hl7 import FhirToHL7v2Converter
 from lib.hl7_to_fhir import Hl7v2ToFhirConverter
+from lib.search_index import SearchIndex, get_search_terms
+
+logger = logging.getLogger(__name__)
+
+# Source of the resource returned by write interactions: "message" parses the
+# HL7v2 message that was built, "mapping" maps the written resource to its
+# canonical form directly without parsing the message
+DEFAULT_RESPONSE_MODE = os.environ.get("WRITE_RESPONSE_MODE", "message")
+
+
+def get_etag(hl7v2_message: str) -> str:
+    # Entity tag is derived from content of the HL7v2 message
+    return '"{}"'.format(md5(hl7v2_message.encode("utf-8")).hexdigest())
+
+
+def get_content_hash(hl7v2_message: str) -> str:
+    # Content hash covers the whole message except message date/time (MSH-7)
+    # and message control ID (MSH-10), which are new for every message
+    msh, separator, segments = hl7v2_message.partition("\r")
+    fields = msh.split(msh[3])
+    # MSH-1 is the field separator itself, so MSH-n is at index n - 1
+    for index in [6, 9]:
+        if index < len(fields):
+            fields[index] = ""
+    content = msh[3].join(fields) + separator + segments
+    return sha256(content.encode("utf-8")).hexdigest()
 
 
 class FhirResourceWriter:
@@ -13,22 +45,110 @@ class FhirResourceWriter:
     Class representing FHIR resource writer
     """
 
-    def __init__(self, payload: dict, path_parameters: dict = None) -> None:
+    def __init__(
+        self,
+        payload: dict,
+        path_parameters: dict = None,
+        response_mode: str = None,
+        encoder: str = None,
+        hash_store: ContentHashStore = None,
+        search_index: SearchIndex = None,
+        previous: Tuple[str, dict] = None,
+    ) -> None:
         self._fhir_resource = payload
         self._path_parameters = path_parameters
+        self._response_mode = response_mode or DEFAULT_RESPONSE_MODE
+        self._encoder = encoder
+        # Messages of resources written with their id are deduplicated
+        self._hash_store = hash_store if path_parameters else None
+        self._search_index = search_index
+        # Message and resource the payload was changed from, if any
+        self._previous = previous
+        self.content_hash = None
+        self.search_terms = None
+        self.etag = None
+        # Set when the message equals the last one sent for the resource
+        self.unchanged = False
 
-    def write(self) -> (Tuple[str, str]):
+    @property
+    def resource_type(self) -> str:
+        return self._get_resource_type()
+
+    @property
+    def resource_id(self) -> str:
+        return self._fhir_resource.get("id")
+
+    def write(self, return_representation: bool = True) -> Tuple[str, Optional[dict]]:
         fhir_resource = self._set_resource_id()
         resource_type = self._get_resource_type()
         resource_id = fhir_resource.get("id")
-        message = FhirToHL7v2Converter(fhir_resource, resource_type).transform()
+        with request_metrics.timer("Encode"):
+            converter = FhirToHL7v2Converter(
+                fhir_resource, resource_type, self._encoder
+            )
+            if self._previous is not None:
+                message = converter.update(*self._previous)
+            else:
+                message = converter.transform()
+        if message is None:
+            raise ValueError(f"Unsupported resource type {resource_type}")
+        request_metrics.record_message(message)
+        self.etag = get_etag(message)
+        if self._hash_store is not None:
+            with request_metrics.timer("Dedupe"):
+                self._check_content_hash(message, f"{resource_type}/{resource_id}")
+        if self._search_index is not None:
+            self.search_terms = get_search_terms(fhir_resource)
 
-        fhir_resource = Hl7v2ToFhirConverter(
-            message, resource_type, resource_id
-        ).transform()
+        if not return_representation:
+            fhir_resource = None
+        elif self._response_mode == "mapping":
+            with request_metrics.timer("Reconvert"):
+                fhir_resource = FhirCanonicalConverter(
+                    fhir_resource, resource_type, resource_id
+                ).transform()
+        else:
+            with request_metrics.timer("Reconvert"):
+                fhir_resource = Hl7v2ToFhirConverter(
+                    message, resource_type, resource_id
+                ).transform()
 
         return (message, fhir_resource)
 
+    def record_sent(self) -> None:
+        """
+        Records content hash and search index terms of the message after it
+        was sent
+        """
+        if self.unchanged:
+            return
+        key = f"{self.resource_type}/{self.resource_id}"
+        if self._hash_store is not None:
+            try:
+                self._hash_store.put(key, self.content_hash, self.etag)
+            except Exception as exc:
+                logger.exception("Unable to record content hash", exc_info=exc)
+        if self._search_index is not None:
+            try:
+                with request_metrics.timer("Index"):
+                    self._search_index.put(key, self.search_terms)
+            except Exception as exc:
+                logger.exception("Unable to update search index", exc_info=exc)
+
+    def _check_content_hash(self, message: str, key: str) -> None:
+        self.content_hash = get_content_hash(message)
+        try:
+            stored = self._hash_store.get(key)
+        except Exception as exc:
+            # Message is sent when the store is unavailable
+            logger.exception("Unable to get content hash", exc_info=exc)
+            return
+        if stored is not None and stored[0] == self.content_hash:
+            self.unchanged = True
+            # Entity tag of the message that was sent before
+            self.etag = stored[1]
+            request_metrics.put_metric("Deduplicated", 1)
+
     def _get_resource_type(self) -> str:
         return self._fhir_resource.get("resourceType")
 
@@ -1,14 +1,44 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from lib.hl7_message_builder import create_adt_message
+import os
+from importlib import import_module
+
+# HL7v2 encoder backends: "hl7apy" builds and serializes an hl7apy message
+# tree, "er7" writes ER7 text directly from the FHIR resource. Backend modules
+# are imported on first use.
+ENCODERS = {
+    "hl7apy": "lib.hl7_message_builder",
+    "er7": "lib.er7_message_builder",
+}
+DEFAULT_ENCODER = os.environ.get("HL7_ENCODER", "hl7apy")
 
 
 class FhirToHL7v2Converter(object):
-    def __init__(self, fhir_resource: dict, resource_type: str) -> None:
+    def __init__(
+        self, fhir_resource: dict, resource_type: str, encoder: str = None
+    ) -> None:
         self._fhir_resource = fhir_resource
         self._resource_type = resource_type
+        self._encoder = import_module(ENCODERS[encoder or DEFAULT_ENCODER])
 
     def transform(self) -> str:
         if self._resource_type == "Patient":
-            return create_adt_message(self._fhir_resource)
+            return self._encoder.create_adt_message(self._fhir_resource)
+        elif self._resource_type == "Observation":
+            return self._encoder.create_oru_message(self._fhir_resource)
+
+    def update(self, hl7msg: str, previous_resource: dict) -> str:
+        """
+        Returns message for the resource, a changed version of
+        previous_resource that was read from hl7msg. Fields that are not read
+        back keep their values from hl7msg. The er7 encoder only encodes the
+        segments of changed elements again.
+        """
+        if self._resource_type == "Patient" and hasattr(
+            self._encoder, "update_adt_message"
+        ):
+            return self._encoder.update_adt_message(
+                hl7msg, previous_resource, self._fhir_resource
+            )
+        return self.transform()
@@ -0,0 +1,1155 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Declarative mapping between FHIR resources and HL7v2 messages.
+#
+# A message mapping lists the segments written for a resource and, for every
+# field, the FHIR element it holds and its HL7v2 datatype. Datatype mappings
+# map components to FHIR element paths. Mappings are compiled into Python
+# functions specialized for one HL7v2 backend ("er7" or "hl7apy") and one
+# direction ("encode" or "decode"): element paths, lookup tables and
+# positions are resolved when the source is generated, so the functions do
+# not interpret the mapping at run time. Backend modules compile the
+# mappings they use when they are imported.
+#
+# The "canonical" backend encodes FHIR resources into their canonical form,
+# the resource read back from the message written for them, without writing
+# or reading the message: values are encoded and decoded component by
+# component, and elements that are not mapped or not read back are dropped.
+#
+# Element paths are dotted FHIR element names; integers select list
+# elements and "n:" selects list elements from n on. Paths are read back by
+# appending to lists in component order, e.g. "line.0" and "line.1" read back
+# as one list.
+#
+# Message decode functions can be compiled for a projection, a set of
+# top-level FHIR elements: fields of other elements and repeated segments of
+# other elements are not read at all.
+#
+# Usage: python -m lib.hl7_mapping er7 decode ADT [--elements identifier,name]
+# (prints generated source)
+import argparse
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from typing import Callable, List
+
+BACKENDS = ["er7", "hl7apy", "canonical"]
+DIRECTIONS = ["encode", "decode"]
+
+# Lookup tables, FHIR values to HL7v2 codes and HL7v2 codes to FHIR values
+NAME_TYPE_CODES = dict(
+    usual="U",
+    official="L",
+    temp="U",
+    nickname="N",
+    anonymous="S",
+    old="U",
+    maiden="M",
+)
+NAME_TYPE_VALUES = dict(
+    U="usual",
+    L="official",
+    N="nickname",
+    S="anonymous",
+    M="maiden",
+)
+TELECOM_USE_CODES = dict(
+    home="PRN",
+    temp="TMP",
+    old="OLD",
+    mobile="MOB",
+    work="WPN",
+)
+TELECOM_USE_VALUES = {code: use for use, code in TELECOM_USE_CODES.items()}
+PERSONAL_TELECOM_USES = frozenset(["home", "temp", "old", "mobile", ""])
+RESULT_STATUS_CODES = {
+    "registered": "I",
+    "preliminary": "P",
+    "final": "F",
+    "amended": "C",
+    "corrected": "C",
+    "cancelled": "X",
+    "entered-in-error": "W",
+}
+RESULT_STATUS_VALUES = dict(
+    I="registered",
+    P="preliminary",
+    F="final",
+    C="corrected",
+    X="cancelled",
+    W="entered-in-error",
+)
+
+
+class Component(object):
+    """
+    Datatype component at position mapped to the FHIR element at path.
+    table maps FHIR values to HL7v2 codes and decode_table HL7v2 codes to
+    FHIR values. join joins the list elements of an "n:" path into one
+    component. The component is written when always is set, when the element
+    at present path exists, or when it has a value.
+    """
+
+    def __init__(
+        self,
+        position: int,
+        path: str,
+        table: dict = None,
+        decode_table: dict = None,
+        join: str = None,
+        always: bool = False,
+        present: str = None,
+    ) -> None:
+        self.position = position
+        self.path = _parse_path(path)
+        self.table = table
+        self.decode_table = decode_table
+        self.join = join
+        self.always = always
+        self.present = _parse_path(present) if present else None
+
+
+class Datatype(object):
+    """
+    Composite HL7v2 datatype
+    """
+
+    def __init__(self, name: str, components: List[Component]) -> None:
+        self.name = name
+        self.components = components
+
+
+class Field(object):
+    """
+    Field at position of a segment holding the FHIR element at path, relative
+    to the resource or to the list element of a repeated segment. Fields
+    with datatype hold composite values, other fields a single value. A
+    repeated field has one repetition for every element of the list at path
+    that where accepts; item is the path of the value within the element for
+    fields without datatype, read back into the list elements by position.
+    A field is written when always is set, when the element at present path
+    exists, or when it has a value. set_id fields hold the segment set ID.
+    Fields with decode unset are not read back.
+    """
+
+    def __init__(
+        self,
+        position: int,
+        path: str = None,
+        datatype: Datatype = None,
+        repeat: bool = False,
+        item: str = None,
+        where: Callable[[dict], bool] = None,
+        always: bool = False,
+        present: str = None,
+        set_id: bool = False,
+        decode: bool = True,
+    ) -> None:
+        self.position = position
+        self.path = _parse_path(path) if path else None
+        self.datatype = datatype
+        self.repeat = repeat
+        self.item = _parse_path(item) if item else None
+        self.where = where
+        self.always = always
+        self.present = _parse_path(present) if present else None
+        self.set_id = set_id
+        self.decode = decode
+
+
+class Segment(object):
+    """
+    Segment written once for the resource, or once for every element of the
+    list at path if repeat is set. A required segment must be present when
+    the message is read.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fields: List[Field],
+        path: str = None,
+        repeat: bool = False,
+        required: bool = False,
+    ) -> None:
+        self.name = name
+        self.fields = fields
+        self.path = _parse_path(path) if path else None
+        self.repeat = repeat
+        self.required = required
+
+
+class Message(object):
+    """
+    Message type (MSH-9) and message structure with its mapped segments
+    """
+
+    def __init__(
+        self, name: str, message_type: str, structure: str, segments: List[Segment]
+    ) -> None:
+        self.name = name
+        self.message_type = message_type
+        self.structure = structure
+        self.segments = segments
+
+
+def _parse_path(path: str) -> list:
+    parts = list()
+    for part in path.split("."):
+        if part.endswith(":"):
+            parts.append(slice(int(part[:-1]), None))
+        elif part.isdigit():
+            parts.append(int(part))
+        else:
+            parts.append(part)
+    return parts
+
+
+def _decoded(spec, elements: frozenset) -> bool:
+    # Fields and repeated segments are read back if their top-level element is
+    # in the projection
+    return elements is None or spec.path is None or spec.path[0] in elements
+
+
+def get_elements(message: Message) -> frozenset:
+    """
+    Returns top-level FHIR elements read back from the message
+    """
+    elements = set()
+    for segment in message.segments:
+        if segment.path is not None:
+            elements.add(segment.path[0])
+            continue
+        for field in segment.fields:
+            if field.decode and field.path is not None:
+                elements.add(field.path[0])
+    return frozenset(elements)
+
+
+def get_skipped_segments(message: Message, elements: frozenset) -> frozenset:
+    """
+    Returns names of segments that are not read for the projection
+    """
+    return frozenset(
+        segment.name
+        for segment in message.segments
+        if not segment.required and not _decoded(segment, elements)
+    )
+
+
+def has_identifier(identifier: dict) -> bool:
+    return bool(identifier.get("value", "") or identifier.get("type", {}))
+
+
+def has_district(address: dict) -> bool:
+    return bool(address.get("district"))
+
+
+def is_personal_telecom(telecom: dict) -> bool:
+    return bool(telecom.get("value", "")) and (
+        telecom.get("use", "") in PERSONAL_TELECOM_USES
+    )
+
+
+def is_work_telecom(telecom: dict) -> bool:
+    return bool(telecom.get("value", "")) and (
+        telecom.get("use", "") not in PERSONAL_TELECOM_USES
+    )
+
+
+# Datatypes
+
+CX = Datatype(
+    "CX",
+    [
+        Component(1, "value", always=True),
+        Component(4, "system", always=True),
+        Component(5, "type.coding.0.code", present="type.coding"),
+        Component(9, "assigner.display", present="assigner"),
+    ],
+)
+
+XPN = Datatype(
+    "XPN",
+    [
+        Component(1, "family", always=True),
+        Component(2, "given.0"),
+        Component(3, "given.1:", join=" "),
+        Component(5, "prefix.0", always=True),
+        Component(
+            7, "use", table=NAME_TYPE_CODES, decode_table=NAME_TYPE_VALUES, always=True
+        ),
+    ],
+)
+
+XAD = Datatype(
+    "XAD",
+    [
+        Component(1, "line.0"),
+        Component(2, "line.1"),
+        Component(3, "city", always=True),
+        Component(4, "state", always=True),
+        Component(5, "postalCode", always=True),
+        Component(6, "country", always=True),
+        Component(7, "use", always=True),
+    ],
+)
+
+XTN = Datatype(
+    "XTN",
+    [
+        Component(
+            2,
+            "use",
+            table=TELECOM_USE_CODES,
+            decode_table=TELECOM_USE_VALUES,
+            always=True,
+        ),
+        Component(12, "value", always=True),
+    ],
+)
+
+CE = Datatype(
+    "CE",
+    [
+        Component(1, "coding.0.code"),
+        Component(2, "coding.0.display"),
+        Component(3, "coding.0.system"),
+    ],
+)
+
+# Messages
+
+ADT = Message(
+    "ADT",
+    "ADT^A28^ADT_A05",
+    "ADT_A05",
+    [
+        Segment(
+            "PID",
+            [
+                Field(1, set_id=True),
+                Field(
+                    3, "identifier", CX, repeat=True, where=has_identifier, always=True
+                ),
+                Field(5, "name", XPN, repeat=True),
+                Field(7, "birthDate", always=True),
+                Field(8, "gender", always=True),
+                Field(11, "address", XAD, repeat=True),
+                Field(12, "address", repeat=True, item="district", where=has_district),
+                Field(13, "telecom", XTN, repeat=True, where=is_personal_telecom),
+                Field(14, "telecom", XTN, repeat=True, where=is_work_telecom),
+                Field(
+                    15,
+                    "communication",
+                    repeat=True,
+                    item="language.text",
+                    decode=False,
+                ),
+                Field(16, "maritalStatus.text", always=True, decode=False),
+            ],
+            required=True,
+        ),
+        Segment(
+            "NK1",
+            [
+                Field(1, set_id=True),
+                Field(2, "name", XPN),
+                Field(4, "address", XAD),
+                Field(5, "telecom", XTN, repeat=True, where=is_personal_telecom),
+                Field(6, "telecom", XTN, repeat=True, where=is_work_telecom),
+                Field(7, "relationship.0.coding.0.code", present="relationship"),
+            ],
+            path="contact",
+            repeat=True,
+        ),
+    ],
+)
+
+MAPPINGS = dict(ADT=ADT, CX=CX, XPN=XPN, XAD=XAD, XTN=XTN, CE=CE)
+
+
+# Compiler
+
+
+class _Source(object):
+    """
+    Generated source and the objects it refers to by name
+    """
+
+    def __init__(self, reads: Counter = None) -> None:
+        self.lines = list()
+        self.namespace = dict(_EMPTY={}, _NONE=(None,))
+        self.functions = set()
+        self.written = set()
+        # Number of reads of every element, known after the first pass
+        self.reads = Counter()
+        self._previous_reads = reads
+        self._indent = 0
+        self._names = dict()
+        self._counter = 0
+        self._elements = dict()
+        self._function = None
+
+    def line(self, text: str) -> None:
+        self.lines.append("    " * self._indent + text)
+
+    @contextmanager
+    def block(self, text: str):
+        self.line(text)
+        self._indent += 1
+        yield
+        self._indent -= 1
+
+    @contextmanager
+    def function(self, signature: str):
+        self._elements.clear()
+        self.written.clear()
+        self._function = signature
+        with self.block(f"def {signature}:"):
+            yield
+        self.line("")
+
+    def element(self, key: tuple, expression: str, reads: int = 1) -> str:
+        # Elements read more than once by encode functions are assigned to
+        # locals; they are read at the start of the function before any
+        # nested block
+        key = (self._function, key)
+        self.reads[key] += reads
+        if self._previous_reads is not None and self._previous_reads[key] < 2:
+            return expression
+        if key not in self._elements:
+            self._elements[key] = self.temp()
+            self.line(f"{self._elements[key]} = {expression}")
+        return self._elements[key]
+
+    def bind(self, value, prefix: str) -> str:
+        # Objects are referenced as globals of the generated functions
+        if id(value) not in self._names:
+            self._counter += 1
+            name = f"_{prefix}_{self._counter}"
+            self._names[id(value)] = name
+            self.namespace[name] = value
+        return self._names[id(value)]
+
+    def temp(self) -> str:
+        self._counter += 1
+        return f"_v{self._counter}"
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def _get(source: _Source, var: str, path: list, reads: int = 1) -> str:
+    # Expression of the element at path, None or empty if it does not exist.
+    # Elements of the function argument read more than once are read into
+    # locals.
+    expr = var
+    for index, part in enumerate(path):
+        if isinstance(part, str):
+            if index:
+                expr = f"({expr} or _EMPTY)"
+            expr = f"{expr}.get({part!r})"
+        elif isinstance(part, slice):
+            expr = f"({expr} or ())[{part.start}:]"
+        elif part == 0:
+            expr = f"({expr} or _NONE)[0]"
+        else:
+            index_function = source.bind(_index, "index")
+            expr = f"{index_function}({expr}, {part})"
+        if var == "element":
+            key = tuple(map(str, path[: index + 1]))
+            expr = source.element(key, expr, reads)
+    return expr
+
+
+def _index(items: list, index: int):
+    return items[index] if items and len(items) > index else None
+
+
+def _encoded_value(source: _Source, var: str, spec, escape: bool) -> str:
+    # Expression of the value written for a component or single value field
+    path = spec.item if isinstance(spec, Field) and spec.item else spec.path
+    value = _get(source, var, path)
+    if getattr(spec, "table", None) is not None:
+        return f"{source.bind(spec.table, 'table')}.get({value}, '')"
+    if getattr(spec, "join", None) is not None:
+        value = f"{spec.join!r}.join({value})"
+    else:
+        value = f"({value} or '')"
+    return f"escape({value})" if escape else value
+
+
+def _set(source: _Source, var: str, path: list, value: str, join: str = None):
+    # Writes statements that set the element at path to value, list indexes
+    # append when the list does not have the element yet. Elements of r that
+    # the function has not written before are assigned without lookups.
+    if var == "r" and path[0] not in source.written:
+        source.written.add(path[0])
+        source.line(f"r[{path[0]!r}] = {_literal(path[1:], value, join)}")
+        return
+    if var == "r":
+        source.written.add(path[0])
+    current = var
+    for index, part in enumerate(path[:-1]):
+        container = "{}" if isinstance(path[index + 1], str) else "[]"
+        target = source.temp()
+        if isinstance(part, str):
+            source.line(f"{target} = {current}.setdefault({part!r}, {container})")
+        else:
+            with source.block(f"if len({current}) > {part}:"):
+                source.line(f"{target} = {current}[{part}]")
+            with source.block("else:"):
+                source.line(f"{target} = {container}")
+                source.line(f"{current}.append({target})")
+        current = target
+    last = path[-1]
+    if isinstance(last, str):
+        source.line(f"{current}[{last!r}] = {value}")
+    elif isinstance(last, slice):
+        source.line(f"{current}.extend({value}.split({join!r}))")
+    else:
+        with source.block(f"if len({current}) > {last}:"):
+            source.line(f"{current}[{last}] = {value}")
+        with source.block("else:"):
+            source.line(f"{current}.append({value})")
+
+
+def _literal(path: list, value: str, join: str = None) -> str:
+    # Expression of new elements holding value at path
+    if not path:
+        return value
+    part = path[0]
+    if isinstance(part, str):
+        return f"{{{part!r}: {_literal(path[1:], value, join)}}}"
+    if isinstance(part, slice):
+        return f"{value}.split({join!r})"
+    return f"[{_literal(path[1:], value, join)}]"
+
+
+def _extend(source: _Source, path: list, items: str) -> None:
+    # Writes a statement that extends the list at path of r with items
+    if path[0] in source.written:
+        source.line(f"r.setdefault({path[0]!r}, []).extend({items})")
+    else:
+        source.written.add(path[0])
+        source.line(f"r[{path[0]!r}] = {items}")
+
+
+def _written(source: _Source, var: str, spec, value: str) -> str:
+    # Condition of a conditionally written component or field
+    if spec.present is not None:
+        return _get(source, var, spec.present)
+    return value
+
+
+def _function_name(direction: str, name: str) -> str:
+    return f"{direction}_{name.lower()}"
+
+
+def _generate_er7_encode_datatype(source: _Source, datatype: Datatype) -> str:
+    name = _function_name("encode", datatype.name)
+    if name in source.functions:
+        return name
+    source.functions.add(name)
+    with source.function(f"{name}(element)"):
+        source.line("element = element or _EMPTY")
+        size = max(component.position for component in datatype.components)
+        values = [repr("")] * size
+        last_always = 0
+        conditions = list()
+        for component in datatype.components:
+            var = f"c{component.position}"
+            value = _encoded_value(source, "element", component, False)
+            source.line(f"{var} = {value}")
+            values[component.position - 1] = var
+            if component.always:
+                last_always = component.position
+            else:
+                conditions.append(
+                    (component.position, _written(source, "element", component, var))
+                )
+        source.line(f"components = [{', '.join(values)}]")
+        # Components are only escaped one by one if any of them needs it
+        escape_required = "not escaped_characters.isdisjoint(''.join(components))"
+        with source.block(f"if {escape_required}:"):
+            source.line("components = [escape(c) for c in components]")
+        # Trailing components that are not written are left out
+        for position, condition in reversed(conditions):
+            if position > last_always:
+                with source.block(f"if {condition}:"):
+                    source.line(f"return '^'.join(components[:{position}])")
+        source.line(f"return '^'.join(components[:{last_always}])")
+    return name
+
+
+def _generate_er7_decode_datatype(source: _Source, datatype: Datatype) -> str:
+    name = _function_name("decode", datatype.name)
+    if name in source.functions:
+        return name
+    source.functions.add(name)
+    with source.function(f"{name}(components, unescape)"):
+        source.line("count = len(components)")
+        source.line("r = dict()")
+        for component in datatype.components:
+            index = component.position - 1
+            # Split fields have at least one component
+            with source.block(f"if count > {index}:") if index else nullcontext():
+                source.line(f"value = components[{index}]")
+                with source.block("if value:"):
+                    if component.decode_table is None:
+                        source.line("value = unescape(value)")
+                        _set(source, "r", component.path, "value", component.join)
+                    else:
+                        table = source.bind(component.decode_table, "table")
+                        source.line(f"value = {table}.get(unescape(value), '')")
+                        with source.block("if value:"):
+                            _set(source, "r", component.path, "value", component.join)
+        source.line("return r")
+    return name
+
+
+def _generate_hl7apy_encode_datatype(source: _Source, datatype: Datatype) -> str:
+    name = _function_name("encode", datatype.name)
+    if name in source.functions:
+        return name
+    source.functions.add(name)
+    with source.function(f"{name}(field, element)"):
+        source.line("element = element or _EMPTY")
+        for component in datatype.components:
+            attribute = f"field.{datatype.name}_{component.position}"
+            value = _encoded_value(source, "element", component, False)
+            if component.always:
+                source.line(f"{attribute} = {value}")
+            else:
+                source.line(f"value = {value}")
+                with source.block(
+                    f"if {_written(source, 'element', component, 'value')}:"
+                ):
+                    source.line(f"{attribute} = value")
+    return name
+
+
+def _generate_hl7apy_decode_datatype(source: _Source, datatype: Datatype) -> str:
+    name = _function_name("decode", datatype.name)
+    if name in source.functions:
+        return name
+    source.functions.add(name)
+    with source.function(f"{name}(field)"):
+        source.line("r = dict()")
+        for component in datatype.components:
+            value = f"field.{datatype.name}_{component.position}.value"
+            if component.decode_table is not None:
+                value = (
+                    f"{source.bind(component.decode_table, 'table')}.get({value}, '')"
+                )
+            source.line(f"value = {value}")
+            with source.block("if value:"):
+                _set(source, "r", component.path, "value", component.join)
+        source.line("return r")
+    return name
+
+
+def _generate_er7_encode_segment(source: _Source, segment: Segment) -> str:
+    name = _function_name("encode", segment.name)
+    # Datatype functions are generated before the segment function
+    encoders = {
+        field.position: _generate_er7_encode_datatype(source, field.datatype)
+        for field in segment.fields
+        if field.datatype
+    }
+    with source.function(f"{name}(element, set_id)"):
+        size = max(field.position for field in segment.fields)
+        source.line(f"fields = [''] * {size + 1}")
+        source.line(f"fields[0] = {segment.name!r}")
+        last_always = 0
+        conditions = list()
+        for field in segment.fields:
+            target = f"fields[{field.position}]"
+            if field.set_id:
+                source.line(f"{target} = str(set_id)")
+                last_always = max(last_always, field.position)
+                continue
+            if field.repeat:
+                where = (
+                    f" if {source.bind(field.where, 'where')}(e)" if field.where else ""
+                )
+                if field.datatype:
+                    value = f"{encoders[field.position]}(e)"
+                else:
+                    value = _encoded_value(source, "e", field, True)
+                items = f"({_get(source, 'element', field.path)} or ())"
+                source.line(f"{target} = '~'.join([{value} for e in {items}{where}])")
+                condition = target
+            elif field.datatype:
+                element = _get(source, "element", field.path, reads=3)
+                condition = element
+                with source.block(f"if {element}:"):
+                    source.line(f"{target} = {encoders[field.position]}({element})")
+            else:
+                source.line(
+                    f"{target} = {_encoded_value(source, 'element', field, True)}"
+                )
+                condition = _written(source, "element", field, target)
+            if field.always:
+                last_always = max(last_always, field.position)
+            else:
+                conditions.append((field.position, condition))
+        # Trailing fields that are not written are left out
+        for position, condition in reversed(conditions):
+            if position > last_always:
+                with source.block(f"if {condition}:"):
+                    source.line(f"return '|'.join(fields[:{position + 1}])")
+        source.line(f"return '|'.join(fields[:{last_always + 1}])")
+    return name
+
+
+def _generate_hl7apy_encode_segment(source: _Source, segment: Segment) -> str:
+    name = _function_name("encode", segment.name)
+    encoders = {
+        field.position: _generate_hl7apy_encode_datatype(source, field.datatype)
+        for field in segment.fields
+        if field.datatype
+    }
+    with source.function(f"{name}(segment, element, set_id)"):
+        for field in segment.fields:
+            field_name = f"{segment.name}_{field.position}"
+            if field.set_id:
+                source.line(f"segment.{field_name} = str(set_id)")
+            elif field.repeat:
+                items = f"({_get(source, 'element', field.path)} or ())"
+                with source.block(f"for e in {items}:"):
+                    if field.where:
+                        source.line(f"if not {source.bind(field.where, 'where')}(e):")
+                        source.line("    continue")
+                    if field.datatype:
+                        source.line(
+                            f"{encoders[field.position]}"
+                            f"(segment.add_field({field_name!r}), e)"
+                        )
+                    else:
+                        value = _encoded_value(source, "e", field, False)
+                        source.line(
+                            f"segment.add_field({field_name!r}).value = {value}"
+                        )
+            elif field.datatype:
+                element = _get(source, "element", field.path, reads=2)
+                with source.block(f"if {element}:"):
+                    source.line(
+                        f"{encoders[field.position]}"
+                        f"(segment.add_field({field_name!r}), {element})"
+                    )
+            else:
+                value = _encoded_value(source, "element", field, False)
+                if field.always:
+                    source.line(f"segment.{field_name} = {value}")
+                else:
+                    with source.block(
+                        f"if {_written(source, 'element', field, value)}:"
+                    ):
+                        source.line(f"segment.{field_name} = {value}")
+    return name
+
+
+def _decoded_fields(segment: Segment, elements: frozenset) -> List[Field]:
+    return [
+        field
+        for field in segment.fields
+        if field.decode and not field.set_id and _decoded(field, elements)
+    ]
+
+
+def _generate_er7_decode_segment(
+    source: _Source, segment: Segment, elements: frozenset = None
+) -> str:
+    name = _function_name("decode", segment.name)
+    fields = _decoded_fields(segment, elements)
+    decoders = {
+        field.position: _generate_er7_decode_datatype(source, field.datatype)
+        for field in fields
+        if field.datatype
+    }
+    with source.function(f"{name}(segment, r, unescape)"):
+        for field in fields:
+            if field.repeat and field.datatype:
+                source.line(f"repetitions = segment.repetitions({field.position})")
+                decoder = decoders[field.position]
+                items = (
+                    f"[{decoder}(components, unescape) for components in repetitions]"
+                )
+                with nullcontext() if field.always else source.block("if repetitions:"):
+                    _extend(source, field.path, items)
+            elif field.repeat:
+                # Values are read back into list elements by position
+                items = f"r[{field.path[0]!r}]"
+                with source.block(
+                    f"for index, value in enumerate(segment.values({field.position})):"
+                ):
+                    _set(source, f"{items}[index]", field.item, "value")
+            elif field.datatype:
+                source.line(f"repetitions = segment.repetitions({field.position})")
+                with source.block("if repetitions:"):
+                    decoder = decoders[field.position]
+                    value = f"{decoder}(repetitions[0], unescape)"
+                    _set(source, "r", field.path, value)
+            else:
+                source.line(f"value = segment.value({field.position})")
+                with source.block("if value:"):
+                    _set(source, "r", field.path, "value")
+        source.line("return r")
+    return name
+
+
+def _generate_hl7apy_decode_segment(
+    source: _Source, segment: Segment, elements: frozenset = None
+) -> str:
+    name = _function_name("decode", segment.name)
+    fields = _decoded_fields(segment, elements)
+    decoders = {
+        field.position: _generate_hl7apy_decode_datatype(source, field.datatype)
+        for field in fields
+        if field.datatype
+    }
+    with source.function(f"{name}(segment, r)"):
+        for field in fields:
+            field_name = f"{segment.name}_{field.position}"
+            if field.repeat and field.datatype:
+                source.line(f"repetitions = segment.{field_name}")
+                decoder = decoders[field.position]
+                items = f"[{decoder}(repetition) for repetition in repetitions]"
+                with nullcontext() if field.always else source.block("if repetitions:"):
+                    _extend(source, field.path, items)
+            elif field.repeat:
+                # Values are read back into list elements by position
+                items = f"r[{field.path[0]!r}]"
+                with source.block(
+                    f"for index, repetition in enumerate(segment.{field_name}):"
+                ):
+                    source.line("value = repetition.value")
+                    _set(source, f"{items}[index]", field.item, "value")
+            elif field.datatype:
+                source.line(f"repetitions = segment.{field_name}")
+                with source.block("if repetitions:"):
+                    decoder = decoders[field.position]
+                    _set(source, "r", field.path, f"{decoder}(repetitions[0])")
+            else:
+                source.line(f"value = segment.{field_name}.value")
+                with source.block("if value:"):
+                    _set(source, "r", field.path, "value")
+        source.line("return r")
+    return name
+
+
+def _may_be_empty(datatype: Datatype) -> bool:
+    # Datatypes without components that are always written encode to an empty
+    # value when no component is written
+    return not any(component.always for component in datatype.components)
+
+
+def _generate_canonical_encode_datatype(source: _Source, datatype: Datatype) -> str:
+    name = _function_name("encode", datatype.name)
+    if name in source.functions:
+        return name
+    source.functions.add(name)
+    with source.function(f"{name}(element)"):
+        source.line("element = element or _EMPTY")
+        conditions = list()
+        for component in datatype.components:
+            var = f"c{component.position}"
+            source.line(
+                f"{var} = {_encoded_value(source, 'element', component, False)}"
+            )
+            if not component.always:
+                conditions.append(_written(source, "element", component, var))
+        if _may_be_empty(datatype):
+            with source.block(f"if not ({' or '.join(conditions)}):"):
+                source.line("return None")
+        source.line("r = dict()")
+        for component in datatype.components:
+            var = f"c{component.position}"
+            with source.block(f"if {var}:"):
+                if component.decode_table is None:
+                    _set(source, "r", component.path, var, component.join)
+                else:
+                    table = source.bind(component.decode_table, "table")
+                    source.line(f"value = {table}.get({var}, '')")
+                    with source.block("if value:"):
+                        _set(source, "r", component.path, "value", component.join)
+        source.line("return r")
+    return name
+
+
+def _generate_canonical_encode_segment(source: _Source, segment: Segment) -> str:
+    name = _function_name("encode", segment.name)
+    fields = _decoded_fields(segment, None)
+    encoders = {
+        field.position: _generate_canonical_encode_datatype(source, field.datatype)
+        for field in fields
+        if field.datatype
+    }
+    with source.function(f"{name}(element, r)"):
+        for field in fields:
+            if field.repeat:
+                where = (
+                    f" if {source.bind(field.where, 'where')}(e)" if field.where else ""
+                )
+                if field.datatype:
+                    value = f"{encoders[field.position]}(e)"
+                else:
+                    value = _encoded_value(source, "e", field, False)
+                items = f"({_get(source, 'element', field.path)} or ())"
+                source.line(f"values = [{value} for e in {items}{where}]")
+            if field.repeat and field.datatype:
+                if _may_be_empty(field.datatype):
+                    # A single empty repetition is an empty field
+                    with source.block("if values == [None]:"):
+                        source.line("values = []")
+                    source.line("values = [{} if v is None else v for v in values]")
+                with nullcontext() if field.always else source.block("if values:"):
+                    _extend(source, field.path, "values")
+            elif field.repeat:
+                # Values are read back into list elements by position, a single
+                # empty value is an empty field
+                items = f"r[{field.path[0]!r}]"
+                with source.block("if values != ['']:"):
+                    with source.block("for index, value in enumerate(values):"):
+                        _set(source, f"{items}[index]", field.item, "value")
+            elif field.datatype:
+                element = _get(source, "element", field.path, reads=2)
+                value = f"{encoders[field.position]}({element})"
+                with source.block(f"if {element}:"):
+                    if _may_be_empty(field.datatype):
+                        source.line(f"value = {value}")
+                        with source.block("if value is not None:"):
+                            _set(source, "r", field.path, "value")
+                    else:
+                        _set(source, "r", field.path, value)
+            else:
+                value = _encoded_value(source, "element", field, False)
+                source.line(f"value = {value}")
+                with source.block("if value:"):
+                    _set(source, "r", field.path, "value")
+        source.line("return r")
+    return name
+
+
+def _generate_message(
+    source: _Source,
+    message: Message,
+    backend: str,
+    direction: str,
+    elements: frozenset = None,
+):
+    generate_segment = dict(
+        er7=dict(
+            encode=_generate_er7_encode_segment, decode=_generate_er7_decode_segment
+        ),
+        hl7apy=dict(
+            encode=_generate_hl7apy_encode_segment,
+            decode=_generate_hl7apy_decode_segment,
+        ),
+        canonical=dict(encode=_generate_canonical_encode_segment),
+    )[backend][direction]
+    if direction == "encode":
+        segment_functions = [
+            generate_segment(source, segment) for segment in message.segments
+        ]
+    else:
+        # Segments that are not read for the projection have no function.
+        # Fields of repeated segments hold parts of the segment element and
+        # are all read.
+        segment_functions = [
+            (
+                generate_segment(source, segment, None if segment.path else elements)
+                if _decoded(segment, elements)
+                else None
+            )
+            for segment in message.segments
+        ]
+    name = _function_name(direction, message.name)
+
+    if backend == "canonical":
+        # Repeated segments are written for every list element and read back
+        # into a list
+        with source.function(f"{name}(resource, r)"):
+            for segment, function in zip(message.segments, segment_functions):
+                if segment.repeat:
+                    source.line(f"elements = {_get(source, 'resource', segment.path)}")
+                    with source.block("if elements:"):
+                        items = f"[{function}(element, dict()) for element in elements]"
+                        _set(source, "r", segment.path, items)
+                else:
+                    source.line(f"{function}(resource, r)")
+            source.line("return r")
+        return name
+
+    if direction == "encode":
+        # er7 functions return segments, hl7apy functions add them to message
+        signature = "resource" if backend == "er7" else "message, resource"
+        with source.function(f"{name}({signature})"):
+            if backend == "er7":
+                source.line("segments = []")
+            for segment, function in zip(message.segments, segment_functions):
+                if backend == "er7":
+                    call = f"segments.append({function}(element, set_id))"
+                else:
+                    call = (
+                        f"{function}(message.add_segment({segment.name!r}), "
+                        "element, set_id)"
+                    )
+                if segment.repeat:
+                    items = f"({_get(source, 'resource', segment.path)} or ())"
+                    with source.block(f"for set_id, element in enumerate({items}, 1):"):
+                        source.line(call)
+                else:
+                    source.line("element, set_id = resource, 1")
+                    source.line(call)
+            if backend == "er7":
+                source.line("return segments")
+        return name
+
+    with source.function(f"{name}(message, r)"):
+        # er7 functions unescape values with the message encoding characters
+        arguments = ""
+        if backend == "er7":
+            source.line("unescape = message.unescape")
+            arguments = ", unescape"
+        for segment, function in zip(message.segments, segment_functions):
+            if function is None and not segment.required:
+                continue
+            if backend == "er7":
+                source.line(f"segments = message.segments({segment.name!r})")
+            else:
+                source.line(f"segments = message.{segment.name}")
+            if segment.required:
+                with source.block("if not segments:"):
+                    source.line(
+                        "raise ValueError("
+                        f"'Message does not contain {segment.name} segment')"
+                    )
+            if function is None:
+                continue
+            if segment.repeat:
+                with source.block("if segments:"):
+                    items = source.temp()
+                    source.line(f"{items} = []")
+                    with source.block("for segment in segments:"):
+                        source.line(
+                            f"{items}.append({function}(segment, dict(){arguments}))"
+                        )
+                    _set(source, "r", segment.path, items)
+            else:
+                with source.block("if segments:"):
+                    source.line(f"{function}(segments[0], r{arguments})")
+        source.line("return r")
+    return name
+
+
+def generate(
+    mapping, backend: str, direction: str, elements: frozenset = None
+) -> _Source:
+    """
+    Returns generated source of the function of a message or datatype mapping,
+    message decode functions optionally for a projection of elements
+    """
+    if backend not in BACKENDS or direction not in DIRECTIONS:
+        raise ValueError(f"Unknown backend {backend} or direction {direction}")
+    if backend == "canonical" and direction != "encode":
+        raise ValueError("The canonical backend only encodes")
+    if elements is not None and (
+        direction != "decode" or not isinstance(mapping, Message)
+    ):
+        raise ValueError("Projections apply to message decode functions only")
+    if isinstance(mapping, Message):
+        generate_function = partial(
+            _generate_message, backend=backend, direction=direction, elements=elements
+        )
+    else:
+        generate_function = dict(
+            er7=dict(
+                encode=_generate_er7_encode_datatype,
+                decode=_generate_er7_decode_datatype,
+            ),
+            hl7apy=dict(
+                encode=_generate_hl7apy_encode_datatype,
+                decode=_generate_hl7apy_decode_datatype,
+            ),
+            canonical=dict(encode=_generate_canonical_encode_datatype),
+        )[backend][direction]
+    # The first pass counts element reads, the second pass keeps elements
+    # read more than once in locals
+    source = _Source()
+    generate_function(source, mapping)
+    source = _Source(source.reads)
+    source.entry = generate_function(source, mapping)
+    return source
+
+
+def compile_mapping(
+    mapping, backend: str, direction: str, elements: frozenset = None, **namespace
+) -> Callable:
+    """
+    Compiles a message or datatype mapping into a function. Message decode
+    functions compiled for a projection only read back the top-level FHIR
+    elements in elements. ER7 encoders get the escape function and the set
+    of escaped characters in namespace. Signatures by backend and direction:
+
+    er7 encode: message (resource) -> segments, datatype (element) -> str
+    er7 decode: message (Er7Message, r) -> r,
+                datatype (components, unescape) -> dict
+    hl7apy encode: message (Message, resource), datatype (Field, element)
+    hl7apy decode: message (Message, r) -> r, datatype (Field) -> dict
+    canonical encode: message (resource, r) -> r,
+                      datatype (element) -> dict or None if empty
+    """
+    source = _compile(mapping, backend, direction, elements, namespace)
+    return source.namespace[source.entry]
+
+
+def compile_segments(
+    message: Message, backend: str, direction: str, **namespace
+) -> dict:
+    """
+    Compiles a message mapping and returns its segment functions by segment
+    name, e.g. to write single segments of a message. Encode signatures:
+
+    er7 encode: (element, set_id) -> str
+    hl7apy encode: (Segment, element, set_id)
+    """
+    source = _compile(message, backend, direction, None, namespace)
+    return {
+        segment.name: source.namespace[_function_name(direction, segment.name)]
+        for segment in message.segments
+    }
+
+
+def _compile(
+    mapping, backend: str, direction: str, elements: frozenset, namespace: dict
+) -> _Source:
+    source = generate(mapping, backend, direction, elements)
+    source.namespace.update(namespace)
+    code = compile(
+        source.text(), f"<hl7_mapping {mapping.name} {backend} {direction}>", "exec"
+    )
+    exec(code, source.namespace)
+    return source
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print generated mapping source")
+    parser.add_argument("backend", choices=BACKENDS)
+    parser.add_argument("direction", choices=DIRECTIONS)
+    parser.add_argument("mapping", choices=list(MAPPINGS))
+    parser.add_argument(
+        "--elements", help="comma separated projection of message decode functions"
+    )
+    args = parser.parse_args()
+    elements = frozenset(args.elements.split(",")) if args.elements else None
+    print(
+        generate(MAPPINGS[args.mapping], args.backend, args.direction, elements).text()
+    )
+
+
+if __name__ == "__main__":
+    main()
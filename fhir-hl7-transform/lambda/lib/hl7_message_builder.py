@@ -1,14 +1,20 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 from datetime import datetime
+from decimal import Decimal
 from uuid import uuid4
 
 from hl7apy import set_default_version as hl7_set_version
-from hl7apy.core import Field, Message, Segment
+from hl7apy.base_datatypes import ST
+from hl7apy.core import Message, Segment
+
+from lib.er7_message_builder import carry_adt_fields
+from lib.hl7_mapping import ADT, CE, RESULT_STATUS_CODES, compile_mapping
+
+hl7_set_version("2.5.1")
 
 
 def _create_hl7_message(message_name: str, message_type: str) -> Message:
-    hl7_set_version("2.5.1")
     m = Message(message_name)
     msg_datetime = datetime.now().strftime("%Y%m%d%H%M%S")
     m.MSH.MSH_7 = msg_datetime
@@ -21,137 +27,110 @@ def _create_hl7_message(message_name: str, message_type: str) -> Message:
 
 
 def create_adt_message(fhir_resource: dict) -> str:
-    m = _create_hl7_message("ADT_A05", "ADT^A28^ADT_A05")
-    m.PID = _create_pid_segment(fhir_resource)
-
-    if contact_list := fhir_resource.get("contact"):
-        for nk1_set_id, contact in enumerate(contact_list):
-            nk1 = m.add_segment("NK1")
-            _populate_nk1_segment(nk1, contact, nk1_set_id + 1)
+    m = _create_hl7_message(ADT.structure, ADT.message_type)
+    _encode_adt(m, fhir_resource)
 
     return m.to_er7()
 
 
-def _create_pid_segment(fhir_resource: dict) -> Segment:
-    pid = Segment("PID")
-    pid.PID_1 = str(1)
-
-    for id_ in fhir_resource.get("identifier"):
-        id_value = id_.get("value", "")
-        id_type = id_.get("type", {})
-
-        if any([id_value, id_type]):
-            pid_3 = pid.add_field("PID_3")
-            pid_3.PID_3_1 = id_value
-            pid_3.PID_3_4 = id_.get("system", "")
-            if id_type_coding := id_type.get("coding"):
-                pid_3.PID_3_5 = id_type_coding[0].get("code", "")
-
-            if assigner := id_.get("assigner"):
-                pid_3.PID_3_9 = assigner.get("display", "")
-
-    if name_list := fhir_resource.get("name"):
-        for name in name_list:
-            pid_5 = pid.add_field("PID_5")
-            _populate_name_field(pid_5, name)
-
-    pid.PID_7 = fhir_resource.get("birthDate", "")
-    pid.PID_8 = fhir_resource.get("gender", "")
-
-    if address_list := fhir_resource.get("address"):
-        for address in address_list:
-            pid_11 = pid.add_field("PID_11")
-            _populate_address_field(pid_11, address)
-            if address_county := address.get("district"):
-                pid_12 = pid.add_field("PID_12")
-                pid_12.value = address_county
-
-    if telecom_list := fhir_resource.get("telecom"):
-        _populate_telecom_fields(pid, "PID_13", "PID_14", telecom_list)
-
-    if patient_communication_list := fhir_resource.get("communication"):
-        for patient_communication in patient_communication_list:
-            pid_15 = pid.add_field("PID_15")
-            pid_15.value = patient_communication.get("language", {}).get("text", "")
-
-    pid.PID_16 = fhir_resource.get("maritalStatus", {}).get("text", "")
-
-    return pid
-
-
-def _populate_nk1_segment(nk1: Segment, contact: dict, set_id: int) -> None:
-    nk1.NK1_1 = str(set_id)
-    if name := contact.get("name"):
-        nk1_2 = Field("NK1_2")
-        _populate_name_field(nk1_2, name)
-        nk1.add(nk1_2)
-    if address := contact.get("address"):
-        nk1_4 = nk1.add_field("NK1_4")
-        _populate_address_field(nk1_4, address)
-    if telecom_list := contact.get("telecom"):
-        _populate_telecom_fields(nk1, "NK1_5", "NK1_6", telecom_list)
-    if relationship := contact.get("relationship"):
-        nk1.NK1_7 = relationship[0].get("coding", [""])[0].get("code", "")
-
-
-def _populate_name_field(name_field: Field, name: dict) -> None:
-    name_field.XPN_1 = name.get("family", "")
-    if given_name := name.get("given"):
-        name_field.XPN_2 = given_name[0]
-        if len(given_name) > 1:
-            name_field.XPN_3 = " ".join(given_name[1:])
-    name_field.XPN_5 = name.get("prefix", [""])[0]
-    name_field.XPN_7 = _get_name_type_code(name.get("use"))
-
-
-def _get_name_type_code(value: str) -> str:
-    mapping = dict(
-        usual="U",
-        official="L",
-        temp="U",
-        nickname="N",
-        anonymous="S",
-        old="U",
-        maiden="M",
-    )
-    return mapping.get(value, "")
-
-
-def _populate_address_field(address_field: Field, address: dict) -> None:
-    if address_line_list := address.get("line"):
-        address_field.XAD_1 = address_line_list[0]
-        if len(address_line_list) > 1:
-            address_field.XAD_2 = address_line_list[1]
-    address_field.XAD_3 = address.get("city", "")
-    address_field.XAD_4 = address.get("state", "")
-    address_field.XAD_5 = address.get("postalCode", "")
-    address_field.XAD_6 = address.get("country", "")
-    address_field.XAD_7 = address.get("use", "")
-
-
-def _populate_telecom_fields(
-    segment: Segment, personal_telecom: str, work_telecom: str, telecom_list
-) -> None:
-    for telecom in telecom_list:
-        telecom_type = telecom.get("use", "")
-        telecom_value = telecom.get("value", "")
-        if telecom_type in ["home", "temp", "old", "mobile", ""]:
-            telecom = personal_telecom
-        else:
-            telecom = work_telecom
-        if telecom_value:
-            telecom_field = Field(telecom)
-            telecom_field.XTN_2 = _get_telecom_use_code(telecom_type)
-            telecom_field.XTN_12 = telecom_value
-            segment.add(telecom_field)
-
-
-def _get_telecom_use_code(telecom_type: str) -> str:
-    mapping = dict(
-        home="PRN",
-        temp="TMP",
-        old="OLD",
-        mobile="MOB",
-        work="WPN",
-    )
-    return mapping.get(telecom_type, "")
+def update_adt_message(
+    hl7msg: str, previous_resource: dict, fhir_resource: dict
+) -> str:
+    """
+    Writes ADT message for fhir_resource, a changed version of
+    previous_resource that was read from hl7msg. The whole message is encoded
+    again, fields that are not read back keep their values from hl7msg unless
+    fhir_resource has their elements.
+    """
+    return carry_adt_fields(create_adt_message(fhir_resource), hl7msg, fhir_resource)
+
+
+def create_oru_message(fhir_resource: dict) -> str:
+    m = _create_hl7_message("ORU_R01", "ORU^R01^ORU_R01")
+    # Segments are serialized one at a time instead of adding every OBX
+    # segment to the message tree, which is slow for large results
+    segments = [m.MSH.to_er7()]
+    if patient_id := _get_subject_patient_id(fhir_resource):
+        pid = Segment("PID")
+        pid.PID_1 = str(1)
+        pid.PID_3.PID_3_1 = patient_id
+        pid.PID_3.PID_3_5 = "FW"
+        segments.append(pid.to_er7())
+
+    obr = Segment("OBR")
+    obr.OBR_1 = str(1)
+    obr.OBR_3.EI_1 = fhir_resource["id"]
+    obr.OBR_3.EI_2 = "FW"
+    _populate_coded_element(obr.OBR_4, fhir_resource.get("code"))
+    if effective_date_time := fhir_resource.get("effectiveDateTime"):
+        obr.OBR_7 = effective_date_time
+    segments.append(obr.to_er7())
+
+    status = RESULT_STATUS_CODES.get(fhir_resource.get("status"), "")
+    set_id = 0
+    # Observation value has the Observation code and no sub-ID
+    elements = [(fhir_resource, "")] + [
+        (component, str(sub_id))
+        for sub_id, component in enumerate(fhir_resource.get("component") or [], 1)
+    ]
+    for element, sub_id in elements:
+        obx = _create_obx_segment(set_id + 1, element, sub_id, status)
+        if obx is not None:
+            set_id += 1
+            segments.append(obx.to_er7())
+
+    return "\r".join(segments)
+
+
+def _get_subject_patient_id(fhir_resource: dict) -> str:
+    reference = (fhir_resource.get("subject") or {}).get("reference", "")
+    resource_type, _, resource_id = reference.partition("/")
+    return resource_id if resource_type == "Patient" else ""
+
+
+def _create_obx_segment(set_id: int, element: dict, sub_id: str, status: str):
+    # Returns None for elements without supported value
+    obx = Segment("OBX")
+    obx.OBX_1 = str(set_id)
+    # OBX-5 has variable data type, its value is escaped here
+    if (quantity := element.get("valueQuantity")) is not None:
+        obx.OBX_2 = "NM"
+        obx.OBX_5 = _format_number(quantity.get("value", ""))
+        if code := quantity.get("code"):
+            obx.OBX_6.CE_1 = code
+        if unit := quantity.get("unit"):
+            obx.OBX_6.CE_2 = unit
+        if system := quantity.get("system"):
+            obx.OBX_6.CE_3 = system
+    elif (string := element.get("valueString")) is not None:
+        obx.OBX_2 = "ST"
+        obx.OBX_5 = ST(string).to_er7()
+    elif (concept := element.get("valueCodeableConcept")) is not None:
+        obx.OBX_2 = "CE"
+        coding = (concept.get("coding") or [{}])[0]
+        obx.OBX_5 = "^".join(
+            ST(coding.get(name, "")).to_er7() for name in ["code", "display", "system"]
+        ).rstrip("^")
+    else:
+        return None
+    _populate_coded_element(obx.OBX_3, element.get("code"))
+    if sub_id:
+        obx.OBX_4 = sub_id
+    if status:
+        obx.OBX_11 = status
+
+    return obx
+
+
+def _format_number(value) -> str:
+    # NM values are written in decimal notation without exponent
+    if isinstance(value, float):
+        value = repr(value)
+        if "e" in value or "E" in value:
+            value = format(Decimal(value), "f")
+        return value
+    return str(value)
+
+
+_encode_adt = compile_mapping(ADT, "hl7apy", "encode")
+_populate_coded_element = compile_mapping(CE, "hl7apy", "encode")
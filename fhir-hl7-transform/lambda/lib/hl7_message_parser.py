@@ -1,152 +1,152 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from hl7apy.core import Field
-from hl7apy.parser import parse_message
-
+from functools import lru_cache
+
+from hl7apy.core import Segment
+from hl7apy.parser import parse_message, parse_segment
+
+from lib.er7_message_parser import iter_segments, parse_number
+from lib.fhir_projection import requests
+from lib.hl7_mapping import (
+    ADT,
+    CE,
+    RESULT_STATUS_VALUES,
+    compile_mapping,
+    get_elements,
+    get_skipped_segments,
+)
+
+
+def parse_oru_message(hl7msg: str, r: dict, elements: frozenset = None) -> dict:
+    # Results can have thousands of OBX segments, so segments are parsed one
+    # at a time in a single pass instead of parsing the whole message tree
+    encoding_chars = dict(
+        FIELD=hl7msg[3],
+        COMPONENT=hl7msg[4],
+        REPETITION=hl7msg[5],
+        ESCAPE=hl7msg[6],
+        SUBCOMPONENT=hl7msg[7],
+        GROUP="\r",
+        SEGMENT="\r",
+    )
+    segments = iter_segments(hl7msg)
+    msh_fields = next(segments, "").split(encoding_chars["FIELD"])
+    version = msh_fields[11] if len(msh_fields) > 11 else None
+    # OBX segments hold status, value and components, PID the subject
+    read_results = any(
+        requests(elements, element) for element in ("status", "value", "component")
+    )
+    read_subject = requests(elements, "subject")
+    order_code = None
+    value_found = False
+    component_list = list()
+    for raw_segment in segments:
+        name = raw_segment[:3]
+        if name == "OBX" and not read_results:
+            # OBX segments follow OBR and PID
+            break
+        if name not in ("OBX", "OBR") and (name != "PID" or not read_subject):
+            continue
+        segment = parse_segment(
+            raw_segment, version=version, encoding_chars=encoding_chars
+        )
+        if name == "OBX":
+            obx = segment
+            if "status" not in r:
+                if status := RESULT_STATUS_VALUES.get(obx.OBX_11.value):
+                    r["status"] = status
+            code = obx.OBX_3.CE_1.value
+            # Observation value has the code of the order and no sub-ID
+            if not value_found and code == order_code and not obx.OBX_4.value:
+                value_found = True
+                _parse_observation_value(obx, r)
+            else:
+                component = dict()
+                if coded_element := _parse_coded_element(obx.OBX_3):
+                    component["code"] = coded_element
+                component_list.append(_parse_observation_value(obx, component))
+        elif name == "OBR" and order_code is None:
+            obr = segment
+            order_code = obr.OBR_4.CE_1.value
+            if coded_element := _parse_coded_element(obr.OBR_4):
+                r["code"] = coded_element
+            if effective_date_time := obr.OBR_7.value:
+                r["effectiveDateTime"] = effective_date_time
+        elif name == "PID" and "subject" not in r:
+            for pid_3 in segment.PID_3:
+                if pid_3.PID_3_5.value == "FW":
+                    patient_id = pid_3.PID_3_1.value
+                    r["subject"] = dict(reference=f"Patient/{patient_id}")
+                    break
+
+    if component_list:
+        r["component"] = component_list
 
-def parse_oru_message(hl7msg: str, r: dict) -> dict:
-    # This function will be implemented in the next release
     return r
 
 
-def parse_adt_message(hl7msg: str, r: dict) -> dict:
+def _parse_observation_value(obx: Segment, element: dict) -> dict:
+    value_type = obx.OBX_2.value
+    # OBX-5 has variable data type, components are read by position
+    value_components = [component.value for component in obx.OBX_5.children]
+    value = value_components[0] if value_components else obx.OBX_5.value
+    if value_type == "NM":
+        quantity = dict()
+        if value:
+            try:
+                quantity["value"] = parse_number(value)
+            except ValueError:
+                element["valueString"] = value
+                return element
+        if unit := obx.OBX_6.CE_2.value:
+            quantity["unit"] = unit
+        if system := obx.OBX_6.CE_3.value:
+            quantity["system"] = system
+        if code := obx.OBX_6.CE_1.value:
+            quantity["code"] = code
+        if quantity:
+            element["valueQuantity"] = quantity
+    elif value_type in ("CE", "CWE"):
+        value_components = value_components or [value]
+        value_components.extend([""] * (3 - len(value_components)))
+        coding = dict()
+        if system := value_components[2]:
+            coding["system"] = system
+        if code := value_components[0]:
+            coding["code"] = code
+        if display := value_components[1]:
+            coding["display"] = display
+        if coding:
+            element["valueCodeableConcept"] = dict(coding=[coding])
+    elif value:
+        element["valueString"] = value
+    return element
+
+
+def parse_adt_message(hl7msg: str, r: dict, elements: frozenset = None) -> dict:
+    if elements is None or _ADT_ELEMENTS <= elements:
+        decode_adt = _decode_adt
+    else:
+        elements = elements & _ADT_ELEMENTS
+        decode_adt = _compile_adt_projection(elements)
+        # Segments that are not read are not parsed into the message tree
+        if skipped := get_skipped_segments(ADT, elements):
+            hl7msg = "\r".join(
+                segment
+                for segment in iter_segments(hl7msg)
+                if segment[:3] not in skipped
+            )
     m = parse_message(hl7msg, find_groups=False)
+    return decode_adt(m, r)
 
-    identifier_list = list()
-    for pid_3 in m.PID.PID_3:
-        identifier_element = {}
-        if value := pid_3.PID_3_1.value:
-            identifier_element["value"] = value
-        if system := pid_3.PID_3_4.value:
-            identifier_element["system"] = system
-        if code := pid_3.PID_3_5.value:
-            identifier_element["type"] = dict(coding=[dict(code=code)])
-        if assigner := pid_3.PID_3_9.value:
-            identifier_element["assigner"] = dict(display=assigner)
-        identifier_list.append(identifier_element)
-    r["identifier"] = identifier_list
-
-    if pid_5 := m.PID.PID_5:
-        r["name"] = list()
-        for pid_5_rep in pid_5:
-            r["name"].append(_parse_name_field(pid_5_rep))
-
-    if birth_date := m.PID.PID_7.value:
-        r["birthDate"] = birth_date
-
-    if gender := m.PID.PID_8.value:
-        r["gender"] = gender
-
-    if pid_11 := m.PID.PID_11:
-        r["address"] = list()
-        for pid_11_rep in pid_11:
-            r["address"].append(_parse_address_field(pid_11_rep))
-
-    if pid_12 := m.PID.PID_12:
-        for rep, address_county in enumerate(pid_12):
-            r["address"][rep]["district"] = address_county.value
-
-    pid_13, pid_14 = m.PID.PID_13, m.PID.PID_14
-    if pid_13 or pid_14:
-        r["telecom"] = _parse_telecom_fields(pid_13, pid_14)
-
-    if m.NK1:
-        # parse NK1 segments
-        contact_list = list()
-        for nk1 in m.NK1:
-            contact = dict()
-            if nk1_2 := nk1.NK1_2:
-                contact["name"] = _parse_name_field(nk1_2)
-            if nk1_4 := nk1.NK1_4:
-                contact["address"] = _parse_address_field(nk1_4)
-            nk1_5, nk1_6 = nk1.NK1_5, nk1.NK1_6
-            if nk1_5 or nk1_6:
-                contact["telecom"] = _parse_telecom_fields(nk1_5, nk1_6)
-            if nk1_7 := nk1.NK1_7.value:
-                contact["relationship"] = [dict(coding=[dict(code=nk1_7)])]
-            contact_list.append(contact)
-        r["contact"] = contact_list
-
-    return r
 
+@lru_cache(maxsize=None)
+def _compile_adt_projection(elements: frozenset):
+    # One function for every projection, bounded by subsets of mapped elements
+    return compile_mapping(ADT, "hl7apy", "decode", elements)
 
-def _parse_telecom_fields(
-    personal_telecom_field: Field, work_telecom_field: Field
-) -> list:
-    telecom_list = list()
-    for field in [personal_telecom_field, work_telecom_field]:
-        if field:
-            for rep in field:
-                t = dict()
-                if use_value := _get_telecom_use_value(rep.XTN_2.value):
-                    t["use"] = use_value
-                if value := rep.XTN_12.value:
-                    t["value"] = value
-                telecom_list.append(t)
 
-    return telecom_list
-
-
-def _get_telecom_use_value(use_code: str) -> str:
-    mapping = dict(
-        PRN="home",
-        TMP="temp",
-        OLD="old",
-        MOB="mobile",
-        WPN="work",
-    )
-    return mapping.get(use_code, "")
-
-
-def _parse_name_field(name_field: Field) -> list:
-    name_entry = dict()
-    if family_name := name_field.XPN_1.value:
-        name_entry["family"] = family_name
-    given_name = list()
-    if first_given_name := name_field.XPN_2.value:
-        given_name.append(first_given_name)
-    if other_given_names := name_field.XPN_3.value:
-        for given_name_component in other_given_names.split(" "):
-            given_name.append(given_name_component)
-    if given_name:
-        name_entry["given"] = given_name
-    if prefix := name_field.XPN_5.value:
-        name_entry["prefix"] = [prefix]
-    if use := _get_name_type_value(name_field.XPN_7.value):
-        name_entry["use"] = use
-    return name_entry
-
-
-def _parse_address_field(address_field: Field) -> list:
-    address_list_entry = dict()
-    address_line = list()
-    if first_address_line := address_field.XAD_1.value:
-        address_line.append(first_address_line)
-    if second_address_line := address_field.XAD_2.value:
-        address_line.append(second_address_line)
-    if address_line:
-        address_list_entry["line"] = address_line
-    if city := address_field.XAD_3.value:
-        address_list_entry["city"] = city
-    if state := address_field.XAD_4.value:
-        address_list_entry["state"] = state
-    if postal_code := address_field.XAD_5.value:
-        address_list_entry["postalCode"] = postal_code
-    if country := address_field.XAD_6.value:
-        address_list_entry["country"] = country
-    if use := address_field.XAD_7.value:
-        address_list_entry["use"] = use
-
-    return address_list_entry
-
-
-def _get_name_type_value(value: str) -> str:
-    mapping = dict(
-        U="usual",
-        L="official",
-        N="nickname",
-        S="anonymous",
-        M="maiden",
-    )
-    return mapping.get(value, "")
+_ADT_ELEMENTS = get_elements(ADT)
+_decode_adt = compile_mapping(ADT, "hl7apy", "decode")
+_parse_coded_element = compile_mapping(CE, "hl7apy", "decode")
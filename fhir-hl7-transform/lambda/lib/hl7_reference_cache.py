@@ -0,0 +1,224 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Prebuilt cache of the hl7apy reference structures used by the HL7v2 mapping.
+#
+# hl7apy imports its whole HL7 2.5.1 reference library (all messages,
+# segments, fields, datatypes and tables) the first time it builds or parses
+# a message. The structures the mapping actually uses are recorded at build
+# time (python -m lib.hl7_reference_cache) and pickled next to this module.
+# install() registers a lightweight stand-in for the hl7apy library module
+# that serves lookups from the pickle and loads the full library only when
+# a structure that was not recorded is requested.
+import importlib
+import os
+import pickle
+import sys
+import types
+
+HL7_VERSION = "2.5.1"
+CACHE_FILE = os.path.join(os.path.dirname(__file__), "hl7apy_reference_cache.pickle")
+
+_BASE_DATATYPES = (
+    "ST",
+    "ID",
+    "DT",
+    "DTM",
+    "FT",
+    "GTS",
+    "IS",
+    "NM",
+    "SI",
+    "TM",
+    "TX",
+    "WD",
+)
+
+# Patient resource populating every element of the ADT mapping, used to record
+# reference structures and to warm up converters
+SAMPLE_PATIENT = {
+    "resourceType": "Patient",
+    "id": "warm-up",
+    "identifier": [
+        {
+            "value": "warm-up",
+            "system": "urn:oid:1.2.36.146.595.217.0.1",
+            "type": {"coding": [{"code": "FW"}]},
+            "assigner": {"display": "FHIR Works on AWS Integration Transform"},
+        }
+    ],
+    "name": [{"family": "Doe", "given": ["John", "A"], "prefix": ["Mr"]}],
+    "birthDate": "1974-12-25",
+    "gender": "male",
+    "address": [
+        {
+            "line": ["534 Erewhon St", "Apt 3-A"],
+            "city": "PleasantVille",
+            "state": "Vic",
+            "postalCode": "3999",
+            "country": "AU",
+            "use": "home",
+            "district": "Rainbow",
+        }
+    ],
+    "telecom": [
+        {"use": "home", "value": "(03) 5555 6473"},
+        {"use": "work", "value": "(03) 5555 8834"},
+    ],
+    "communication": [{"language": {"text": "English"}}],
+    "maritalStatus": {"text": "M"},
+    "contact": [
+        {
+            "name": {"family": "Doe", "given": ["Jane"]},
+            "address": {"line": ["534 Erewhon St"], "city": "PleasantVille"},
+            "telecom": [
+                {"use": "home", "value": "(03) 5555 6473"},
+                {"use": "work", "value": "(03) 5555 8834"},
+            ],
+            "relationship": [{"coding": [{"code": "N"}]}],
+        }
+    ],
+}
+
+# Observation resource populating every element of the ORU mapping
+SAMPLE_OBSERVATION = {
+    "resourceType": "Observation",
+    "id": "warm-up",
+    "status": "final",
+    "subject": {"reference": "Patient/warm-up"},
+    "code": {
+        "coding": [
+            {
+                "system": "http://loinc.org",
+                "code": "85354-9",
+                "display": "Blood pressure panel",
+            }
+        ]
+    },
+    "effectiveDateTime": "2020-01-01T10:00:00Z",
+    "valueString": "Normal",
+    "component": [
+        {
+            "code": {"coding": [{"system": "http://loinc.org", "code": "8480-6"}]},
+            "valueQuantity": {
+                "value": 107,
+                "unit": "mmHg",
+                "system": "http://unitsofmeasure.org",
+                "code": "mm[Hg]",
+            },
+        },
+        {
+            "code": {"coding": [{"code": "interpretation"}]},
+            "valueCodeableConcept": {"coding": [{"code": "N", "display": "Normal"}]},
+        },
+    ],
+}
+
+
+def install(cache_file: str = CACHE_FILE) -> bool:
+    """
+    Serves hl7apy reference structures from the cache file. Returns False if
+    the cache file does not exist or the hl7apy library is already loaded.
+    """
+    import hl7apy
+
+    module_name = hl7apy.SUPPORTED_LIBRARIES[HL7_VERSION]
+    if module_name in sys.modules or not os.path.exists(cache_file):
+        return False
+
+    with open(cache_file, "rb") as f:
+        found, not_found = pickle.load(f)
+    sys.modules[module_name] = _create_library_module(module_name, found, not_found)
+    return True
+
+
+def _create_library_module(
+    module_name: str, found: dict, not_found: dict
+) -> types.ModuleType:
+    from hl7apy.exceptions import ChildNotFound
+
+    module = types.ModuleType(module_name)
+    base_datatypes_module = importlib.import_module("hl7apy.base_datatypes")
+    base_datatypes = {
+        name: getattr(base_datatypes_module, name) for name in _BASE_DATATYPES
+    }
+
+    def _load_full_library():
+        # Replace this module with the full library for all further lookups
+        del sys.modules[module_name]
+        return importlib.import_module(module_name)
+
+    def get(name, element_type):
+        try:
+            return found[element_type][name]
+        except KeyError:
+            pass
+        if name in not_found.get(element_type, ()):
+            raise ChildNotFound(name)
+        return _load_full_library().get(name, element_type)
+
+    def find(name, where):
+        for cls in where:
+            try:
+                return {"ref": get(name, cls.__name__), "name": name, "cls": cls}
+            except ChildNotFound:
+                pass
+        raise ChildNotFound(name)
+
+    def is_base_datatype(datatype):
+        return datatype in base_datatypes
+
+    def get_base_datatypes():
+        return base_datatypes
+
+    module.get = get
+    module.find = find
+    module.is_base_datatype = is_base_datatype
+    module.get_base_datatypes = get_base_datatypes
+    return module
+
+
+def build(cache_file: str = CACHE_FILE) -> None:
+    """
+    Records reference structures used to build and parse the sample messages
+    with the full hl7apy library and writes them to the cache file
+    """
+    import hl7apy
+
+    library = hl7apy.load_library(HL7_VERSION)
+    found, not_found = dict(), dict()
+
+    class _RecordingDict(dict):
+        def __init__(self, element_type: str, elements: dict) -> None:
+            super().__init__(elements)
+            self._element_type = element_type
+
+        def __getitem__(self, name):
+            try:
+                ref = super().__getitem__(name)
+            except KeyError:
+                not_found.setdefault(self._element_type, set()).add(name)
+                raise
+            found.setdefault(self._element_type, dict())[name] = ref
+            return ref
+
+    elements = dict(library.ELEMENTS)
+    try:
+        for element_type, element_refs in elements.items():
+            library.ELEMENTS[element_type] = _RecordingDict(element_type, element_refs)
+
+        from lib.hl7_message_builder import create_adt_message, create_oru_message
+        from lib.hl7_message_parser import parse_adt_message, parse_oru_message
+
+        parse_adt_message(create_adt_message(SAMPLE_PATIENT), dict())
+        parse_oru_message(create_oru_message(SAMPLE_OBSERVATION), dict())
+    finally:
+        library.ELEMENTS.update(elements)
+
+    with open(cache_file, "wb") as f:
+        pickle.dump((found, not_found), f, protocol=4)
+
+
+if __name__ == "__main__":
+    build()
+    print(f"Wrote hl7apy reference cache to {CACHE_FILE}")
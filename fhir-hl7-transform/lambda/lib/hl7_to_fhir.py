@@ -1,7 +1,19 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from lib.hl7_message_parser import parse_adt_message, parse_oru_message
+import os
+from importlib import import_module
+
+from lib.fhir_projection import project
+
+# HL7v2 parser backends: "hl7apy" parses the whole message into an hl7apy
+# message tree, "er7" splits the message lazily and decodes only mapped values.
+# Backend modules are imported on first use.
+PARSERS = {
+    "hl7apy": "lib.hl7_message_parser",
+    "er7": "lib.er7_message_parser",
+}
+DEFAULT_PARSER = os.environ.get("HL7_PARSER", "hl7apy")
 
 
 class Hl7v2ToFhirConverter(object):
@@ -9,20 +21,33 @@ class Hl7v2ToFhirConverter(object):
     This class converts HL7v2 messages to FHIR resource format using JSON
     """
 
-    def __init__(self, hl7msg: str, resource_type: str, resource_id: str) -> None:
+    def __init__(
+        self,
+        hl7msg: str,
+        resource_type: str,
+        resource_id: str,
+        parser: str = None,
+        elements: frozenset = None,
+    ) -> None:
         self._hl7msg = hl7msg
         self._resource_type = resource_type
         self._resource_id = resource_id
+        self._parser = import_module(PARSERS[parser or DEFAULT_PARSER])
+        # Projection of top-level elements (lib.fhir_projection), None for
+        # the whole resource
+        self._elements = elements
 
     def transform(self) -> dict:
         r = dict()
         r["resourceType"] = self._resource_type
         r["id"] = self._resource_id
         if self._resource_type == "Patient":
-            resource = parse_adt_message(self._hl7msg, r)
+            resource = self._parser.parse_adt_message(self._hl7msg, r, self._elements)
         elif self._resource_type == "Observation":
-            resource = parse_oru_message(self._hl7msg, r)
+            resource = self._parser.parse_oru_message(self._hl7msg, r, self._elements)
         else:
             return {}
 
+        if self._elements is not None:
+            resource = project(resource, self._elements)
         return resource
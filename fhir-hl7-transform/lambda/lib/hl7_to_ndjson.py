@@ -0,0 +1,286 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Converts HL7v2 messages from HL7 batch files (FHS/BHS ... BTS/FTS) or
+# MLLP-framed captures to FHIR resources in NDJSON files, one file per
+# resource type (e.g. Patient.ndjson), as in FHIR Bulk Data exports. Input is
+# read in fixed-size blocks and split into messages at MSH segments, so files
+# of any size can be converted. Chunks of messages are converted on a process
+# pool with a bounded number of chunks in flight, and resources are written
+# in input order. Patient ids are read from the FW identifier in PID-3, as
+# written by the transform, or the first PID-3 identifier, and Observation ids
+# from the OBR-3 filler order number.
+#
+# Usage: python -m lib.hl7_to_ndjson patients.hl7 output-directory
+#            [--workers 4] [--chunk-size 500] [--parser er7] [--errors errors.ndjson]
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Callable, Iterator, List, TextIO, Tuple
+
+from lib.er7_message_parser import Er7Message
+from lib.hl7_to_fhir import DEFAULT_PARSER, Hl7v2ToFhirConverter
+from lib.ndjson_to_hl7 import ConversionStats, iter_chunks
+
+logger = logging.getLogger(__name__)
+
+# Resource type by message type (MSH-9.1)
+RESOURCE_TYPES = dict(ADT="Patient", ORU="Observation")
+
+# Segment separators, MLLP block characters separate segments of
+# consecutive messages
+_SEGMENT_SEPARATORS = re.compile(rb"[\r\n\x0b\x1c]+")
+_BATCH_SEGMENTS = (b"FHS", b"BHS", b"BTS", b"FTS")
+
+
+def read_messages(input_file: BinaryIO, block_size: int = 1 << 16) -> Iterator[bytes]:
+    """
+    Yields messages of an HL7 batch file or MLLP-framed capture as ER7 bytes
+    with segments separated by carriage returns. Segments before the first
+    MSH segment are yielded as a message of their own, so they are reported
+    as a conversion failure instead of being dropped.
+    """
+    segments = []
+    tail = b""
+    while True:
+        block = input_file.read(block_size)
+        parts = _SEGMENT_SEPARATORS.split(tail + block)
+        # Last part may continue in the next block
+        tail = parts.pop() if block else b""
+        for segment in parts:
+            if not segment.strip():
+                continue
+            name = segment[:3]
+            if name == b"MSH" or name in _BATCH_SEGMENTS:
+                if segments:
+                    yield b"\r".join(segments)
+                segments = [segment] if name == b"MSH" else []
+            else:
+                segments.append(segment)
+        if not block:
+            break
+    if segments:
+        yield b"\r".join(segments)
+
+
+def get_resource_type(message: Er7Message) -> str:
+    msh = message.segment("MSH")
+    message_type = ""
+    if msh_9 := msh.repetitions(9):
+        message_type = msh.component(msh_9[0], 1)
+    if resource_type := RESOURCE_TYPES.get(message_type):
+        return resource_type
+    raise ValueError(f"Unsupported message type {message_type}")
+
+
+def get_resource_id(message: Er7Message, resource_type: str) -> str:
+    if resource_type == "Observation":
+        # OBR-3 filler order number, as written by the transform
+        obr = message.segment("OBR")
+        if obr and (obr_3 := obr.repetitions(3)):
+            if value := obr.component(obr_3[0], 1):
+                return value
+        raise ValueError("Unable to get resource ID from the message")
+
+    pid = message.segment("PID")
+    pid_3 = pid.repetitions(3) if pid else []
+    for rep in pid_3:
+        if pid.component(rep, 5) == "FW" and (value := pid.component(rep, 1)):
+            return value
+    if pid_3 and (value := pid.component(pid_3[0], 1)):
+        return value
+    raise ValueError("Unable to get resource ID from the message")
+
+
+def convert_messages(
+    messages: List[bytes],
+    first_message_number: int,
+    parser: str = None,
+    encoding: str = "utf-8",
+) -> Tuple[List[Tuple[str, str]], List[Tuple[int, str, str]]]:
+    """
+    Converts messages and returns (resource type, NDJSON line) of resources
+    and (message number, control ID, error) of messages that could not be
+    converted
+    """
+    resources, errors = [], []
+    for message_number, raw_message in enumerate(messages, first_message_number):
+        control_id = ""
+        try:
+            hl7msg = raw_message.decode(encoding)
+            message = Er7Message(hl7msg)
+            control_id = message.segment("MSH").value(10)
+            resource_type = get_resource_type(message)
+            resource = Hl7v2ToFhirConverter(
+                hl7msg, resource_type, get_resource_id(message, resource_type), parser
+            ).transform()
+        except Exception as exc:
+            errors.append((message_number, control_id, repr(exc)))
+        else:
+            line = json.dumps(resource, separators=(",", ":"), ensure_ascii=False)
+            resources.append((resource_type, line))
+    return (resources, errors)
+
+
+def _init_worker(parser: str) -> None:
+    if parser == "hl7apy":
+        from lib.hl7_reference_cache import install
+
+        install()
+
+
+class NdjsonShardWriter(object):
+    """
+    Writes NDJSON lines to one file per resource type in a directory, files
+    are created when the first resource of their type is written
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        self._output_dir = output_dir
+        self._files = dict()
+
+    def write(self, resource_type: str, line: str) -> None:
+        output_file = self._files.get(resource_type)
+        if output_file is None:
+            path = os.path.join(self._output_dir, f"{resource_type}.ndjson")
+            output_file = open(path, "w", encoding="utf-8")
+            self._files[resource_type] = output_file
+        output_file.write(line)
+        output_file.write("\n")
+
+    def close(self) -> None:
+        for output_file in self._files.values():
+            output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def convert_hl7(
+    input_file: BinaryIO,
+    output_dir: str,
+    workers: int = None,
+    chunk_size: int = 500,
+    parser: str = None,
+    encoding: str = "utf-8",
+    errors_file: TextIO = None,
+    progress: Callable[[ConversionStats], None] = None,
+) -> ConversionStats:
+    """
+    Converts HL7v2 messages from input_file and writes resources to NDJSON
+    files by resource type in output_dir in input order. Failures are logged
+    and written to errors_file as NDJSON records if given. workers=0 converts
+    in this process. progress is called with conversion stats after every
+    chunk.
+    """
+    parser = parser or DEFAULT_PARSER
+    stats = ConversionStats()
+    os.makedirs(output_dir, exist_ok=True)
+
+    with NdjsonShardWriter(output_dir) as shards:
+
+        def write(result):
+            resources, errors = result
+            for resource_type, line in resources:
+                shards.write(resource_type, line)
+            for message_number, control_id, error in errors:
+                logger.error(
+                    f"Unable to convert message {message_number} "
+                    f"control id: [{control_id}]: {error}"
+                )
+                if errors_file is not None:
+                    record = dict(
+                        message=message_number, controlId=control_id, error=error
+                    )
+                    errors_file.write(json.dumps(record) + "\n")
+            stats.converted += len(resources)
+            stats.failed += len(errors)
+            if progress:
+                progress(stats)
+
+        chunks = iter_chunks(read_messages(input_file), chunk_size)
+        workers = os.cpu_count() if workers is None else workers
+        if workers == 0:
+            for chunk, message_number in chunks:
+                write(convert_messages(chunk, message_number, parser, encoding))
+        else:
+            with ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(parser,)
+            ) as pool:
+                # Bounded number of chunks in flight, results are written in order
+                pending = deque()
+                max_pending = 2 * workers
+                for chunk, message_number in chunks:
+                    pending.append(
+                        pool.submit(
+                            convert_messages, chunk, message_number, parser, encoding
+                        )
+                    )
+                    if len(pending) >= max_pending:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert HL7v2 batch or MLLP files to FHIR NDJSON resources"
+    )
+    parser.add_argument("input", help="HL7v2 file, - for standard input")
+    parser.add_argument("output", help="directory of NDJSON files by resource type")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--parser", choices=["hl7apy", "er7"])
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--errors", help="write conversion failures to NDJSON file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    last_report = [0.0]
+
+    def report(stats):
+        if stats.elapsed - last_report[0] >= 2:
+            last_report[0] = stats.elapsed
+            print(
+                f"{stats.converted} converted, {stats.failed} failed, "
+                f"{stats.throughput:.0f} messages/s",
+                file=sys.stderr,
+            )
+
+    input_file = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    errors_file = open(args.errors, "w") if args.errors else None
+    try:
+        with input_file:
+            stats = convert_hl7(
+                input_file,
+                args.output,
+                workers=args.workers,
+                chunk_size=args.chunk_size,
+                parser=args.parser,
+                encoding=args.encoding,
+                errors_file=errors_file,
+                progress=report,
+            )
+    finally:
+        if errors_file is not None:
+            errors_file.close()
+    print(
+        f"{stats.converted} converted, {stats.failed} failed in "
+        f"{stats.elapsed:.1f} s ({stats.throughput:.0f} messages/s)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# JSON Patch (RFC 6902) for the patch interaction of FHIR resources. A patch
+# document is an array of add, remove, replace, move, copy and test
+# operations on JSON Pointer (RFC 6901) paths, applied in order.
+from copy import deepcopy
+from typing import List
+
+OPERATIONS = frozenset(["add", "remove", "replace", "move", "copy", "test"])
+
+
+class JsonPatchError(ValueError):
+    """
+    Raised for patch documents that are not valid JSON Patch
+    """
+
+
+class JsonPatchConflict(JsonPatchError):
+    """
+    Raised for operations that cannot be applied to the document, including
+    failed test operations
+    """
+
+
+def apply_patch(document, patch: list):
+    """
+    Returns document with the operations of patch applied in order. Lists
+    and objects of document are changed in place. Raises JsonPatchError for
+    invalid patch documents and JsonPatchConflict for operations that cannot
+    be applied.
+    """
+    if not isinstance(patch, list):
+        raise JsonPatchError("Patch document must be an array of operations")
+    for operation in patch:
+        if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+            raise JsonPatchError(f"Invalid patch operation {operation}")
+        op = operation["op"]
+        path = _parse_pointer(operation, "path")
+        if op == "add":
+            document = _add(document, path, deepcopy(_get_value(operation)))
+        elif op == "remove":
+            document = _remove(document, path)
+        elif op == "replace":
+            document = _replace(document, path, deepcopy(_get_value(operation)))
+        elif op == "move":
+            from_path = _parse_pointer(operation, "from")
+            if path[: len(from_path)] == from_path and path != from_path:
+                raise JsonPatchConflict(
+                    f"Cannot move {operation['from']} into one of its children"
+                )
+            value = _resolve(document, from_path)
+            document = _add(_remove(document, from_path), path, value)
+        elif op == "copy":
+            value = deepcopy(_resolve(document, _parse_pointer(operation, "from")))
+            document = _add(document, path, value)
+        else:
+            if not _equal(_resolve(document, path), _get_value(operation)):
+                raise JsonPatchConflict(f"Test of {operation['path']} failed")
+    return document
+
+
+def _get_value(operation: dict):
+    if "value" not in operation:
+        raise JsonPatchError(f"Missing value of {operation['op']} operation")
+    return operation["value"]
+
+
+def _parse_pointer(operation: dict, member: str) -> List[str]:
+    pointer = operation.get(member)
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+        raise JsonPatchError(f"Invalid {member} of {operation['op']} operation")
+    # ~1 is unescaped before ~0, so ~01 is ~1
+    return [
+        token.replace("~1", "/").replace("~0", "~") for token in pointer.split("/")[1:]
+    ]
+
+
+def _get_index(parent: list, token: str, path: List[str], append: bool) -> int:
+    # Indexes have no leading zeros, "-" is the end of the list
+    if append and token == "-":
+        return len(parent)
+    if not (token.isascii() and token.isdigit()) or (
+        token != "0" and token.startswith("0")
+    ):
+        raise JsonPatchConflict(f"Invalid list index in /{'/'.join(path)}")
+    index = int(token)
+    if index > len(parent) or (index == len(parent) and not append):
+        raise JsonPatchConflict(f"List index out of range in /{'/'.join(path)}")
+    return index
+
+
+def _resolve(document, path: List[str]):
+    value = document
+    for position, token in enumerate(path):
+        if isinstance(value, dict):
+            if token not in value:
+                raise JsonPatchConflict(
+                    f"Path /{'/'.join(path[: position + 1])} does not exist"
+                )
+            value = value[token]
+        elif isinstance(value, list):
+            value = value[_get_index(value, token, path[: position + 1], False)]
+        else:
+            raise JsonPatchConflict(
+                f"Path /{'/'.join(path[: position + 1])} does not exist"
+            )
+    return value
+
+
+def _add(document, path: List[str], value):
+    if not path:
+        return value
+    parent = _resolve(document, path[:-1])
+    if isinstance(parent, dict):
+        parent[path[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_get_index(parent, path[-1], path, True), value)
+    else:
+        raise JsonPatchConflict(f"Cannot add to /{'/'.join(path[:-1])}")
+    return document
+
+
+def _replace(document, path: List[str], value):
+    # Target must exist, members keep their position
+    _resolve(document, path)
+    if not path:
+        return value
+    parent = _resolve(document, path[:-1])
+    if isinstance(parent, list):
+        parent[_get_index(parent, path[-1], path, False)] = value
+    else:
+        parent[path[-1]] = value
+    return document
+
+
+def _remove(document, path: List[str]):
+    if not path:
+        raise JsonPatchConflict("Cannot remove the whole document")
+    parent = _resolve(document, path[:-1])
+    if isinstance(parent, dict):
+        if path[-1] not in parent:
+            raise JsonPatchConflict(f"Path /{'/'.join(path)} does not exist")
+        del parent[path[-1]]
+    elif isinstance(parent, list):
+        del parent[_get_index(parent, path[-1], path, False)]
+    else:
+        raise JsonPatchConflict(f"Path /{'/'.join(path)} does not exist")
+    return document
+
+
+def _equal(a, b) -> bool:
+    # JSON values are equal by type and value: numbers compare by value, but
+    # booleans are not numbers
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_equal(x, y) for x, y in zip(a, b))
+    return type(a) is type(b) and a == b
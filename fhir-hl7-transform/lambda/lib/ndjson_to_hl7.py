@@ -0,0 +1,216 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Converts FHIR resources in NDJSON files (e.g. FHIR Bulk Data exports) to
+# HL7v2 messages, written as an HL7 batch file (FHS/BHS ... BTS/FTS) or as
+# MLLP-framed messages. Input is read in chunks of lines that are converted
+# on a process pool; a bounded number of chunks is in flight, so memory use
+# does not depend on input size, and messages are written in input order.
+# Messages are the same as for PUT requests (or POST if resources have no
+# id), including the FW identifier of the resource id.
+#
+# Usage: python -m lib.ndjson_to_hl7 Patient.ndjson patients.hl7
+#            [--workers 4] [--chunk-size 500] [--format mllp] [--encoder er7]
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Callable, Iterable, List, Tuple
+
+from lib.fhir_resource_writer import FhirResourceWriter
+from lib.fhir_to_hl7 import DEFAULT_ENCODER
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ["batch", "mllp"]
+
+# MLLP block characters
+MLLP_START_BLOCK = b"\x0b"
+MLLP_END_BLOCK = b"\x1c\r"
+
+_BATCH_HEADER = "FHS|^~\\&|||||{datetime}\rBHS|^~\\&|||||{datetime}\r"
+_BATCH_TRAILER = "BTS|{count}\rFTS|1\r"
+
+
+class ConversionStats(object):
+    """
+    Counts of converted and failed resources
+    """
+
+    def __init__(self) -> None:
+        self.converted = 0
+        self.failed = 0
+        self.started_at = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        return (self.converted + self.failed) / max(self.elapsed, 1e-9)
+
+
+def convert_lines(
+    lines: List[bytes], first_line_number: int, encoder: str = None
+) -> Tuple[List[str], List[Tuple[int, str]]]:
+    """
+    Converts NDJSON lines and returns messages and (line number, error) of
+    lines that could not be converted
+    """
+    messages, errors = [], []
+    for line_number, line in enumerate(lines, first_line_number):
+        if not line.strip():
+            continue
+        try:
+            resource = json.loads(line)
+            resource_id = resource.get("id")
+            writer = FhirResourceWriter(
+                resource,
+                dict(id=resource_id) if resource_id else None,
+                encoder=encoder,
+            )
+            message, _ = writer.write(return_representation=False)
+            if message is None:
+                raise ValueError(
+                    f"Unsupported resource type {resource.get('resourceType')}"
+                )
+        except Exception as exc:
+            errors.append((line_number, repr(exc)))
+        else:
+            messages.append(message)
+    return (messages, errors)
+
+
+def _init_worker(encoder: str) -> None:
+    if encoder == "hl7apy":
+        from lib.hl7_reference_cache import install
+
+        install()
+
+
+def iter_chunks(lines: Iterable, chunk_size: int):
+    """
+    Yields lists of up to chunk_size lines with the number of their first
+    line, counted from 1
+    """
+    line_number = 1
+    lines = iter(lines)
+    while chunk := list(itertools.islice(lines, chunk_size)):
+        yield (chunk, line_number)
+        line_number += len(chunk)
+
+
+def convert_ndjson(
+    input_file: BinaryIO,
+    output_file: BinaryIO,
+    workers: int = None,
+    chunk_size: int = 500,
+    output_format: str = "batch",
+    encoder: str = None,
+    progress: Callable[[ConversionStats], None] = None,
+) -> ConversionStats:
+    """
+    Converts NDJSON resources from input_file and writes HL7v2 messages to
+    output_file in input order. workers=0 converts in this process. progress
+    is called with conversion stats after every chunk.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}")
+    encoder = encoder or DEFAULT_ENCODER
+    stats = ConversionStats()
+
+    if output_format == "batch":
+        header = _BATCH_HEADER.format(datetime=datetime.now().strftime("%Y%m%d%H%M%S"))
+        output_file.write(header.encode("utf-8"))
+
+    def write(result):
+        messages, errors = result
+        for message in messages:
+            message = message.rstrip("\r").encode("utf-8")
+            if output_format == "mllp":
+                output_file.write(MLLP_START_BLOCK + message + MLLP_END_BLOCK)
+            else:
+                output_file.write(message + b"\r")
+        for line_number, error in errors:
+            logger.error(f"Unable to convert line {line_number}: {error}")
+        stats.converted += len(messages)
+        stats.failed += len(errors)
+        if progress:
+            progress(stats)
+
+    chunks = iter_chunks(input_file, chunk_size)
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 0:
+        for chunk, line_number in chunks:
+            write(convert_lines(chunk, line_number, encoder))
+    else:
+        with ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(encoder,)
+        ) as pool:
+            # Bounded number of chunks in flight, results are written in order
+            pending = deque()
+            max_pending = 2 * workers
+            for chunk, line_number in chunks:
+                pending.append(pool.submit(convert_lines, chunk, line_number, encoder))
+                if len(pending) >= max_pending:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+
+    if output_format == "batch":
+        output_file.write(_BATCH_TRAILER.format(count=stats.converted).encode("utf-8"))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert FHIR NDJSON resources to HL7v2 messages"
+    )
+    parser.add_argument("input", help="NDJSON file, - for standard input")
+    parser.add_argument("output", help="output file, - for standard output")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--format", default="batch", choices=OUTPUT_FORMATS)
+    parser.add_argument("--encoder", choices=["hl7apy", "er7"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    last_report = [0.0]
+
+    def report(stats):
+        if stats.elapsed - last_report[0] >= 2:
+            last_report[0] = stats.elapsed
+            print(
+                f"{stats.converted} converted, {stats.failed} failed, "
+                f"{stats.throughput:.0f} resources/s",
+                file=sys.stderr,
+            )
+
+    input_file = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    output_file = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    with input_file, output_file:
+        stats = convert_ndjson(
+            input_file,
+            output_file,
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+            output_format=args.format,
+            encoder=args.encoder,
+            progress=report,
+        )
+    print(
+        f"{stats.converted} converted, {stats.failed} failed in "
+        f"{stats.elapsed:.1f} s ({stats.throughput:.0f} resources/s)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Stage timers of the request being handled, emitted as one CloudWatch
+# Embedded Metric Format (EMF) log line per request. Metrics are enabled with
+# STAGE_METRICS=true; otherwise timers and metrics are no-ops. Durations of a
+# stage that runs more than once in a request (e.g. for Bundle entries) are
+# summed. Metrics have resource type and HTTP method as dimensions.
+import json
+import os
+import time
+
+ENABLED = os.environ.get("STAGE_METRICS", "false").lower() == "true"
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "FhirHl7v2Transform")
+
+# Metrics of the request being handled, Lambda handles one request at a time
+_request = None
+
+
+class _Request(object):
+    def __init__(self, dimensions: dict) -> None:
+        self.started_at = time.perf_counter()
+        self.dimensions = dimensions
+        self.values = dict()
+        self.units = dict()
+
+    def add(self, name: str, value: float, unit: str) -> None:
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+
+class _Timer(object):
+    __slots__ = ("_request", "_name", "_started_at")
+
+    def __init__(self, request: _Request, name: str) -> None:
+        self._request = request
+        self._name = name
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = (time.perf_counter() - self._started_at) * 1000
+        self._request.add(self._name, elapsed, "Milliseconds")
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def start(resource_type: str, method: str) -> None:
+    """
+    Starts collecting metrics of a request
+    """
+    global _request
+    if ENABLED:
+        _request = _Request(dict(ResourceType=resource_type, Method=method))
+
+
+def timer(stage: str):
+    """
+    Returns context manager that adds its duration to the stage time
+    """
+    if _request is None:
+        return _NULL_TIMER
+    return _Timer(_request, f"{stage}Time")
+
+
+def put_metric(name: str, value: float, unit: str = "Count") -> None:
+    if _request is not None:
+        _request.add(name, value, unit)
+
+
+def record_message(message: str) -> None:
+    """
+    Adds size and segment count of an HL7v2 message
+    """
+    if _request is not None:
+        _request.add("MessageBytes", len(message.encode("utf-8")), "Bytes")
+        _request.add("SegmentCount", message.count("\r") + 1, "Count")
+
+
+def flush(**properties) -> None:
+    """
+    Emits metrics of the request as EMF log line, properties are logged
+    without being metrics
+    """
+    global _request
+    request = _request
+    if request is None:
+        return
+    _request = None
+    request.add(
+        "TotalTime", (time.perf_counter() - request.started_at) * 1000, "Milliseconds"
+    )
+    document = dict(
+        _aws=dict(
+            Timestamp=int(time.time() * 1000),
+            CloudWatchMetrics=[
+                dict(
+                    Namespace=NAMESPACE,
+                    Dimensions=[list(request.dimensions)],
+                    Metrics=[
+                        dict(Name=name, Unit=unit)
+                        for name, unit in request.units.items()
+                    ],
+                )
+            ],
+        ),
+        **request.dimensions,
+        **properties,
+        **request.values,
+    )
+    print(json.dumps(document), flush=True)
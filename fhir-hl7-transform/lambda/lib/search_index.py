@@ -0,0 +1,313 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Secondary index of written resources for search interactions, updated by
+# the transform Lambda after the message of a resource was sent. Index terms
+# "{resource_type}?{parameter}={value}" map search parameter values to keys
+# "{resource_type}/{id}" of the resources that have them. Search parameters:
+#   Patient identifier - system|value, |value (no system) or value (any system)
+#   Patient family     - family name, case-insensitive
+#   Patient birthdate  - birth date as written, e.g. 1970-01-01
+#   Patient gender     - administrative gender code
+# The backend is selected by environment variables:
+#   SEARCH_INDEX       - none (default, search disabled), sqlite or dynamodb
+#   SEARCH_INDEX_PATH  - database file of the sqlite backend
+#                        (default search_index.db)
+#   SEARCH_INDEX_TABLE - table of the dynamodb backend, with string partition
+#                        key "term" and string sort key "key"
+#
+# Keys of every term are read in key order, so resources matching several
+# terms are found by seeking all terms to the same key, and results can be
+# continued after the last key returned.
+import os
+import threading
+from bisect import bisect_left
+from typing import Iterable, List, Optional, Tuple
+
+from lib.aws_clients import get_client
+
+SEARCH_INDEX = os.environ.get("SEARCH_INDEX", "none")
+
+# Search parameters of every resource type
+SEARCH_PARAMETERS = dict(Patient=["identifier", "family", "birthdate", "gender"])
+
+# DynamoDB limit of items in BatchWriteItem requests
+DYNAMODB_BATCH_MAX_ITEMS = 25
+
+_lock = threading.Lock()
+_indexes = dict()
+
+
+def get_term(resource_type: str, parameter: str, value: str) -> str:
+    """
+    Returns index term of the search parameter value
+    """
+    if parameter == "family":
+        value = value.casefold()
+    return f"{resource_type}?{parameter}={value}"
+
+
+def get_search_terms(fhir_resource: dict) -> List[str]:
+    """
+    Returns index terms of the written FHIR resource
+    """
+    resource_type = fhir_resource.get("resourceType")
+    if resource_type != "Patient":
+        return []
+    values = set()
+    for identifier in fhir_resource.get("identifier") or []:
+        if value := identifier.get("value", ""):
+            values.add(("identifier", f"{identifier.get('system', '')}|{value}"))
+            values.add(("identifier", value))
+    for name in fhir_resource.get("name") or []:
+        if family := name.get("family", ""):
+            values.add(("family", family))
+    if birth_date := fhir_resource.get("birthDate", ""):
+        values.add(("birthdate", birth_date))
+    if gender := fhir_resource.get("gender", ""):
+        values.add(("gender", gender))
+    return sorted({get_term(resource_type, *value) for value in values})
+
+
+class SearchIndex(object):
+    """
+    Interface of search index backends
+    """
+
+    def put(self, key: str, terms: List[str]) -> None:
+        """
+        Replaces index terms of the resource key
+        """
+        self.put_many([(key, terms)])
+
+    def put_many(self, items: Iterable[Tuple[str, List[str]]]) -> None:
+        """
+        Replaces index terms of (key, terms) pairs
+        """
+        raise NotImplementedError
+
+    def scan(self, term: str, start: str, limit: int) -> List[str]:
+        """
+        Returns up to limit sorted keys of the term from start (inclusive)
+        """
+        raise NotImplementedError
+
+    def search(self, terms: List[str], count: int, after: str = None) -> List[str]:
+        """
+        Returns up to count sorted keys that have all terms, following the
+        key after if given
+        """
+        cursors = [_Cursor(self, term, count) for term in terms]
+        keys = list()
+        # Smallest key greater than after
+        candidate = after + "\0" if after else ""
+        while cursors and len(keys) < count:
+            for cursor in cursors:
+                key = cursor.seek(candidate)
+                if key is None:
+                    return keys
+                if key != candidate:
+                    # Other terms are sought to the next key of this term
+                    candidate = key
+                    break
+            else:
+                keys.append(candidate)
+                candidate += "\0"
+        return keys
+
+
+class _Cursor(object):
+    """
+    Position in the sorted keys of a term, read one page at a time
+    """
+
+    def __init__(self, index: SearchIndex, term: str, page_size: int) -> None:
+        self._index = index
+        self._term = term
+        self._page_size = page_size
+        self._start = None
+        self._page = None
+        self._last_page = False
+
+    def seek(self, key: str) -> Optional[str]:
+        """
+        Returns first key of the term from key (inclusive), or None
+        """
+        if self._page is not None and self._start <= key:
+            if self._page and key <= self._page[-1]:
+                return self._page[bisect_left(self._page, key)]
+            if self._last_page:
+                return None
+        self._start = key
+        self._page = self._index.scan(self._term, key, self._page_size)
+        self._last_page = len(self._page) < self._page_size
+        return self._page[0] if self._page else None
+
+
+class SqliteSearchIndex(SearchIndex):
+    """
+    Search index stored in a local SQLite database
+    """
+
+    def __init__(self, path: str) -> None:
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS search_terms "
+            "(term TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (term, key)) "
+            "WITHOUT ROWID"
+        )
+        # Terms of a key are replaced when the resource is written again
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS search_terms_key ON search_terms (key)"
+        )
+
+    def put_many(self, items: Iterable[Tuple[str, List[str]]]) -> None:
+        items = list(items)
+        rows = [(term, key) for key, terms in items for term in terms]
+        # All terms are replaced in one transaction
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "DELETE FROM search_terms WHERE key = ?",
+                    [(key,) for key, _ in items],
+                )
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO search_terms (term, key) VALUES (?, ?)",
+                    rows,
+                )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def scan(self, term: str, start: str, limit: int) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key FROM search_terms WHERE term = ? AND key >= ? "
+                "ORDER BY key LIMIT ?",
+                (term, start, limit),
+            ).fetchall()
+        return [key for key, in rows]
+
+
+class DynamoDbSearchIndex(SearchIndex):
+    """
+    Search index stored as items of a DynamoDB table, one item per term and
+    key. The terms of every key are kept in an item with the key as
+    partition key and sort key "#terms".
+    """
+
+    def __init__(self, table_name: str) -> None:
+        self._table_name = table_name
+
+    def put_many(self, items: Iterable[Tuple[str, List[str]]]) -> None:
+        dynamodb = get_client("dynamodb")
+        requests = list()
+        # Batch writes cannot have two requests of the same item, the last
+        # terms of a key win
+        for key, terms in dict(items).items():
+            item = dynamodb.get_item(
+                TableName=self._table_name,
+                Key=dict(term=dict(S=key), key=dict(S="#terms")),
+                ConsistentRead=True,
+            ).get("Item")
+            old_terms = set(item["terms"]["SS"]) if item else set()
+            new_terms = set(terms)
+            requests.extend(
+                dict(DeleteRequest=dict(Key=dict(term=dict(S=term), key=dict(S=key))))
+                for term in sorted(old_terms - new_terms)
+            )
+            requests.extend(
+                dict(PutRequest=dict(Item=dict(term=dict(S=term), key=dict(S=key))))
+                for term in sorted(new_terms - old_terms)
+            )
+            if new_terms:
+                requests.append(
+                    dict(
+                        PutRequest=dict(
+                            Item=dict(
+                                term=dict(S=key),
+                                key=dict(S="#terms"),
+                                terms=dict(SS=sorted(new_terms)),
+                            )
+                        )
+                    )
+                )
+            elif item:
+                requests.append(
+                    dict(
+                        DeleteRequest=dict(
+                            Key=dict(term=dict(S=key), key=dict(S="#terms"))
+                        )
+                    )
+                )
+        for start in range(0, len(requests), DYNAMODB_BATCH_MAX_ITEMS):
+            self._write_batch(requests[start : start + DYNAMODB_BATCH_MAX_ITEMS])
+
+    def _write_batch(self, requests: List[dict]) -> None:
+        dynamodb = get_client("dynamodb")
+        request_items = {self._table_name: requests}
+        while request_items:
+            response = dynamodb.batch_write_item(RequestItems=request_items)
+            # Unprocessed items are retried, the client backs off on throttling
+            request_items = response.get("UnprocessedItems")
+
+    def scan(self, term: str, start: str, limit: int) -> List[str]:
+        dynamodb = get_client("dynamodb")
+        parameters = dict(
+            TableName=self._table_name,
+            ProjectionExpression="#key",
+            ExpressionAttributeNames={"#term": "term", "#key": "key"},
+            Limit=limit,
+        )
+        if start:
+            parameters["KeyConditionExpression"] = "#term = :term AND #key >= :start"
+            parameters["ExpressionAttributeValues"] = {
+                ":term": dict(S=term),
+                ":start": dict(S=start),
+            }
+        else:
+            parameters["KeyConditionExpression"] = "#term = :term"
+            parameters["ExpressionAttributeValues"] = {":term": dict(S=term)}
+        keys = list()
+        while len(keys) < limit:
+            response = dynamodb.query(**parameters)
+            keys.extend(item["key"]["S"] for item in response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            parameters["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+            parameters["Limit"] = limit - len(keys)
+        return keys
+
+
+def get_search_index(name: str = None) -> Optional[SearchIndex]:
+    """
+    Returns shared search index of the backend, creating it on first use,
+    or None if search is disabled
+    """
+    name = name or SEARCH_INDEX
+    if name == "none":
+        return None
+    index = _indexes.get(name)
+    if index is None:
+        with _lock:
+            index = _indexes.get(name)
+            if index is None:
+                if name == "sqlite":
+                    index = SqliteSearchIndex(
+                        os.environ.get("SEARCH_INDEX_PATH", "search_index.db")
+                    )
+                elif name == "dynamodb":
+                    index = DynamoDbSearchIndex(os.environ["SEARCH_INDEX_TABLE"])
+                else:
+                    raise ValueError(f"Unknown search index {name}")
+                _indexes[name] = index
+    return index
@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Encoding of HL7v2 messages sent to the HL7v2 sender over SQS. SQS message
+# bodies are limited to 256 KB and requests are billed per 64 KB chunk, so
+# large messages are compressed and messages that would still not fit are
+# stored in S3 with only their location sent on SQS (claim check).
+# Encoding is configured with environment variables:
+#   SQS_COMPRESS_MIN_BYTES - messages of at least this size are compressed
+#                            (default 65536, 0 disables compression)
+#   SQS_OFFLOAD_BUCKET     - S3 bucket of offloaded messages (unset disables
+#                            offloading)
+#   SQS_OFFLOAD_MIN_BYTES  - messages with larger SQS bodies are offloaded
+#                            (default 258048)
+#   SQS_OFFLOAD_PREFIX     - key prefix of offloaded messages (default hl7/)
+#
+# Message attributes describe how the body is encoded, bodies without them
+# are the ER7 message text:
+#   ContentEncoding - "zlib": the message is zlib-compressed UTF-8 text,
+#                     base64-encoded in the body
+#   PayloadLocation - "s3://bucket/key" of the offloaded message (compressed
+#                     as in ContentEncoding, without base64), also the body
+import os
+import zlib
+from base64 import b64encode
+from typing import List, Tuple
+from uuid import uuid4
+
+from lib.aws_clients import get_client
+
+COMPRESS_MIN_BYTES = int(os.environ.get("SQS_COMPRESS_MIN_BYTES", "65536"))
+OFFLOAD_BUCKET = os.environ.get("SQS_OFFLOAD_BUCKET")
+OFFLOAD_MIN_BYTES = int(os.environ.get("SQS_OFFLOAD_MIN_BYTES", "258048"))
+OFFLOAD_PREFIX = os.environ.get("SQS_OFFLOAD_PREFIX", "hl7/")
+
+
+def encode_message(message: str) -> Tuple[str, dict]:
+    """
+    Returns SQS message body and message attributes for the HL7v2 message,
+    storing the message in S3 if the body would be too large
+    """
+    payload = message.encode("utf-8")
+    attributes = dict()
+    if COMPRESS_MIN_BYTES and len(payload) >= COMPRESS_MIN_BYTES:
+        payload = zlib.compress(payload)
+        attributes["ContentEncoding"] = _string_attribute("zlib")
+        body = b64encode(payload).decode("ascii")
+        body_size = len(body)
+    else:
+        body = message
+        body_size = len(payload)
+
+    if OFFLOAD_BUCKET and body_size > OFFLOAD_MIN_BYTES:
+        key = f"{OFFLOAD_PREFIX}{uuid4()}"
+        get_client("s3").put_object(Bucket=OFFLOAD_BUCKET, Key=key, Body=payload)
+        body = f"s3://{OFFLOAD_BUCKET}/{key}"
+        attributes["PayloadLocation"] = _string_attribute(body)
+    return (body, attributes)
+
+
+def encode_messages(messages: List[str]) -> List[Tuple[str, dict]]:
+    """
+    Returns SQS message bodies and message attributes for HL7v2 messages
+    """
+    return [encode_message(message) for message in messages]
+
+
+def get_size(body: str, attributes: dict) -> int:
+    """
+    Returns size of the SQS message as counted towards the SQS size limit
+    """
+    size = len(body.encode("utf-8"))
+    for name, attribute in attributes.items():
+        size += len(name) + len(attribute["DataType"]) + len(attribute["StringValue"])
+    return size
+
+
+def _string_attribute(value: str) -> dict:
+    return dict(DataType="String", StringValue=value)
@@ -5,35 +5,103 @@ import json
 import logging
 import os
 from base64 import b64decode
-from typing import Any
+from copy import deepcopy
+from typing import Any, List, Optional, Tuple
 
-import boto3
-
-from lib.fhir_resource_reader import FhirResourceReader
-from lib.fhir_resource_writer import FhirResourceWriter
+from lib import request_metrics
+from lib.aws_clients import get_client
+from lib.content_hash_store import get_content_hash_store
+from lib.fhir_to_hl7 import DEFAULT_ENCODER
+from lib.hl7_reference_cache import SAMPLE_PATIENT
+from lib.hl7_reference_cache import install as install_hl7_reference_cache
+from lib.hl7_to_fhir import DEFAULT_PARSER
+from lib.message_store import MESSAGE_STORE, get_message_store
+from lib.search_index import get_search_index
+from lib.sqs_payload import encode_message, encode_messages, get_size
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# SQS limits for SendMessageBatch requests
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+
+
+def init() -> None:
+    """
+    Prepares execution environment when the function module is imported.
+    Converters and AWS clients are otherwise imported on first use.
+    """
+    if "hl7apy" in [DEFAULT_ENCODER, DEFAULT_PARSER]:
+        install_hl7_reference_cache()
+    # Optional warm-up moves first conversion and client creation to init
+    if os.environ.get("HL7_WARM_UP", "false").lower() == "true":
+        warm_up()
+
+
+def warm_up() -> None:
+    from lib.fhir_resource_writer import FhirResourceWriter
+
+    FhirResourceWriter(deepcopy(SAMPLE_PATIENT), dict(id="warm-up")).write()
+    get_client("sqs")
+    get_message_store()
+    if MESSAGE_STORE == "s3":
+        get_client("s3")
+
 
 def handler(event, context):
     sqs_queue = os.environ.get("SQS_QUEUE")
     s3_bucket_name = os.environ.get("S3_BUCKET_NAME")
 
-    if (sqs_queue is None) or (s3_bucket_name is None):
+    if (sqs_queue is None) or (MESSAGE_STORE == "s3" and s3_bucket_name is None):
         logger.error("Check SQS_QUEUE or S3_BUCKET_NAME environment variables")
         return prepare_response(500, {}, "Configuration Error")
+    # Stores are opened before the request is processed, so that their
+    # configuration errors are not reported as invalid resources. Later calls
+    # return the same stores.
+    try:
+        get_content_hash_store()
+        get_search_index()
+    except Exception as exc:
+        logger.exception(
+            "Unable to open content hash store or search index", exc_info=exc
+        )
+        return prepare_response(500, {}, "Configuration Error")
 
     http_method = event.get("httpMethod")
+    request_metrics.start(
+        (event.get("pathParameters") or {}).get("resource_type", "Bundle"),
+        http_method,
+    )
+
+    headers = None
+
+    # Batch or transaction Bundle
+    if http_method == "POST" and not (event.get("pathParameters") or {}).get(
+        "resource_type"
+    ):
+        bundle = parse_event(event)
+        return_preference = get_return_preference(event)
+        status_code, resource, message = write_bundle(
+            sqs_queue, bundle, return_preference != "minimal"
+        )
 
     # Write request
-    if http_method in ["POST", "PUT"]:
+    elif http_method in ["POST", "PUT"]:
+        from lib.fhir_resource_writer import FhirResourceWriter
+
         fhir_resource_content = parse_event(event)
+        return_preference = get_return_preference(event)
         try:
-            hl7v2_message, resource = FhirResourceWriter(
+            writer = FhirResourceWriter(
                 fhir_resource_content,
                 event.get("pathParameters") if http_method == "PUT" else None,
-            ).write()
+                hash_store=get_content_hash_store(),
+                search_index=get_search_index(),
+            )
+            hl7v2_message, resource = writer.write(
+                return_representation=(return_preference != "minimal")
+            )
         except Exception as exc:
             path_parameters = event.get("pathParameters", {})
             resource_type = path_parameters.get("resource_type", "")
@@ -42,34 +110,59 @@ def handler(event, context):
             message = f"Unable to parse resource {resource_type}"
             logger.exception(message, exc_info=exc)
         else:
-            try:
-                send_hl7_to_transporter(sqs_queue, hl7v2_message)
-                status_code = 201
-                message = ""
-            except Exception as exc:
-                status_code = 500
-                resource = {}
-                message = "Unable to pass request to back end system"
-                logger.exception(message, exc_info=exc)
+            status_code, resource, message, headers = send_written(
+                sqs_queue, writer, hl7v2_message, resource, 201
+            )
+
+    # Patch request: JSON Patch is applied to the stored resource and only
+    # the segments of changed elements are encoded again
+    elif http_method == "PATCH":
+        status_code, resource, message, headers = patch(sqs_queue, event)
+
+    # Search request: matching resources are looked up in the search index
+    # and read from the message store
+    elif http_method == "GET" and not (event.get("pathParameters") or {}).get("id"):
+        status_code, resource, message = search(event)
 
     # Read request implemented in this proof of concept relies
     # on mock HL7 server implementation which stores HL7 messages
-    # as S3 objects
+    # in the message store (S3 objects by default)
     elif http_method == "GET":
+        from lib.fhir_projection import get_projection
+        from lib.fhir_resource_reader import FhirResourceReader
+
+        query_parameters = event.get("queryStringParameters") or {}
         try:
-            resource = FhirResourceReader(
-                s3_bucket_name, event.get("pathParameters")
-            ).read()
-            status_code = 200
-            message = ""
-        except Exception as exc:
-            path_parameters = event.get("pathParameters", {})
-            resource_type = path_parameters.get("resource_type", "")
-            id = path_parameters.get("id", "")
-            status_code = 404
+            elements = get_projection(
+                (event.get("pathParameters") or {}).get("resource_type"),
+                query_parameters.get("_elements"),
+                query_parameters.get("_summary"),
+            )
+        except ValueError as exc:
+            status_code = 400
             resource = {}
-            message = f"Unable to find resource {resource_type} with {id}"
-            logger.error(f"Resource {resource_type}/{id} not found", exc_info=exc)
+            message = str(exc)
+        else:
+            try:
+                reader = FhirResourceReader(
+                    get_message_store(), event.get("pathParameters")
+                )
+                resource = reader.read(
+                    if_none_match=get_header(event, "If-None-Match"),
+                    elements=elements,
+                )
+                # Resource is None when it matches the entity tag in If-None-Match
+                status_code = 200 if resource is not None else 304
+                message = ""
+                headers = {"ETag": reader.etag}
+            except Exception as exc:
+                path_parameters = event.get("pathParameters", {})
+                resource_type = path_parameters.get("resource_type", "")
+                id = path_parameters.get("id", "")
+                status_code = 404
+                resource = {}
+                message = f"Unable to find resource {resource_type} with {id}"
+                logger.error(f"Resource {resource_type}/{id} not found", exc_info=exc)
 
     # Delete
     elif http_method == "DELETE":
@@ -84,24 +177,273 @@ def handler(event, context):
         message = f"Unknown method: {http_method}"
         logger.error(message)
 
-    return prepare_response(status_code, resource, message)
+    with request_metrics.timer("PrepareResponse"):
+        response = prepare_response(status_code, resource, message, headers)
+    request_metrics.flush(StatusCode=status_code)
+    return response
+
+
+def send_written(
+    sqs_queue: str,
+    writer: Any,
+    hl7v2_message: str,
+    resource: Optional[dict],
+    status_code: int,
+) -> Tuple[int, Optional[dict], str, Optional[dict]]:
+    """
+    Sends message of a written resource unless it is unchanged and returns
+    status code, resource, message and headers of the response
+    """
+    headers = {
+        "Location": f"{writer.resource_type}/{writer.resource_id}",
+        "ETag": writer.etag,
+    }
+    if writer.unchanged:
+        # Message equal to the last one sent for the resource is not sent again
+        return (200, resource, "", headers)
+    try:
+        send_hl7_to_transporter(sqs_queue, hl7v2_message)
+    except Exception as exc:
+        message = "Unable to pass request to back end system"
+        logger.exception(message, exc_info=exc)
+        return (500, {}, message, None)
+    writer.record_sent()
+    return (status_code, resource, "", headers)
+
+
+def patch(
+    sqs_queue: str, event: Any
+) -> Tuple[int, Optional[dict], str, Optional[dict]]:
+    from lib.fhir_resource_patcher import FhirResourcePatcher, PreconditionFailed
+    from lib.fhir_resource_writer import FhirResourceWriter
+    from lib.json_patch import JsonPatchConflict
+    from lib.message_store import MessageNotFound
+
+    path_parameters = event.get("pathParameters") or {}
+    resource_type = path_parameters.get("resource_type", "")
+    resource_id = path_parameters.get("id", "")
+    content_type = get_header(event, "Content-Type") or "application/json-patch+json"
+    if content_type.split(";")[0].strip().lower() not in [
+        "application/json-patch+json",
+        "application/json",
+    ]:
+        return (415, {}, "Only JSON Patch documents are supported", None)
+
+    try:
+        patcher = FhirResourcePatcher(get_message_store(), path_parameters)
+        fhir_resource = patcher.patch(parse_event(event), get_header(event, "If-Match"))
+    except MessageNotFound:
+        return (
+            404,
+            {},
+            f"Unable to find resource {resource_type} with {resource_id}",
+            None,
+        )
+    except PreconditionFailed as exc:
+        return (412, {}, str(exc), None)
+    except JsonPatchConflict as exc:
+        return (422, {}, str(exc), None)
+    except ValueError as exc:
+        # Invalid JSON or JSON Patch document
+        return (400, {}, str(exc), None)
+
+    try:
+        writer = FhirResourceWriter(
+            fhir_resource,
+            path_parameters,
+            hash_store=get_content_hash_store(),
+            search_index=get_search_index(),
+            previous=(patcher.message, patcher.resource),
+        )
+        hl7v2_message, resource = writer.write(
+            return_representation=(get_return_preference(event) != "minimal")
+        )
+    except Exception as exc:
+        message = f"Unable to encode patched resource {resource_type}"
+        logger.exception(message, exc_info=exc)
+        return (422, {}, message, None)
+    return send_written(sqs_queue, writer, hl7v2_message, resource, 200)
+
+
+def write_bundle(
+    sqs_queue: str, bundle: dict, return_representation: bool
+) -> Tuple[int, dict, str]:
+    from lib.fhir_bundle_writer import FhirBundleWriter
+
+    if bundle.get("resourceType") != "Bundle":
+        return (400, {}, "Expected Bundle resource")
+    try:
+        writer = FhirBundleWriter(bundle, get_content_hash_store(), get_search_index())
+    except ValueError as exc:
+        return (400, {}, str(exc))
+
+    results = writer.write(return_representation)
+    if writer.bundle_type == "transaction":
+        for result in results:
+            if result["message"] is None:
+                # Transaction with an entry that cannot be converted is
+                # rejected before any message is sent. Sending is best-effort
+                # for batches and transactions alike, with a status per entry.
+                return (400, {}, f"Unable to process transaction: {result['outcome']}")
+
+    sent_results = [
+        result
+        for result in results
+        if result["message"] is not None and not result["unchanged"]
+    ]
+    failed = send_hl7_batch_to_transporter(
+        sqs_queue, [result["message"] for result in sent_results]
+    )
+    writer.record_sent(
+        [result for index, result in enumerate(sent_results) if index not in failed]
+    )
+    for index in failed:
+        sent_results[index].update(
+            status="500 Internal Server Error",
+            outcome="Unable to pass request to back end system",
+            resource=None,
+            location=None,
+            etag=None,
+        )
+
+    return (200, writer.response(results), "")
+
+
+def search(event: Any) -> Tuple[int, dict, str]:
+    from lib.fhir_resource_search import FhirResourceSearch
+
+    search_index = get_search_index()
+    if search_index is None:
+        return (501, {}, "Search is not enabled")
+    try:
+        resource = FhirResourceSearch(
+            get_message_store(),
+            search_index,
+            event.get("pathParameters"),
+            event.get("queryStringParameters"),
+        ).search()
+    except ValueError as exc:
+        return (400, {}, str(exc))
+    except Exception as exc:
+        message = "Unable to search resources"
+        logger.exception(message, exc_info=exc)
+        return (500, {}, message)
+    return (200, resource, "")
 
 
 def send_hl7_to_transporter(sqs_queue: str, message: Any) -> None:
-    sqs = boto3.client("sqs")
-    sqs.send_message(QueueUrl=sqs_queue, MessageBody=message)
+    sqs = get_client("sqs")
+    with request_metrics.timer("Send"):
+        body, attributes = encode_message(message)
+        sqs.send_message(
+            QueueUrl=sqs_queue, MessageBody=body, MessageAttributes=attributes
+        )
+
+
+def send_hl7_batch_to_transporter(sqs_queue: str, messages: List[str]) -> dict:
+    """
+    Sends messages with SendMessageBatch requests of up to 10 messages
+    and returns positions of failed messages mapped to the SQS error code.
+    When a request fails, its messages and the messages of later requests
+    are not sent and returned as failed.
+    """
+    sqs = get_client("sqs")
+    failed = dict()
+    try:
+        with request_metrics.timer("Send"):
+            encoded = encode_messages(messages)
+    except Exception as exc:
+        logger.exception("Unable to encode messages", exc_info=exc)
+        return {index: type(exc).__name__ for index in range(len(messages))}
+    batches = _split_batches(encoded)
+    for position, batch in enumerate(batches):
+        try:
+            with request_metrics.timer("Send"):
+                response = sqs.send_message_batch(
+                    QueueUrl=sqs_queue,
+                    Entries=[
+                        dict(
+                            Id=str(index),
+                            MessageBody=encoded[index][0],
+                            MessageAttributes=encoded[index][1],
+                        )
+                        for index in batch
+                    ],
+                )
+        except Exception as exc:
+            logger.exception("Unable to send messages", exc_info=exc)
+            for unsent in batches[position:]:
+                failed.update((index, type(exc).__name__) for index in unsent)
+            break
+        for failure in response.get("Failed", []):
+            failed[int(failure["Id"])] = failure.get("Code", "")
+            logger.error(f"Unable to send message: {failure.get('Message')}")
+    return failed
+
+
+def _split_batches(encoded: List[Tuple[str, dict]]) -> List[List[int]]:
+    # Groups positions of encoded messages into batches within SQS entry and
+    # size limits
+    batches = list()
+    batch, batch_size = list(), 0
+    for index, (body, attributes) in enumerate(encoded):
+        message_size = get_size(body, attributes)
+        if batch and (
+            len(batch) == SQS_BATCH_MAX_ENTRIES
+            or batch_size + message_size > SQS_BATCH_MAX_BYTES
+        ):
+            batches.append(batch)
+            batch, batch_size = list(), 0
+        batch.append(index)
+        batch_size += message_size
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 def parse_event(event: Any) -> Any:
-    if event.get("isBase64Encoded"):
-        return json.loads(b64decode(event["body"]))
+    request_metrics.put_metric("PayloadBytes", len(event["body"]), "Bytes")
+    with request_metrics.timer("ParseEvent"):
+        if event.get("isBase64Encoded"):
+            return json.loads(b64decode(event["body"]))
+        else:
+            return json.loads(event["body"])
+
+
+def get_header(event: Any, name: str) -> Optional[str]:
+    name = name.lower()
+    for header, value in (event.get("headers") or {}).items():
+        if header.lower() == name:
+            return value
+    return None
+
+
+def get_return_preference(event: Any) -> str:
+    """
+    Returns value of the return preference (RFC 7240) of the Prefer header:
+    "minimal" or "representation" (default)
+    """
+    if prefer := get_header(event, "Prefer"):
+        for preference in prefer.replace(",", ";").split(";"):
+            name, _, value = preference.strip().partition("=")
+            if name.strip().lower() == "return" and value.strip(' "') == "minimal":
+                return "minimal"
+    return "representation"
+
+
+def prepare_response(
+    status_code: int, resource: Any, message: str, headers: dict = None
+) -> dict:
+    response = {"statusCode": status_code}
+    if headers:
+        response["headers"] = headers
+    # Resource is None for write interactions with Prefer: return=minimal
+    # and for read interactions with matching If-None-Match
+    if resource is None:
+        response["body"] = ""
     else:
-        return json.loads(event["body"])
+        response["body"] = json.dumps({"resource": resource, "message": message})
+    return response
 
 
-def prepare_response(status_code: int, resource: Any, message: str) -> dict:
-    body = {"resource": resource, "message": message}
-    return {
-        "statusCode": status_code,
-        "body": json.dumps(body),
-    }
+init()
@@ -3,17 +3,27 @@
 import logging
 import os
 import signal
+from typing import Optional, Tuple
 
-import boto3
-from twisted.internet import defer, reactor
-from txHL7.mllp import MLLPFactory
-from txHL7.receiver import AbstractHL7Receiver
+import hl7
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+from txHL7.mllp import MinimalLowerLayerProtocol, MLLPFactory
+from txHL7.receiver import AbstractHL7Receiver, MessageContainer
+
+from message_store import get_message_store
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_bucket_name = os.environ["S3_BUCKET_NAME"]
 port = int(os.environ.get("PORT_NUMBER", "2575"))
+mllp_encoding = os.environ.get("MLLP_ENCODING", "utf-8")
+
+# Message store writes run in a bounded thread pool off the reactor thread.
+# Connections stop reading when max_pending_writes messages are waiting to be
+# persisted and resume when half of them completed.
+persistence_threads = int(os.environ.get("PERSISTENCE_THREADS", "10"))
+max_pending_writes = int(os.environ.get("MAX_PENDING_WRITES", "100"))
 
 resource_type = {
     "ADT": "Patient",
@@ -21,35 +31,222 @@ resource_type = {
 }
 
 
+def scan_message(raw_message: bytes) -> Optional[Tuple[bytes, bytes, bytes]]:
+    """
+    Returns message type (MSH-9.1), control ID (MSH-10) and resource ID (PID-3
+    identifier with type FW, or OBR-3 filler order number in namespace FW for
+    ORU messages) read from ER7 bytes without parsing the message, or None if
+    the message must be parsed to find them
+    """
+    if not raw_message.startswith(b"MSH"):
+        return None
+    field_separator = raw_message[3:4]
+    encoding_characters_end = raw_message.find(field_separator, 4)
+    if encoding_characters_end != 8:
+        return None
+    (
+        component_separator,
+        repetition_separator,
+        escape_character,
+        subcomponent_separator,
+    ) = [raw_message[i : i + 1] for i in range(4, 8)]
+
+    # MSH-1 is the field separator itself, so MSH-n is part n - 1 of the segment
+    msh_fields = raw_message.split(b"\r", 1)[0].split(field_separator)
+    if len(msh_fields) < 10:
+        return None
+    # First subcomponent of the first component, as python-hl7 field access
+    message_type, control_id = [
+        field.split(repetition_separator, 1)[0]
+        .split(component_separator, 1)[0]
+        .split(subcomponent_separator, 1)[0]
+        for field in msh_fields[8:10]
+    ]
+
+    # Observation id is the OBR-3 filler order number in the FW namespace
+    segment_name, fw_component = (b"OBR", 1) if message_type == b"ORU" else (b"PID", 4)
+    segment_start = raw_message.find(b"\r" + segment_name + field_separator)
+    if segment_start < 0:
+        return None
+    segment_end = raw_message.find(b"\r", segment_start + 1)
+    segment_fields = raw_message[
+        segment_start + 1 : segment_end if segment_end >= 0 else len(raw_message)
+    ].split(field_separator)
+    if len(segment_fields) < 4:
+        return None
+    resource_id = None
+    for repetition in segment_fields[3].split(repetition_separator):
+        components = repetition.split(component_separator)
+        if len(components) > fw_component and components[fw_component] == b"FW":
+            resource_id = components[0]
+            break
+
+    # Escaped values are left to the parser
+    if resource_id is None or any(
+        escape_character in value for value in [message_type, control_id, resource_id]
+    ):
+        return None
+    return (message_type, control_id, resource_id)
+
+
+class RawMessageContainer(MessageContainer):
+    """
+    Message container that keeps the received bytes and reads the fields used
+    by the receiver without parsing the message. The message is parsed with
+    python-hl7 only if the fields cannot be read from the bytes.
+    """
+
+    def __init__(self, raw_message: bytes):
+        # Framing characters left between messages are removed, as by hl7.parse
+        MessageContainer.__init__(self, raw_message.strip())
+        self._message = None
+        self.fields = scan_message(self.raw_message)
+        if self.fields is None:
+            # Invalid messages are rejected when they are received
+            self._message = hl7.parse(self.raw_message, encoding=mllp_encoding)
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = hl7.parse(self.raw_message, encoding=mllp_encoding)
+        return self._message
+
+    def ack(self, ack_code="AA"):
+        if self._message is None:
+            # ACK only depends on the message header
+            header = self.raw_message.split(b"\r", 1)[0]
+            return str(hl7.parse(header, encoding=mllp_encoding).create_ack(ack_code))
+        return str(self._message.create_ack(ack_code))
+
+
 class HL7Receiver(AbstractHL7Receiver):
+    message_cls = RawMessageContainer
+
+    def __init__(self, store, thread_pool):
+        self._store = store
+        self._thread_pool = thread_pool
+        # Writes of the same key are serialized to keep the last message
+        self._locks = dict()
+
+    def getCodec(self):
+        return (mllp_encoding, "strict")
+
     def handleMessage(self, container):
-        message = container.message
+        if container.fields is not None:
+            message_type, control_id, resource_id = [
+                value.decode(mllp_encoding) for value in container.fields
+            ]
+        else:
+            message = container.message
 
-        message_type = str(message["MSH.F9"])
-        resource_id = None
-        for pid_3 in message.segment("PID")[3]:
-            if len(pid_3) >= 5 and str(pid_3[4]) == "FW":
-                resource_id = str(pid_3[0])
-                break
+            message_type = str(message["MSH.F9"])
+            control_id = str(message["MSH.F10"])
+            resource_id = None
+            if str(message_type) == "ORU":
+                segment_name, fw_component = ("OBR", 1)
+            else:
+                segment_name, fw_component = ("PID", 4)
+            for identifier in message.segment(segment_name)[3]:
+                if len(identifier) > fw_component and (
+                    str(identifier[fw_component]) == "FW"
+                ):
+                    resource_id = str(identifier[0])
+                    break
 
         if resource_id is None:
             raise Exception("Unable to get resource ID from the message")
 
-        print(f"Received message {message_type} id: [{resource_id}]", flush=True)
-
-        try:
-            s3 = boto3.resource("s3")
-            s3_object = s3.Object(
-                s3_bucket_name,
-                f"{resource_type.get(str(message_type), 'Other')}/{resource_id}",
-            )
-            s3_object.put(Body=str.encode(str(message)))
-        except Exception as e:
-            logger.exception(f"Exception: {repr(e)}", exc_info=e)
-            raise (e)
-        else:
-            # We succeeded, so ACK back (default is AA)
-            return defer.succeed(container.ack())
+        print(
+            f"Received message {message_type} control id: [{control_id}] "
+            f"id: [{resource_id}]",
+            flush=True,
+        )
+
+        # Message is stored as received
+        key = f"{resource_type.get(str(message_type), 'Other')}/{resource_id}"
+        d = self._persist(key, container.raw_message)
+        # We succeeded, so ACK back (default is AA)
+        d.addCallback(lambda _: container.ack())
+        d.addErrback(self._log_error)
+        return d
+
+    def _persist(self, key, body):
+        lock = self._locks.setdefault(key, defer.DeferredLock())
+        d = lock.run(
+            threads.deferToThreadPool,
+            reactor,
+            self._thread_pool,
+            self._store.put,
+            key,
+            body,
+        )
+        d.addBoth(self._release_lock, key, lock)
+        return d
+
+    def _release_lock(self, result, key, lock):
+        if not lock.locked and not lock.waiting:
+            self._locks.pop(key, None)
+        return result
+
+    def _log_error(self, failure):
+        logger.error(f"Exception: {repr(failure.value)}", exc_info=failure.value)
+        return failure
+
+
+class HL7Protocol(MinimalLowerLayerProtocol):
+    def connectionMade(self):
+        MinimalLowerLayerProtocol.connectionMade(self)
+        self.factory.connectionMade(self)
+
+    def connectionLost(self, reason):
+        self.factory.connectionLost(self)
+        MinimalLowerLayerProtocol.connectionLost(self, reason)
+
+
+class HL7Factory(MLLPFactory):
+    """
+    MLLP factory that pauses reading from all connections while too many
+    messages are waiting to be persisted
+    """
+
+    protocol = HL7Protocol
+
+    def __init__(self, receiver, max_pending):
+        MLLPFactory.__init__(self, receiver)
+        self._max_pending = max_pending
+        self._pending = 0
+        self._paused = False
+        self._connections = set()
+
+    def connectionMade(self, connection):
+        self._connections.add(connection)
+        if self._paused:
+            connection.transport.pauseProducing()
+
+    def connectionLost(self, connection):
+        self._connections.discard(connection)
+
+    def decode(self, value):
+        # Messages are passed to the receiver as received bytes
+        return value
+
+    def handleMessage(self, message_container):
+        self._pending += 1
+        if not self._paused and self._pending >= self._max_pending:
+            self._paused = True
+            for connection in self._connections:
+                connection.transport.pauseProducing()
+        d = MLLPFactory.handleMessage(self, message_container)
+        d.addBoth(self._message_handled)
+        return d
+
+    def _message_handled(self, result):
+        self._pending -= 1
+        if self._paused and self._pending <= self._max_pending // 2:
+            self._paused = False
+            for connection in self._connections:
+                connection.transport.resumeProducing()
+        return result
 
 
 def handler(signum, frame):
@@ -60,8 +257,12 @@ def run(port):
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGTERM, handler)
 
-    receiver = HL7Receiver()
-    factory = MLLPFactory(receiver)
+    thread_pool = ThreadPool(maxthreads=persistence_threads, name="persistence")
+    thread_pool.start()
+    reactor.addSystemEventTrigger("during", "shutdown", thread_pool.stop)
+
+    receiver = HL7Receiver(get_message_store(), thread_pool)
+    factory = HL7Factory(receiver, max_pending_writes)
 
     reactor.listenTCP(port, factory)
     print(f"Listening on port {port}", flush=True)
@@ -0,0 +1,197 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Storage of HL7v2 messages received by the Test HL7 Server, keyed by
+# "{resource_type}/{id}". The backend is selected by environment variables:
+#   MESSAGE_STORE      - s3 (default) or sqlite
+#   S3_BUCKET_NAME     - bucket of the s3 backend
+#   MESSAGE_STORE_PATH - database file of the sqlite backend (default messages.db)
+#
+# The sqlite backend keeps messages in a local embedded database, e.g. for
+# benchmarks and local runs. Entity tags of both backends are quoted MD5
+# digests of the message, the same as S3 ETags of objects uploaded at once.
+import os
+import threading
+from hashlib import md5
+from typing import Iterable, List, Optional, Tuple
+
+from aws_clients import get_client
+
+MESSAGE_STORE = os.environ.get("MESSAGE_STORE", "s3")
+
+_lock = threading.Lock()
+_stores = dict()
+
+
+class MessageNotFound(KeyError):
+    """
+    Raised when there is no message stored under the key
+    """
+
+
+class MessageStore(object):
+    """
+    Interface of HL7v2 message storage backends
+    """
+
+    # Identifies the storage location, e.g. in cache keys
+    location = None
+
+    def get(
+        self, key: str, if_none_match: Optional[str] = None
+    ) -> Tuple[Optional[bytes], str]:
+        """
+        Returns message and its entity tag. Message is None if the entity tag
+        equals if_none_match. Raises MessageNotFound for unknown keys.
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, body: bytes) -> str:
+        """
+        Stores message and returns its entity tag
+        """
+        raise NotImplementedError
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]) -> List[str]:
+        """
+        Stores (key, message) pairs and returns their entity tags
+        """
+        return [self.put(key, body) for key, body in items]
+
+    def keys(self, prefix: str = "") -> List[str]:
+        """
+        Returns sorted keys starting with prefix
+        """
+        raise NotImplementedError
+
+
+class S3MessageStore(MessageStore):
+    """
+    Messages stored as S3 objects
+    """
+
+    def __init__(self, bucket_name: str) -> None:
+        self._bucket_name = bucket_name
+        self.location = f"s3://{bucket_name}"
+
+    def get(
+        self, key: str, if_none_match: Optional[str] = None
+    ) -> Tuple[Optional[bytes], str]:
+        from botocore.exceptions import ClientError
+
+        s3 = get_client("s3")
+        parameters = dict(Bucket=self._bucket_name, Key=key)
+        if if_none_match:
+            parameters["IfNoneMatch"] = if_none_match
+        try:
+            obj = s3.get_object(**parameters)
+        except ClientError as exc:
+            code = exc.response.get("Error", {}).get("Code")
+            if code in ["304", "NotModified"]:
+                return (None, if_none_match)
+            if code in ["404", "NoSuchKey"]:
+                raise MessageNotFound(key) from exc
+            raise
+        return (obj["Body"].read(), obj["ETag"])
+
+    def put(self, key: str, body: bytes) -> str:
+        s3 = get_client("s3")
+        return s3.put_object(Bucket=self._bucket_name, Key=key, Body=body)["ETag"]
+
+    def keys(self, prefix: str = "") -> List[str]:
+        s3 = get_client("s3")
+        paginator = s3.get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return keys
+
+
+class SqliteMessageStore(MessageStore):
+    """
+    Messages stored in a local SQLite database. Keys are the primary key of
+    the table, so lookups and prefix scans use its index.
+    """
+
+    def __init__(self, path: str) -> None:
+        import sqlite3
+
+        self.location = f"sqlite://{os.path.abspath(path)}"
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        # Write-ahead log lets other processes read while messages are written
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages "
+            "(key TEXT PRIMARY KEY, etag TEXT NOT NULL, body BLOB NOT NULL) "
+            "WITHOUT ROWID"
+        )
+
+    def get(
+        self, key: str, if_none_match: Optional[str] = None
+    ) -> Tuple[Optional[bytes], str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, body FROM messages WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            raise MessageNotFound(key)
+        etag, body = row
+        if etag == if_none_match:
+            return (None, etag)
+        return (bytes(body), etag)
+
+    def put(self, key: str, body: bytes) -> str:
+        return self.put_many([(key, body)])[0]
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]) -> List[str]:
+        rows = [(key, f'"{md5(body).hexdigest()}"', body) for key, body in items]
+        # All messages are written in one transaction
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO messages (key, etag, body) "
+                    "VALUES (?, ?, ?)",
+                    rows,
+                )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return [etag for _, etag, _ in rows]
+
+    def keys(self, prefix: str = "") -> List[str]:
+        # Range scan on the primary key instead of LIKE, which does not use
+        # the index for parameters
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key FROM messages WHERE key >= ? AND key < ? ORDER BY key",
+                (prefix, prefix + "\U0010ffff"),
+            ).fetchall()
+        return [key for key, in rows]
+
+
+def get_message_store(name: str = None) -> MessageStore:
+    """
+    Returns shared message store of the backend, creating it on first use
+    """
+    name = name or MESSAGE_STORE
+    store = _stores.get(name)
+    if store is None:
+        with _lock:
+            store = _stores.get(name)
+            if store is None:
+                if name == "s3":
+                    store = S3MessageStore(os.environ["S3_BUCKET_NAME"])
+                elif name == "sqlite":
+                    store = SqliteMessageStore(
+                        os.environ.get("MESSAGE_STORE_PATH", "messages.db")
+                    )
+                else:
+                    raise ValueError(f"Unknown message store {name}")
+                _stores[name] = store
+    return store